@@ -34,11 +34,15 @@ interface MatchedStudent {
   timestamp: string
 }
 
-// Real face detection using face-api.js
-async function detectFaceInCanvas(canvas: HTMLCanvasElement): Promise<boolean> {
+type FaceBox = { x: number; y: number; w: number; h: number }
+
+// Real face detection using face-api.js; returns the largest face's box in canvas pixels, or null
+async function detectFaceInCanvas(canvas: HTMLCanvasElement): Promise<FaceBox | null> {
   // Detect with face-api.js
   const detections = await faceapi.detectAllFaces(canvas, new faceapi.TinyFaceDetectorOptions());
-  return detections.length > 0;
+  if (detections.length === 0) return null;
+  const { x, y, width, height } = detections.reduce((a, b) => (b.box.area > a.box.area ? b : a)).box;
+  return { x: Math.round(x), y: Math.round(y), w: Math.round(width), h: Math.round(height) };
 }
 
 export default function MobileAttendanceScreen() {
@@ -313,12 +317,57 @@ export default function MobileAttendanceScreen() {
 
   // Backend recognition flow
   const BACKEND_URL = process.env.NEXT_PUBLIC_BACKEND_URL || 'http://localhost:8000';
-  async function recognizeFace(file: File, auto = false) {
+  // Show a /recognize result (HTTP response or WebSocket "recognition" event)
+  function handleRecognitionResult(result: any) {
+    setLastDebugInfo({status: result.status, distance: result.distance ?? null});
+    // Only allow marking if the matched student is in filteredStudents
+    if (result.status === 'success' || result.status === 'already-marked') {
+      if (!filteredUsns.has(result.usn)) {
+        setRecognitionStatus("no-match");
+        setMatchedStudent(null);
+        setRecognitionError('Face not recognized for this class/subject');
+        setTimeout(() => setRecognitionStatus("scanning"), 2000);
+        setRecognizing(false);
+        return;
+      }
+    }
+    if (result.status === 'success') {
+      setRecognitionStatus("matched");
+      setMatchedStudent({ name: result.name || "", usn: result.usn, timestamp: new Date().toLocaleTimeString() });
+      setTimeout(() => {
+        setRecognizing(false);
+        setRecognitionStatus('scanning');
+      }, 2000);
+    } else if (result.status === 'already-marked') {
+      setRecognitionStatus("already-marked");
+      setMatchedStudent({ name: result.name || "", usn: result.usn, timestamp: "Already marked" });
+      setTimeout(() => {
+        setRecognizing(false);
+        setRecognitionStatus('scanning');
+      }, 2000);
+    } else if (result.status === 'no-face') {
+      setRecognitionStatus("no-face");
+      setMatchedStudent(null);
+      setTimeout(() => setRecognizing(false), 2000);
+    } else {
+      setRecognitionStatus("no-match");
+      setMatchedStudent(null);
+      setRecognitionError(result.message || 'No match');
+      setTimeout(() => {
+        setRecognizing(false);
+        setRecognitionStatus('scanning');
+      }, 2000);
+    }
+  }
+
+  async function recognizeFace(file: File, auto = false, faceBox: FaceBox | null = null) {
     setRecognizing(true);
     setRecognitionError(null);
     try {
       const formData = new FormData();
       formData.append('file', file);
+      // The box found on-device lets the backend skip its own face detection
+      if (faceBox) formData.append('face_box', JSON.stringify(faceBox));
       // Add session_id, class, subject if available
       if (sessionInfo) {
         formData.append('session_id', sessionInfo.sessionId);
@@ -343,46 +392,7 @@ export default function MobileAttendanceScreen() {
         setTimeout(() => setRecognizing(false), 2000);
         return;
       }
-      const result = await response.json();
-      setLastDebugInfo({status: result.status, distance: result.distance ?? null});
-      // Only allow marking if the matched student is in filteredStudents
-      if (result.status === 'success' || result.status === 'already-marked') {
-        if (!filteredUsns.has(result.usn)) {
-          setRecognitionStatus("no-match");
-          setMatchedStudent(null);
-          setRecognitionError('Face not recognized for this class/subject');
-          setTimeout(() => setRecognitionStatus("scanning"), 2000);
-          setRecognizing(false);
-          return;
-        }
-      }
-      if (result.status === 'success') {
-        setRecognitionStatus("matched");
-        setMatchedStudent({ name: result.name || "", usn: result.usn, timestamp: new Date().toLocaleTimeString() });
-        setTimeout(() => {
-          setRecognizing(false);
-          setRecognitionStatus('scanning');
-        }, 2000);
-      } else if (result.status === 'already-marked') {
-        setRecognitionStatus("already-marked");
-        setMatchedStudent({ name: result.name || "", usn: result.usn, timestamp: "Already marked" });
-        setTimeout(() => {
-          setRecognizing(false);
-          setRecognitionStatus('scanning');
-        }, 2000);
-      } else if (result.status === 'no-face') {
-        setRecognitionStatus("no-face");
-        setMatchedStudent(null);
-        setTimeout(() => setRecognizing(false), 2000);
-      } else {
-        setRecognitionStatus("no-match");
-        setMatchedStudent(null);
-        setRecognitionError(result.message || 'No match');
-        setTimeout(() => {
-          setRecognizing(false);
-          setRecognitionStatus('scanning');
-        }, 2000);
-      }
+      handleRecognitionResult(await response.json());
     } catch (err) {
       setRecognitionStatus("no-match");
       setMatchedStudent(null);
@@ -395,6 +405,43 @@ export default function MobileAttendanceScreen() {
     }
   }
 
+  // Streaming recognition: while a session is active, one WebSocket carries every auto-captured
+  // frame; the session context is sent once when it opens. Falls back to POST /recognize when closed.
+  const wsRef = useRef<WebSocket | null>(null);
+  const handleResultRef = useRef(handleRecognitionResult);
+  handleResultRef.current = handleRecognitionResult;
+  useEffect(() => {
+    if (!sessionInfo || !cameraActive) return;
+    const ws = new WebSocket(`${BACKEND_URL.replace(/^http/, 'ws')}/ws/recognize`);
+    ws.onopen = () => ws.send(JSON.stringify({
+      session_id: sessionInfo.sessionId,
+      class_name: sessionInfo.className,
+      subject: sessionInfo.subject,
+      teacher_id: sessionInfo.teacherId,
+      mode: sessionInfo.sessionMode?.toLowerCase(),
+    }));
+    ws.onmessage = (event) => {
+      const message = JSON.parse(event.data);
+      if (message.type === 'recognition') {
+        handleResultRef.current(message);
+      } else if (message.type === 'busy') {
+        setRecognizing(false);
+      }
+    };
+    ws.onclose = () => {
+      // A frame in flight gets no answer; let the capture loop continue over HTTP
+      if (wsRef.current === ws) {
+        wsRef.current = null;
+        setRecognizing(false);
+      }
+    };
+    wsRef.current = ws;
+    return () => {
+      wsRef.current = null;
+      ws.close();
+    };
+  }, [sessionInfo?.sessionId, sessionInfo?.sessionMode, cameraActive]);
+
   // Real-time auto-capture effect
   useEffect(() => {
     if (!cameraActive || recognizing || !modelsLoaded) return;
@@ -410,8 +457,8 @@ export default function MobileAttendanceScreen() {
         if (!ctx) return;
         ctx.drawImage(videoRef.current, 0, 0);
         // Real face detection
-        const hasFace = await detectFaceInCanvas(canvas);
-        if (!hasFace) {
+        const faceBox = await detectFaceInCanvas(canvas);
+        if (!faceBox) {
           setRecognitionStatus('no-face');
           setMatchedStudent(null);
           return;
@@ -421,7 +468,13 @@ export default function MobileAttendanceScreen() {
         setRecognitionError(null);
         canvas.toBlob(async (blob) => {
           if (blob) {
-            await recognizeFace(new File([blob], 'photo.jpg', { type: 'image/jpeg' }), true);
+            const ws = wsRef.current;
+            if (ws && ws.readyState === WebSocket.OPEN) {
+              ws.send(JSON.stringify({ face_box: faceBox }));
+              ws.send(await blob.arrayBuffer());
+            } else {
+              await recognizeFace(new File([blob], 'photo.jpg', { type: 'image/jpeg' }), true, faceBox);
+            }
           } else {
             setRecognitionStatus('no-face');
             setMatchedStudent(null);
@@ -0,0 +1,347 @@
+#3.Music/face-backend/ann_index.py
+# Optional approximate nearest-neighbour backends for large (multi-campus) galleries.
+# Every backend implements VectorIndex: build/add/remove/search over (id, usn, vector)
+# rows, plus save/load to a local directory. IVFIndex is a pure-NumPy inverted file:
+# spherical k-means centroids, one posting list per centroid, and a search that only
+# scores the `nprobe` lists closest to the query. Saved indexes are memory-mapped on load
+# and kept current incrementally, so startup never has to retrain.
+# On disk, `path/CURRENT` names the subdirectory holding the complete saved index. A save writes
+# a new subdirectory and then replaces CURRENT, so a crash mid-save leaves the previous index.
+import json
+import logging
+import os
+import shutil
+import uuid
+import numpy as np
+from matcher import normalize_rows
+
+DEFAULT_NPROBE = 8
+KMEANS_ITERATIONS = 10
+KMEANS_TRAIN_SAMPLE = 50000
+RETRAIN_GROWTH = 4.0  # retrain once the index holds this many times its training size
+log = logging.getLogger(__name__)
+
+
+class VectorIndex:
+    """Interface shared by all index backends. Rows are identified by face_embeddings.id."""
+
+    kind = None
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def build(self, ids, usns, vectors):
+        raise NotImplementedError
+
+    def add(self, ids, usns, vectors):
+        raise NotImplementedError
+
+    def remove(self, ids):
+        raise NotImplementedError
+
+    def search(self, queries, k=1):
+        """Return (distances, usns, ids), each shaped (queries, k), nearest first.
+
+        Slots without a candidate have distance inf and usn/id None.
+        """
+        raise NotImplementedError
+
+    def fresh(self):
+        """An empty, untrained index with the same parameters, to build beside this one."""
+        raise NotImplementedError
+
+    def export(self):
+        """(arrays, meta) describing the index, for write_index(); cheap next to writing them."""
+        raise NotImplementedError
+
+    def save(self, path):
+        write_index(path, *self.export())
+
+    def needs_retrain(self):
+        return False
+
+    def sync(self, ids, usns, vectors):
+        """Bring the index in line with the authoritative rows, touching only what changed."""
+        ids = np.asarray(ids, dtype=object)
+        current = set(self.row_ids())
+        wanted = set(ids.tolist())
+        stale = current - wanted
+        if stale:
+            self.remove(stale)
+        new = np.array([i not in current for i in ids], dtype=bool)
+        if new.any():
+            self.add(ids[new], np.asarray(usns, dtype=object)[new], np.asarray(vectors)[new])
+        return len(stale), int(new.sum())
+
+    def row_ids(self):
+        raise NotImplementedError
+
+
+class _RowStore:
+    """Growable (id, usn, vector) storage with tombstones; the base block may be a read-only memmap."""
+
+    def __init__(self, dim, vectors=None, ids=None, usns=None):
+        self.dim = dim
+        self.vectors = vectors if vectors is not None else np.empty((0, dim), dtype=np.float32)
+        self.size = len(self.vectors)
+        self.ids = list(ids) if ids is not None else []
+        self.usns = list(usns) if usns is not None else []
+        self.alive = np.ones(self.size, dtype=bool)
+        self.position = {row_id: pos for pos, row_id in enumerate(self.ids)}
+
+    def __len__(self):
+        return len(self.position)
+
+    def append(self, ids, usns, vectors):
+        vectors = normalize_rows(vectors)
+        needed = self.size + len(vectors)
+        if needed > len(self.vectors) or isinstance(self.vectors, np.memmap):
+            grown = np.empty((max(needed, 2 * len(self.vectors), 1024), self.dim), dtype=np.float32)
+            grown[:self.size] = self.vectors[:self.size]
+            self.vectors = grown
+            self.alive = np.concatenate([self.alive, np.zeros(len(grown) - len(self.alive), dtype=bool)])
+        start = self.size
+        self.vectors[start:needed] = vectors
+        self.alive[start:needed] = True
+        for offset, (row_id, usn) in enumerate(zip(ids, usns)):
+            old = self.position.get(row_id)
+            if old is not None:
+                self.alive[old] = False
+            self.position[row_id] = start + offset
+            self.ids.append(row_id)
+            self.usns.append(usn)
+        self.size = needed
+        return np.arange(start, needed)
+
+    def remove(self, ids):
+        removed = 0
+        for row_id in ids:
+            pos = self.position.pop(row_id, None)
+            if pos is not None:
+                self.alive[pos] = False
+                removed += 1
+        return removed
+
+
+class BruteForceIndex(VectorIndex):
+    """Exact search over every live row; the reference the ANN backends are measured against."""
+
+    kind = "exact"
+
+    def __init__(self, dim=512):
+        self.store = _RowStore(dim)
+
+    def __len__(self):
+        return len(self.store)
+
+    def fresh(self):
+        return BruteForceIndex(self.store.dim)
+
+    def row_ids(self):
+        return list(self.store.position)
+
+    def build(self, ids, usns, vectors):
+        self.store = _RowStore(self.store.dim)
+        self.store.append(ids, usns, vectors)
+
+    def add(self, ids, usns, vectors):
+        self.store.append(ids, usns, vectors)
+
+    def remove(self, ids):
+        return self.store.remove(ids)
+
+    def search(self, queries, k=1):
+        candidates = np.flatnonzero(self.store.alive[:self.store.size])
+        return _rank(self.store, normalize_rows(queries), [candidates] * len(np.atleast_2d(queries)), k)
+
+
+class IVFIndex(VectorIndex):
+    """Inverted-file index: probe the `nprobe` nearest of `nlist` k-means cells per query."""
+
+    kind = "ivf"
+
+    def __init__(self, dim=512, nlist=None, nprobe=DEFAULT_NPROBE, seed=0):
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.seed = seed
+        self.centroids = np.empty((0, dim), dtype=np.float32)
+        self.lists = []
+        self.store = _RowStore(dim)
+        self.trained_size = 0
+
+    def __len__(self):
+        return len(self.store)
+
+    def row_ids(self):
+        return list(self.store.position)
+
+    def fresh(self):
+        return IVFIndex(dim=self.dim, nlist=self.nlist, nprobe=self.nprobe, seed=self.seed)
+
+    def needs_retrain(self):
+        return len(self.centroids) == 0 or len(self.store) > RETRAIN_GROWTH * max(self.trained_size, 1)
+
+    def build(self, ids, usns, vectors):
+        vectors = normalize_rows(vectors) if len(vectors) else np.empty((0, self.dim), dtype=np.float32)
+        nlist = self.nlist or max(1, int(4 * np.sqrt(len(vectors))))
+        self.centroids = _spherical_kmeans(vectors, min(nlist, max(len(vectors), 1)), self.seed)
+        self.lists = [np.empty(0, dtype=np.intp) for _ in range(len(self.centroids))]
+        self.store = _RowStore(self.dim)
+        self.trained_size = len(vectors)
+        if len(vectors):
+            self.add(ids, usns, vectors)
+
+    def add(self, ids, usns, vectors):
+        if len(self.centroids) == 0:
+            return self.build(ids, usns, vectors)
+        positions = self.store.append(ids, usns, vectors)
+        cells = np.argmax(self.store.vectors[positions] @ self.centroids.T, axis=1)
+        for cell in np.unique(cells):
+            self.lists[cell] = np.concatenate([self.lists[cell], positions[cells == cell]])
+
+    def remove(self, ids):
+        # Tombstoned rows stay in their posting list until the next save() compacts them
+        return self.store.remove(ids)
+
+    def search(self, queries, k=1, nprobe=None):
+        queries = normalize_rows(queries)
+        if len(self.centroids) == 0:
+            return _rank(self.store, queries, [np.empty(0, dtype=np.intp)] * len(queries), k)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        cell_sims = queries @ self.centroids.T
+        probes = np.argpartition(-cell_sims, nprobe - 1, axis=1)[:, :nprobe]
+        candidates = []
+        for cells in probes:
+            rows = np.concatenate([self.lists[c] for c in cells])
+            candidates.append(rows[self.store.alive[rows]])
+        return _rank(self.store, queries, candidates, k)
+
+    def export(self):
+        """A compacted copy (rows grouped by cell, tombstones dropped) for write_index()."""
+        order = [lst[self.store.alive[lst]] for lst in self.lists]
+        offsets = np.concatenate([[0], np.cumsum([len(o) for o in order])]).astype(np.int64)
+        rows = np.concatenate(order) if order else np.empty(0, dtype=np.intp)
+        arrays = {
+            "centroids": self.centroids,
+            "vectors": self.store.vectors[rows] if len(rows) else np.empty((0, self.dim), dtype=np.float32),
+            "offsets": offsets,
+            "ids": np.array([self.store.ids[r] for r in rows], dtype=str),
+            "usns": np.array([self.store.usns[r] for r in rows], dtype=str),
+        }
+        meta = {"kind": self.kind, "dim": self.dim, "nlist": self.nlist, "nprobe": self.nprobe,
+                "trained_size": self.trained_size, "size": int(len(rows))}
+        return arrays, meta
+
+    @classmethod
+    def load(cls, path):
+        """Open a saved index; vectors are memory-mapped and only copied into RAM on the first add.
+
+        Raises ValueError when the files do not describe one consistent index.
+        """
+        path = saved_index_dir(path)
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        index = cls(dim=meta["dim"], nlist=meta["nlist"], nprobe=meta["nprobe"])
+        index.trained_size = meta["trained_size"]
+        index.centroids = np.load(os.path.join(path, "centroids.npy"))
+        vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        ids = np.load(os.path.join(path, "ids.npy")).tolist()
+        usns = np.load(os.path.join(path, "usns.npy")).tolist()
+        offsets = np.load(os.path.join(path, "offsets.npy"))
+        sizes = {"meta": meta["size"], "vectors": len(vectors), "offsets": int(offsets[-1]) if len(offsets) else -1,
+                 "ids": len(ids), "usns": len(usns)}
+        if len(set(sizes.values())) != 1 or len(offsets) != len(index.centroids) + 1 or vectors.shape[1:] != (meta["dim"],):
+            raise ValueError(f"Inconsistent index files in {path}: {sizes}")
+        index.store = _RowStore(meta["dim"], vectors, ids, usns)
+        index.lists = [np.arange(offsets[c], offsets[c + 1], dtype=np.intp) for c in range(len(offsets) - 1)]
+        return index
+
+
+def saved_index_dir(path):
+    """The directory holding the files of the index saved at `path` (CURRENT, or the old flat layout)."""
+    try:
+        with open(os.path.join(path, "CURRENT")) as f:
+            return os.path.join(path, f.read().strip())
+    except FileNotFoundError:
+        return path
+
+
+def write_index(path, arrays, meta):
+    """Write an exported index to a new subdirectory of `path`, then switch CURRENT to it."""
+    os.makedirs(path, exist_ok=True)
+    name = f"index-{uuid.uuid4().hex}"
+    target = os.path.join(path, name)
+    os.makedirs(target)
+    for array_name, array in arrays.items():
+        np.save(os.path.join(target, f"{array_name}.npy"), array)
+    with open(os.path.join(target, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    tmp = os.path.join(path, "CURRENT.tmp")
+    with open(tmp, "w") as f:
+        f.write(name)
+    os.replace(tmp, os.path.join(path, "CURRENT"))
+    # Older saves (and files of the flat layout) are no longer referenced; an open memmap keeps its data
+    for entry in os.listdir(path):
+        stale = os.path.join(path, entry)
+        if entry.startswith("index-") and entry != name:
+            shutil.rmtree(stale, ignore_errors=True)
+        elif entry.endswith((".npy", ".json")):
+            os.remove(stale)
+
+
+def _rank(store, queries, candidates, k):
+    """Exact re-rank of each query's candidate rows; returns (distances, usns, ids) padded to k."""
+    dist = np.full((len(queries), k), np.inf, dtype=np.float32)
+    usns = np.full((len(queries), k), None, dtype=object)
+    ids = np.full((len(queries), k), None, dtype=object)
+    for q, rows in enumerate(candidates):
+        if len(rows) == 0:
+            continue
+        sims = store.vectors[rows] @ queries[q]
+        n = min(k, len(rows))
+        top = np.argpartition(-sims, n - 1)[:n] if n < len(rows) else np.arange(len(rows))
+        top = top[np.argsort(-sims[top], kind="stable")]
+        dist[q, :n] = 1.0 - sims[top]
+        usns[q, :n] = [store.usns[r] for r in rows[top]]
+        ids[q, :n] = [store.ids[r] for r in rows[top]]
+    return dist, usns, ids
+
+
+def _spherical_kmeans(vectors, n_clusters, seed):
+    """Cosine k-means on unit vectors; centroids are re-normalized every iteration."""
+    if len(vectors) == 0:
+        return np.empty((0, vectors.shape[1]), dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    sample = vectors
+    if len(vectors) > KMEANS_TRAIN_SAMPLE:
+        sample = vectors[rng.choice(len(vectors), KMEANS_TRAIN_SAMPLE, replace=False)]
+    centroids = sample[rng.choice(len(sample), n_clusters, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        empty = np.bincount(assign, minlength=n_clusters) == 0
+        if empty.any():
+            # Re-seed empty cells from random samples so every list stays useful
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+def open_index(path, kind="ivf", dim=512, **params):
+    """Load the index saved at `path` if it is of the requested kind, else return a fresh one."""
+    if kind == "exact":
+        return BruteForceIndex(dim)
+    if kind != "ivf":
+        raise ValueError(f"Unknown ANN backend: {kind!r}")
+    if path and os.path.exists(os.path.join(saved_index_dir(path), "meta.json")):
+        try:
+            index = IVFIndex.load(path)
+            if index.dim == dim:
+                if params.get("nprobe"):
+                    index.nprobe = params["nprobe"]
+                return index
+        except Exception as e:
+            log.warning(f"Failed to load index from {path}, rebuilding: {e}")
+    return IVFIndex(dim=dim, **params)
@@ -0,0 +1,306 @@
+#3.Music/face-backend/attendance.py
+# Per-session attendance state held in memory, so deciding "already marked?" on a scan needs no
+# Supabase read. A session's rows are loaded on its first scan, updated in place by every
+# check-in / check-out this worker writes, and reloaded once they are `refresh` seconds old, so
+# an undo made directly in Supabase from the teacher page is seen within that window.
+# AttendanceWriter batches the resulting upserts behind a durable local journal.
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+SESSION_IDLE_TTL = 6 * 3600  # forget sessions nobody has scanned for this long
+SESSION_REFRESH = 15.0  # seconds before a session's rows are read again
+log = logging.getLogger(__name__)
+
+
+def stamped(value):
+    return value not in (None, "", "null")
+
+
+def _apply(state, payload):
+    row = state.setdefault(payload["student_id"], {"check_in": None, "check_out": None})
+    for field in ("check_in", "check_out"):
+        if field in payload:
+            row[field] = payload[field]
+
+
+class SessionAttendance:
+    """session_id -> {student_id: {"check_in", "check_out"}} with lazy per-session loading.
+
+    `pending` (callable(session_id) -> payloads not yet written) is applied over every load so a
+    reload never loses this worker's own unflushed check-ins. `on_cleared` is called as
+    (session_id, mode, student_ids) for stamps a reload found removed from the database.
+    """
+
+    def __init__(self, loader, idle_ttl=SESSION_IDLE_TTL, refresh=SESSION_REFRESH, pending=None, on_cleared=None):
+        self.loader = loader  # callable(session_id) -> attendance rows with student_id/check_in/check_out
+        self.idle_ttl = idle_ttl
+        self.refresh = refresh
+        self.pending = pending
+        self.on_cleared = on_cleared
+        self._sessions = {}
+        self._last_used = {}
+        self._loaded_at = {}
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    def is_loaded(self, session_id):
+        return session_id in self._loaded_at
+
+    def is_fresh(self, session_id):
+        """Loaded less than `refresh` seconds ago, so its already-marked answers can be trusted."""
+        loaded_at = self._loaded_at.get(session_id)
+        return loaded_at is not None and time.monotonic() - loaded_at < self.refresh
+
+    def load(self, session_id):
+        """(Re)load a session's rows from the database; returns how many were loaded."""
+        rows = self.loader(session_id)
+        state = {row["student_id"]: {"check_in": row.get("check_in"), "check_out": row.get("check_out")} for row in rows}
+        with self._lock:
+            for payload in self.pending(session_id) if self.pending else ():
+                _apply(state, payload)
+            previous = self._sessions.get(session_id, {})
+            self._sessions[session_id] = state
+            self._last_used[session_id] = self._loaded_at[session_id] = time.monotonic()
+            self.loads += 1
+        if self.on_cleared:
+            for mode, field in (("check-in", "check_in"), ("check-out", "check_out")):
+                cleared = {student_id for student_id, row in previous.items()
+                           if stamped(row[field]) and not stamped(state.get(student_id, {}).get(field))}
+                if cleared:
+                    self.on_cleared(session_id, mode, cleared)
+        self._evict_idle()
+        return len(state)
+
+    def ensure_fresh(self, session_id):
+        if not self.is_fresh(session_id):
+            self.load(session_id)
+
+    def is_marked(self, session_id, student_id, mode):
+        with self._lock:
+            self._last_used[session_id] = time.monotonic()
+            row = self._sessions.get(session_id, {}).get(student_id)
+        if row is None:
+            return False
+        if mode == "check-in":
+            return stamped(row["check_in"])
+        if mode == "check-out":
+            return stamped(row["check_out"])
+        return False
+
+    def record(self, payload):
+        """Apply an attendance upsert payload to the in-memory state."""
+        session_id = payload["session_id"]
+        with self._lock:
+            _apply(self._sessions.setdefault(session_id, {}), payload)
+            self._last_used[session_id] = time.monotonic()
+
+    def forget(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            self._last_used.pop(session_id, None)
+            self._loaded_at.pop(session_id, None)
+
+    def _evict_idle(self):
+        cutoff = time.monotonic() - self.idle_ttl
+        with self._lock:
+            for session_id in [s for s, t in self._last_used.items() if t < cutoff]:
+                self._sessions.pop(session_id, None)
+                self._last_used.pop(session_id, None)
+                self._loaded_at.pop(session_id, None)
+
+    def status(self):
+        with self._lock:
+            return {"sessions": len(self._sessions), "rows": sum(len(s) for s in self._sessions.values()), "loads": self.loads}
+
+
+JOURNAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pending_attendance (
+    session_id TEXT NOT NULL,
+    student_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (session_id, student_id)
+);
+CREATE TABLE IF NOT EXISTS dead_attendance (
+    session_id TEXT NOT NULL,
+    student_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    error TEXT,
+    failed_at REAL NOT NULL
+);
+"""
+FLUSH_INTERVAL = 0.25  # seconds
+FLUSH_MAX_ROWS = 50
+MAX_ATTEMPTS = 10  # failed writes before a row is moved to dead_attendance
+RETRY_BACKOFF = 1.0  # seconds before a failed row is retried, doubling per attempt
+RETRY_BACKOFF_MAX = 300.0
+
+
+class AttendanceWriter:
+    """Write-behind buffer for attendance upserts.
+
+    Payloads are coalesced per (session_id, student_id), so a check-in followed by a check-out
+    becomes one row. They are journaled to SQLite before submit() returns and flushed as bulk
+    upserts every `interval` seconds or once `max_rows` are waiting. `upsert` is a
+    callable(list_of_payloads) that writes one bulk upsert; rows stay journaled until it succeeds.
+
+    A bulk upsert that fails is retried row by row, so one bad row (a deleted student, say) only
+    holds back itself. Each failing row waits `backoff` seconds, doubling per attempt, before its
+    next try, and after `max_attempts` it is moved to the journal's dead_attendance table.
+    """
+
+    def __init__(self, path, upsert, interval=FLUSH_INTERVAL, max_rows=FLUSH_MAX_ROWS,
+                 max_attempts=MAX_ATTEMPTS, backoff=RETRY_BACKOFF, backoff_max=RETRY_BACKOFF_MAX):
+        self.upsert = upsert
+        self.interval = interval
+        self.max_rows = max_rows
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._seq = 0
+        self.flushed = 0
+        self.failures = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(JOURNAL_SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(pending_attendance)")}
+        if "attempts" not in columns:  # journal written before retries were tracked
+            self._conn.execute("ALTER TABLE pending_attendance ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        self.dead = self._conn.execute("SELECT COUNT(*) FROM dead_attendance").fetchone()[0]
+        # Anything journaled before a crash is flushed on the next run
+        self._pending = {}
+        self._attempts = {}
+        self._retry_at = {}
+        for session_id, student_id, payload, seq, attempts in self._conn.execute(
+                "SELECT session_id, student_id, payload, seq, attempts FROM pending_attendance"):
+            self._pending[(session_id, student_id)] = (json.loads(payload), seq)
+            if attempts:
+                self._attempts[(session_id, student_id)] = attempts
+            self._seq = max(self._seq, seq)
+
+    def submit(self, payload):
+        """Buffer one attendance payload (merged into any pending row for the same student/session)."""
+        key = (payload["session_id"], payload["student_id"])
+        with self._lock:
+            previous = self._pending.get(key)
+            merged = {**previous[0], **payload} if previous else dict(payload)
+            if previous and stamped(previous[0].get("check_in")):
+                merged["check_in"] = previous[0]["check_in"]  # the first check-in wins
+            self._seq += 1
+            self._pending[key] = (merged, self._seq)
+            self._conn.execute("INSERT OR REPLACE INTO pending_attendance (session_id, student_id, payload, seq, attempts)"
+                               " VALUES (?, ?, ?, ?, ?)", (key[0], key[1], json.dumps(merged), self._seq, self._attempts.get(key, 0)))
+            size = len(self._pending)
+        if size >= self.max_rows:
+            self._wake.set()
+
+    def pending(self, session_id):
+        """Payloads for `session_id` that are buffered but not yet written."""
+        with self._lock:
+            return [payload for (sid, _), (payload, _) in self._pending.items() if sid == session_id]
+
+    def flush(self, session_id=None):
+        """Write pending rows (optionally only one session's) now; returns how many were written.
+
+        Rows still backing off from a failed write are left for a later flush.
+        """
+        with self._flush_lock:
+            now = time.monotonic()
+            with self._lock:
+                batch = {k: v for k, v in self._pending.items()
+                         if (session_id is None or k[0] == session_id) and self._retry_at.get(k, 0) <= now}
+            if not batch:
+                return 0
+            # PostgREST fills keys missing from some rows of a bulk upsert with NULL, which would
+            # wipe check_in on check-out-only rows; so rows are grouped by their set of columns.
+            groups = {}
+            for key, (payload, _) in batch.items():
+                groups.setdefault(tuple(sorted(payload)), []).append(key)
+            written, failed = [], {}
+            for keys in groups.values():
+                error = self._write([batch[key][0] for key in keys])
+                if error is None:
+                    written += keys
+                    continue
+                for key in keys:
+                    error = self._write([batch[key][0]]) if len(keys) > 1 else error
+                    if error is None:
+                        written.append(key)
+                    else:
+                        failed[key] = error
+            with self._lock:
+                for key in written:
+                    self._attempts.pop(key, None)
+                    self._retry_at.pop(key, None)
+                    seq = batch[key][1]
+                    current = self._pending.get(key)
+                    if current and current[1] == seq:  # not updated while we were writing
+                        del self._pending[key]
+                        self._conn.execute("DELETE FROM pending_attendance WHERE session_id = ? AND student_id = ? AND seq = ?",
+                                           (key[0], key[1], seq))
+                for key, error in failed.items():
+                    self._failed(key, error, now)
+                self.flushed += len(written)
+            if failed:
+                self.failures += 1
+                log.warning(f"Flush of {len(failed)} of {len(batch)} rows failed, will retry: {next(iter(failed.values()))}")
+            return len(written)
+
+    def _write(self, payloads):
+        try:
+            self.upsert(payloads)
+        except Exception as e:
+            return e
+        return None
+
+    def _failed(self, key, error, now):
+        # Held under self._lock: back off, or give up on the row after max_attempts
+        attempts = self._attempts.get(key, 0) + 1
+        if attempts < self.max_attempts:
+            self._attempts[key] = attempts
+            self._retry_at[key] = now + min(self.backoff_max, self.backoff * 2 ** (attempts - 1))
+            self._conn.execute("UPDATE pending_attendance SET attempts = ? WHERE session_id = ? AND student_id = ?",
+                               (attempts, key[0], key[1]))
+            return
+        payload, _ = self._pending.pop(key)
+        self._attempts.pop(key, None)
+        self._retry_at.pop(key, None)
+        self._conn.execute("DELETE FROM pending_attendance WHERE session_id = ? AND student_id = ?", key)
+        self._conn.execute("INSERT INTO dead_attendance VALUES (?, ?, ?, ?, ?, ?)",
+                           (key[0], key[1], json.dumps(payload), attempts, str(error), time.time()))
+        self.dead += 1
+        log.error(f"Giving up on attendance row {key} after {attempts} attempts, moved to dead_attendance: {error}")
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="attendance-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def status(self):
+        with self._lock:
+            return {"pending": len(self._pending), "retrying": len(self._retry_at), "flushed": self.flushed,
+                    "failures": self.failures, "dead": self.dead}
@@ -0,0 +1,63 @@
+#3.Music/face-backend/benchmarks/bench_ann.py
+# Recall-vs-latency benchmark for the IVF index against exact search.
+# "recall@1" is the fraction of queries whose nearest sample matches exact search;
+# "decision agreement" is the fraction whose final /recognize outcome (USN or no-match at
+# DISTANCE_THRESHOLD) is unchanged, which is what actually matters for attendance.
+#
+#   python benchmarks/bench_ann.py --sizes 10000 100000 --nprobe 1 4 8 16 32
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from ann_index import BruteForceIndex, IVFIndex  # noqa: E402
+from matcher import DISTANCE_THRESHOLD  # noqa: E402
+from bench_matcher import synthetic_gallery  # noqa: E402
+
+
+def decisions(distances, usns):
+    return [u if d <= DISTANCE_THRESHOLD else None for d, u in zip(distances[:, 0], usns[:, 0])]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--nlist", type=int, default=None)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        vectors, usns, queries = synthetic_gallery(size)
+        ids = np.array([f"id{i}" for i in range(size)], dtype=object)
+        exact = BruteForceIndex()
+        exact.build(ids, usns, vectors)
+        t = time.perf_counter()
+        exact_dist, exact_usns, exact_ids = exact.search(queries, k=1)
+        exact_ms = (time.perf_counter() - t) * 1000 / len(queries)
+
+        t = time.perf_counter()
+        ivf = IVFIndex(nlist=args.nlist)
+        ivf.build(ids, usns, vectors)
+        build_s = time.perf_counter() - t
+        with tempfile.TemporaryDirectory() as path:
+            ivf.save(path)
+            t = time.perf_counter()
+            ivf = IVFIndex.load(path)
+            load_ms = (time.perf_counter() - t) * 1000
+
+            print(f"\nsize={size} nlist={len(ivf.centroids)} build={build_s:.1f}s mmap-load={load_ms:.1f}ms exact={exact_ms:.2f}ms/query")
+            print(f"{'nprobe':>7} {'ms/query':>9} {'recall@1':>9} {'decision agreement':>19}")
+            for nprobe in args.nprobe:
+                t = time.perf_counter()
+                dist, found_usns, found_ids = ivf.search(queries, k=1, nprobe=nprobe)
+                ms = (time.perf_counter() - t) * 1000 / len(queries)
+                recall = float(np.mean(found_ids[:, 0] == exact_ids[:, 0]))
+                agree = float(np.mean([a == b for a, b in zip(decisions(dist, found_usns), decisions(exact_dist, exact_usns))]))
+                print(f"{nprobe:>7} {ms:>9.2f} {recall:>9.3f} {agree:>19.3f}")
+
+
+if __name__ == "__main__":
+    main()
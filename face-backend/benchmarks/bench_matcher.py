@@ -0,0 +1,75 @@
+#3.Music/face-backend/benchmarks/bench_matcher.py
+# Micro-benchmark: per-request sklearn KNN (fit + kneighbors + predict, the old /recognize path)
+# versus matcher.Matcher over the same pre-normalized float32 gallery.
+#
+#   python benchmarks/bench_matcher.py --sizes 1000 10000 100000 --queries 50
+import argparse
+import os
+import sys
+import time
+import numpy as np
+from sklearn.neighbors import KNeighborsClassifier
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from matcher import Matcher, normalize_rows  # noqa: E402
+
+
+def synthetic_gallery(size, dim=512, samples_per_student=5, seed=0):
+    rng = np.random.default_rng(seed)
+    students = max(1, size // samples_per_student)
+    centers = rng.standard_normal((students, dim)).astype(np.float32)
+    labels = np.arange(size) % students
+    vectors = centers[labels] + 0.3 * rng.standard_normal((size, dim)).astype(np.float32)
+    usns = np.array([f"USN{label:06d}" for label in labels], dtype=object)
+    queries = centers[rng.integers(0, students, 64)] + 0.3 * rng.standard_normal((64, dim)).astype(np.float32)
+    return normalize_rows(vectors), usns, queries
+
+
+def bench(fn, queries, repeat):
+    times = []
+    for _ in range(repeat):
+        for q in queries:
+            t = time.perf_counter()
+            fn(q)
+            times.append(time.perf_counter() - t)
+    return np.median(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{'size':>8} {'sklearn ms':>12} {'matcher ms':>12} {'batch ms/q':>12} {'speedup':>8} {'agree':>6}")
+    for size in args.sizes:
+        vectors, usns, queries = synthetic_gallery(size)
+        queries = queries[:args.queries]
+
+        def sklearn_path(q):
+            knn = KNeighborsClassifier(n_neighbors=1, metric='cosine')
+            knn.fit(vectors, usns)
+            dist, _ = knn.kneighbors([q], n_neighbors=1, return_distance=True)
+            return knn.predict([q])[0], float(dist[0][0])
+
+        matcher = Matcher(vectors, usns)
+
+        def matcher_path(q):
+            m = matcher.match([q])[0]
+            return m["usn"], m["distance"]
+
+        agree = all(
+            a[0] == b[0] and abs(a[1] - b[1]) < 1e-4
+            for a, b in (([*sklearn_path(q)], [*matcher_path(q)]) for q in queries)
+        )
+        sk_ms = bench(sklearn_path, queries, args.repeat)
+        m_ms = bench(matcher_path, queries, args.repeat)
+        t = time.perf_counter()
+        matcher.match(queries)
+        batch_ms = (time.perf_counter() - t) * 1000 / len(queries)
+        print(f"{size:>8} {sk_ms:>12.2f} {m_ms:>12.2f} {batch_ms:>12.2f} {sk_ms / m_ms:>7.1f}x {str(agree):>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+#3.Music/face-backend/benchmarks/bench_pipeline.py
+# Offline end-to-end benchmark of /recognize and /register.
+# The real FastAPI app (main.py, lifespan included) runs in-process behind httpx's ASGI transport.
+# Supabase is replaced by benchmarks/fake_supabase.py, with optional simulated round-trip
+# latency, and the gallery is seeded with synthetic embeddings at each size.
+#
+#   --embedder stub      no TensorFlow: the whole frame is the face, and embeddings of the
+#                        benchmark's frames are known vectors near seeded students, so the
+#                        match, DB and I/O layers run exactly as in production
+#   --embedder deepface  the real ModelManager; --images points at fixture photos
+#                        (default: a synthetic face)
+#   --client-box         mark each frame as a face crop (face_cropped), i.e. the /recognize path that
+#                        skips server-side detection
+#
+# For each gallery size it reports req/s and p50/p95/p99 latency per endpoint, and the mean
+# time per pipeline stage (face_stage_seconds, see metrics.py). --save-baseline writes the
+# numbers; --baseline compares a run against them and exits 1 when an endpoint's p95 or a
+# stage's mean regresses by more than --tolerance. Any HTTP 503 (a saturated worker pool)
+# fails the run as well. Each registration uploads --images-per-registration photos (default 5).
+#
+#   python benchmarks/bench_pipeline.py --sizes 100 1000 10000 100000 --save-baseline baseline.json
+#   python benchmarks/bench_pipeline.py --baseline baseline.json --tolerance 0.25
+import os
+import tempfile
+
+_workdir = tempfile.mkdtemp(prefix="bench-pipeline-")
+os.environ.setdefault("JOB_QUEUE_PATH", os.path.join(_workdir, "jobs.sqlite3"))
+os.environ.setdefault("ATTENDANCE_JOURNAL_PATH", os.path.join(_workdir, "attendance.sqlite3"))
+os.environ.setdefault("ANN_INDEX_PATH", os.path.join(_workdir, "ann_index"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import argparse  # noqa: E402
+import asyncio  # noqa: E402
+import hashlib  # noqa: E402
+import json  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+import uuid  # noqa: E402
+import cv2  # noqa: E402
+import httpx  # noqa: E402
+import numpy as np  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from fake_supabase import FakeSupabase  # noqa: E402
+from bench_matcher import synthetic_gallery  # noqa: E402
+from imaging import decode_image, encode_jpeg, face_from_box  # noqa: E402
+from metrics import STAGE_SECONDS, timed  # noqa: E402
+from models import RECOGNIZE_DETECTOR, synthetic_face_image  # noqa: E402
+
+CLASS_NAME = "BENCH"
+SUBJECT = "BENCH-SUB"
+STAGE_FLOOR_MS = 0.5  # stages faster than this are too noisy to gate on
+
+
+def frame_key(img):
+    return hashlib.blake2b(np.ascontiguousarray(img).tobytes(), digest_size=16).digest()
+
+
+class StubModelManager:
+    """models.ModelManager without TensorFlow: every frame is one face covering the whole image.
+
+    Frames registered with `know()` embed to the given vector; any other frame gets a random
+    vector seeded by its pixels, so repeated frames always embed identically.
+    """
+
+    state = "ready"
+    ready = True
+
+    def __init__(self):
+        self.known = {}
+
+    def know(self, img, embedding):
+        self.known[frame_key(img)] = np.asarray(embedding, dtype=np.float32)
+
+    def _embedding(self, img):
+        key = frame_key(img)
+        if key not in self.known:
+            return np.random.default_rng(int.from_bytes(key[:8], "little")).standard_normal(512).astype(np.float32)
+        return self.known[key]
+
+    def load(self):
+        return True
+
+    def load_in_background(self):
+        return None
+
+    def status(self):
+        return {"state": self.state, "ready": True, "model": "stub"}
+
+    @timed("detect_embed")
+    def represent(self, img, detector_backend=RECOGNIZE_DETECTOR, enforce_detection=True):
+        h, w = img.shape[:2]
+        return [{"embedding": self._embedding(img).tolist(), "facial_area": {"x": 0, "y": 0, "w": w, "h": h}, "face_confidence": 1.0}]
+
+    @timed("detect")
+    def detect_faces(self, img, detector_backend=RECOGNIZE_DETECTOR, enforce_detection=False):
+        h, w = img.shape[:2]
+        return [{"face": img[:, :, ::-1].astype(np.float32) / 255, "facial_area": {"x": 0, "y": 0, "w": w, "h": h}, "confidence": 1.0}]
+
+    @timed("embed")
+    def embed_faces(self, faces):
+        return np.stack([self._embedding(face) for face in faces]) if len(faces) else np.empty((0, 512), np.float32)
+
+
+def load_backend(fake):
+    """Import main.py with the fake client in place of supabase.create_client."""
+    import supabase
+    supabase.create_client = lambda url, key: fake
+    import main
+    return main
+
+
+def seed(main, fake, size):
+    """Fill the fake face_embeddings/students tables with a synthetic gallery; returns the query vectors."""
+    vectors, usns, queries = synthetic_gallery(size)
+    fake.reset()
+    student_ids = {usn: str(uuid.uuid4()) for usn in dict.fromkeys(usns)}
+    fake.tables["students"] = [{"id": sid, "usn": usn, "name": usn, "class": CLASS_NAME, "subjects": [SUBJECT], "image_urls": []}
+                               for usn, sid in student_ids.items()]
+    rows = []
+    for i, (vector, usn) in enumerate(zip(vectors, usns)):
+        row = {"id": f"{i:08d}", "usn": usn, "embedding": vector, "sharpness": 150.0, "source": "register",
+               "model": "Facenet512", "image_url": f"https://fake.supabase.local/storage/v1/object/public/student-images/students/{usn}/{i}.jpg"}
+        if main.QUANTIZED_STORAGE:
+            row["embedding_q"] = main.encode_embedding(vector)
+        rows.append(row)
+    fake.tables["face_embeddings"] = rows
+    fake.tables["attendance"] = []
+    return queries
+
+
+def recognize_frames(args, embedder, queries):
+    """JPEG frames for /recognize; with the stub embedder each one embeds to a query vector."""
+    if args.embedder == "deepface":
+        return fixture_images(args)
+    frames = []
+    rng = np.random.default_rng(1)
+    for query in queries[:args.frames]:
+        data = encode_jpeg((rng.random((240, 320, 3)) * 255).astype(np.uint8))
+        img = decode_image(data)
+        embedder.know(img, query)
+        embedder.know(face_from_box(img, {"x": 0, "y": 0, "w": 320, "h": 240}), query)
+        frames.append(data)
+    return frames
+
+
+def fixture_images(args):
+    if args.images:
+        paths = sorted(os.path.join(args.images, f) for f in os.listdir(args.images)
+                       if f.lower().endswith((".jpg", ".jpeg", ".png")))
+        return [open(p, "rb").read() for p in paths]
+    return [encode_jpeg(cv2.resize(synthetic_face_image(), (400, 400)))]
+
+
+def register_images(args):
+    if args.embedder == "deepface":
+        return fixture_images(args)
+    rng = np.random.default_rng(2)
+    return [encode_jpeg((rng.random((400, 400, 3)) * 255).astype(np.uint8)) for _ in range(max(4, args.images_per_registration))]
+
+
+async def drive(client, count, concurrency, request):
+    """Run `count` requests, `concurrency` at a time; returns (latencies ms, statuses, elapsed s)."""
+    latencies, statuses = [], {}
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index
+        while next_index < count:
+            i = next_index
+            next_index += 1
+            t = time.perf_counter()
+            response = await request(i)
+            ms = (time.perf_counter() - t) * 1000
+            status = response.json().get("status") if response.status_code == 200 else f"http-{response.status_code}"
+            statuses[status] = statuses.get(status, 0) + 1
+            if response.status_code == 200:
+                latencies.append(ms)
+
+    t = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, statuses, time.perf_counter() - t
+
+
+def summarize(latencies, statuses, elapsed):
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if latencies else (0.0, 0.0, 0.0)
+    return {"rps": len(latencies) / elapsed if elapsed else 0.0, "p50": float(p50), "p95": float(p95),
+            "p99": float(p99), "ok": len(latencies), "statuses": statuses}
+
+
+async def bench_size(main, fake, embedder, client, args, size):
+    queries = seed(main, fake, size)
+    t = time.perf_counter()
+    main.reload_gallery()
+    load_s = time.perf_counter() - t
+    main.recognition_cache.cache.clear()
+    STAGE_SECONDS.reset()
+    session_id = f"bench-{size}-{uuid.uuid4().hex[:8]}"
+    frames = recognize_frames(args, embedder, queries)
+    results = {"gallery_load_s": load_s}
+
+    def recognize(i):
+        form = {"session_id": session_id, "class_name": CLASS_NAME, "subject": SUBJECT, "teacher_id": "bench", "mode": "check-in"}
+        if args.client_box:
+            form["face_cropped"] = "true"
+        return client.post("/recognize", data=form, files={"file": ("frame.jpg", frames[i % len(frames)], "image/jpeg")})
+
+    results["recognize"] = summarize(*await drive(client, args.requests, args.concurrency, recognize))
+
+    images = register_images(args)
+
+    def register(i):
+        form = {"usn": f"BENCHREG{size}-{i:05d}", "name": "Bench", "class_": CLASS_NAME, "subjects": [SUBJECT]}
+        n = args.images_per_registration
+        files = [("files", (f"{i}-{j}.jpg", images[(i * n + j) % len(images)], "image/jpeg")) for j in range(n)]
+        return client.post("/register", data=form, files=files)
+
+    results["register"] = summarize(*await drive(client, args.registrations, args.concurrency, register))
+    results["stages"] = {key[0]: mean * 1000 for key, mean in STAGE_SECONDS.mean().items()}
+    return results
+
+
+def report(size, results):
+    print(f"\n== gallery size {size} (load {results['gallery_load_s']:.2f}s) ==")
+    print(f"{'endpoint':>10} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  statuses")
+    for endpoint in ("recognize", "register"):
+        r = results[endpoint]
+        print(f"{endpoint:>10} {r['rps']:>8.1f} {r['p50']:>8.1f} {r['p95']:>8.1f} {r['p99']:>8.1f}  {r['statuses']}")
+    print("stage means (ms): " + ", ".join(f"{k}={v:.2f}" for k, v in sorted(results["stages"].items(), key=lambda kv: -kv[1])))
+
+
+def saturations(run):
+    """Endpoints that answered 503 in `run`; the benchmark's load must never saturate the pools."""
+    return [f"size {size} {endpoint}: {results[endpoint]['statuses']['http-503']} x HTTP 503"
+            for size, results in run.items() for endpoint in ("recognize", "register")
+            if results[endpoint]["statuses"].get("http-503")]
+
+
+def regressions(run, baseline, tolerance):
+    found = []
+    for size, results in run.items():
+        base = baseline.get(size)
+        if not base:
+            continue
+        for endpoint in ("recognize", "register"):
+            now, then = results[endpoint]["p95"], base.get(endpoint, {}).get("p95")
+            if then and now > then * (1 + tolerance):
+                found.append(f"size {size} {endpoint} p95 {now:.1f} ms > baseline {then:.1f} ms")
+        for name, now in results["stages"].items():
+            then = base.get("stages", {}).get(name)
+            if then and now > STAGE_FLOOR_MS and now > then * (1 + tolerance):
+                found.append(f"size {size} stage {name} {now:.2f} ms > baseline {then:.2f} ms")
+    return found
+
+
+async def run(args):
+    fake = FakeSupabase(latency=args.db_latency_ms / 1000)
+    main = load_backend(fake)
+    embedder = StubModelManager() if args.embedder == "stub" else main.model_manager
+    main.model_manager = embedder
+    if args.embedder == "deepface":
+        embedder.load()
+    fake.tables["face_embeddings"], fake.tables["students"] = [], []
+    results = {}
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300.0) as client:
+            for size in args.sizes:
+                results[str(size)] = await bench_size(main, fake, embedder, client, args, size)
+                report(size, results[str(size)])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--embedder", choices=("stub", "deepface"), default="stub")
+    parser.add_argument("--images", default=None, help="fixture photos for --embedder deepface")
+    parser.add_argument("--requests", type=int, default=200, help="/recognize requests per size")
+    parser.add_argument("--registrations", type=int, default=20, help="/register requests per size")
+    parser.add_argument("--images-per-registration", type=int, default=5, help="photos uploaded by each /register request")
+    parser.add_argument("--concurrency", type=int, default=2)
+    parser.add_argument("--client-box", action="store_true", help="skip server-side detection on /recognize")
+    parser.add_argument("--frames", type=int, default=32, help="distinct /recognize frames (stub embedder)")
+    parser.add_argument("--db-latency-ms", type=float, default=0.0, help="simulated Supabase round trip")
+    parser.add_argument("--save-baseline", default=None)
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    saturated = saturations(results)
+    if saturated:
+        print("\nSATURATED:\n  " + "\n  ".join(saturated))
+        sys.exit(1)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"\nBaseline written to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        if found:
+            print("\nREGRESSIONS:\n  " + "\n  ".join(found))
+            sys.exit(1)
+        print(f"\nNo regressions beyond {args.tolerance:.0%} of {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#3.Music/face-backend/benchmarks/bench_quantized.py
+# Compact embedding storage versus the JSON/float32 path (see quantize.py).
+# For each gallery size it compares:
+#   wire      bytes per row of the face_embeddings page payload (JSON floats vs embedding_q hex)
+#   load      json.loads of the payload + EmbeddingGallery.load, and peak memory during it
+#   memory    resident gallery vectors plus the matcher's scan matrix
+#   query     batched match() latency per query
+#   accuracy  /recognize decision agreement (USN or no-match) and max |distance| error vs float32
+#
+#   python benchmarks/bench_quantized.py --sizes 10000 100000
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from gallery import EmbeddingGallery  # noqa: E402
+from matcher import DISTANCE_THRESHOLD  # noqa: E402
+from quantize import encode_embedding  # noqa: E402
+from bench_matcher import synthetic_gallery  # noqa: E402
+
+
+def payload(vectors, usns, column):
+    rows = []
+    for i, (vector, usn) in enumerate(zip(vectors, usns)):
+        value = [float(v) for v in vector] if column == "embedding" else encode_embedding(vector)
+        rows.append({"id": f"{i:08d}", "usn": usn, column: value})
+    return json.dumps(rows)
+
+
+def load(body, quantization):
+    """(gallery, matcher, seconds, peak bytes); peak is measured on a second, untimed load
+    because tracemalloc slows down the allocation-heavy JSON path."""
+    gallery = EmbeddingGallery(quantization=quantization, template_candidates=0)  # measure the full scan
+    t = time.perf_counter()
+    gallery.load(json.loads(body))
+    matcher = gallery.matcher()
+    seconds = time.perf_counter() - t
+    tracemalloc.start()
+    EmbeddingGallery(quantization=quantization, template_candidates=0).load(json.loads(body))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return gallery, matcher, seconds, peak
+
+
+def decision(result):
+    return result["usn"] if result["distance"] <= DISTANCE_THRESHOLD else None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--queries", type=int, default=64)
+    args = parser.parse_args()
+
+    print(f"{'size':>8} {'mode':>8} {'B/row':>7} {'load s':>7} {'peak MB':>8} {'resident MB':>12} "
+          f"{'ms/query':>9} {'agree':>6} {'max err':>8}")
+    for size in args.sizes:
+        vectors, usns, queries = synthetic_gallery(size)
+        queries = queries[:args.queries]
+        bodies = {"embedding": payload(vectors, usns, "embedding"), "embedding_q": payload(vectors, usns, "embedding_q")}
+        reference = None
+        for mode, column, quantization in (("float32", "embedding", None), ("float16", "embedding_q", "float16"),
+                                           ("int8", "embedding_q", "int8")):
+            gallery, matcher, seconds, peak = load(bodies[column], quantization)
+            resident = gallery.vectors.nbytes + (matcher.quantized.nbytes if matcher.quantized is not None
+                                                 and not np.shares_memory(matcher.quantized.codes, gallery.vectors) else 0)
+            matcher.match(queries[:1])
+            t = time.perf_counter()
+            results = matcher.match(queries)
+            ms = (time.perf_counter() - t) * 1000 / len(queries)
+            if reference is None:
+                reference = results
+            agree = np.mean([decision(a) == decision(b) for a, b in zip(reference, results)])
+            error = max(abs(a["distance"] - b["distance"]) for a, b in zip(reference, results))
+            print(f"{size:>8} {mode:>8} {len(bodies[column]) / size:>7.0f} {seconds:>7.2f} {peak / 2**20:>8.1f} "
+                  f"{resident / 2**20:>12.1f} {ms:>9.2f} {agree:>6.3f} {error:>8.1e}")
+
+
+if __name__ == "__main__":
+    main()
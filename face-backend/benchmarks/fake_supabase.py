@@ -0,0 +1,185 @@
+#3.Music/face-backend/benchmarks/fake_supabase.py
+# In-process stand-in for the supabase-py client, so the backend can be benchmarked without a
+# network or a Supabase project. It covers only the query-builder calls this backend makes:
+# select/insert/upsert/update/delete, the eq/in_/gt/lt/is_/not_ filters, order/range/limit, and
+# storage upload/get_public_url/remove. `latency` adds a fixed delay to every call, standing in
+# for the network round trip.
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+
+class FakeQuery:
+    def __init__(self, client, table):
+        self.client = client
+        self.table = table
+        self.action = "select"
+        self.columns = None
+        self.payload = None
+        self.on_conflict = None
+        self.filters = []
+        self.order_by = None
+        self.window = None
+        self._negate = False
+
+    # Actions
+    def select(self, columns="*"):
+        self.action, self.columns = "select", [c.strip() for c in columns.split(",")]
+        return self
+
+    def insert(self, rows):
+        self.action, self.payload = "insert", rows
+        return self
+
+    def upsert(self, rows, on_conflict=None):
+        self.action, self.payload, self.on_conflict = "upsert", rows, on_conflict
+        return self
+
+    def update(self, values):
+        self.action, self.payload = "update", values
+        return self
+
+    def delete(self):
+        self.action = "delete"
+        return self
+
+    # Filters
+    def _filter(self, fn):
+        negate, self._negate = self._negate, False
+        self.filters.append((lambda row: not fn(row)) if negate else fn)
+        return self
+
+    @property
+    def not_(self):
+        self._negate = True
+        return self
+
+    def eq(self, column, value):
+        return self._filter(lambda row: row.get(column) == value)
+
+    def in_(self, column, values):
+        values = set(values)
+        return self._filter(lambda row: row.get(column) in values)
+
+    def gt(self, column, value):
+        return self._filter(lambda row: row.get(column) is not None and row[column] > value)
+
+    def lt(self, column, value):
+        return self._filter(lambda row: row.get(column) is not None and row[column] < value)
+
+    def is_(self, column, value):
+        return self._filter(lambda row: row.get(column) is None if value == "null" else row.get(column) == value)
+
+    def order(self, column, desc=False):
+        self.order_by = (column, desc)
+        return self
+
+    def range(self, start, end):
+        self.window = (start, end + 1)
+        return self
+
+    def limit(self, count):
+        self.window = (0, count)
+        return self
+
+    def execute(self):
+        if self.client.latency:
+            time.sleep(self.client.latency)
+        self.client.calls += 1
+        with self.client.lock:
+            rows = self.client.tables.setdefault(self.table, [])
+            data = getattr(self, f"_{self.action}")(rows)
+        return SimpleNamespace(data=data)
+
+    def _matching(self, rows):
+        return [row for row in rows if all(f(row) for f in self.filters)]
+
+    def _select(self, rows):
+        rows = self._matching(rows)
+        if self.order_by:
+            column, desc = self.order_by
+            rows = sorted(rows, key=lambda row: (row.get(column) is None, row.get(column)), reverse=desc)
+        if self.window:
+            rows = rows[self.window[0]:self.window[1]]
+        if self.columns == ["*"]:
+            return [dict(row) for row in rows]
+        return [{c: row.get(c) for c in self.columns} for row in rows]
+
+    def _insert(self, rows):
+        new = [dict(row) for row in (self.payload if isinstance(self.payload, list) else [self.payload])]
+        for row in new:
+            row.setdefault("id", str(uuid.uuid4()))
+        rows.extend(new)
+        return [dict(row) for row in new]
+
+    def _upsert(self, rows):
+        keys = [k.strip() for k in (self.on_conflict or "id").split(",")]
+        index = {tuple(row.get(k) for k in keys): row for row in rows}
+        written = []
+        for row in (self.payload if isinstance(self.payload, list) else [self.payload]):
+            existing = index.get(tuple(row.get(k) for k in keys))
+            if existing is not None:
+                existing.update(row)
+            else:
+                existing = dict(row)
+                existing.setdefault("id", str(uuid.uuid4()))
+                rows.append(existing)
+                index[tuple(existing.get(k) for k in keys)] = existing
+            written.append(dict(existing))
+        return written
+
+    def _update(self, rows):
+        matched = self._matching(rows)
+        for row in matched:
+            row.update(self.payload)
+        return [dict(row) for row in matched]
+
+    def _delete(self, rows):
+        matched = self._matching(rows)
+        doomed = {id(row) for row in matched}
+        rows[:] = [row for row in rows if id(row) not in doomed]
+        return [dict(row) for row in matched]
+
+
+class FakeBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def upload(self, path, data, options=None):
+        if self.client.latency:
+            time.sleep(self.client.latency)
+        with self.client.lock:
+            self.client.objects[(self.name, path)] = bytes(data)
+        return SimpleNamespace(path=path, full_path=f"{self.name}/{path}")
+
+    def get_public_url(self, path):
+        return f"https://fake.supabase.local/storage/v1/object/public/{self.name}/{path}"
+
+    def remove(self, paths):
+        if self.client.latency:
+            time.sleep(self.client.latency)
+        with self.client.lock:
+            for path in paths:
+                self.client.objects.pop((self.name, path), None)
+        return [{"name": path} for path in paths]
+
+
+class FakeSupabase:
+    """tables: {name: [row dicts]}; objects: {(bucket, path): bytes}."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.tables = {}
+        self.objects = {}
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.storage = SimpleNamespace(from_=lambda bucket: FakeBucket(self, bucket))
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+    def reset(self):
+        with self.lock:
+            self.tables, self.objects, self.calls = {}, {}, 0
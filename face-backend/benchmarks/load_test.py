@@ -0,0 +1,109 @@
+#3.Music/face-backend/benchmarks/load_test.py
+# Load test for the bounded worker pools.
+#
+# Offline (no server, no TensorFlow): pushes the per-frame image work (JPEG decode, face crop,
+# Laplacian sharpness, JPEG encode) through workers.WorkerPool at increasing pool sizes and
+# reports frames/s, showing throughput scaling with cores:
+#   python benchmarks/load_test.py offline --frames 400
+#
+# Live: fires concurrent /recognize requests at a running server and reports requests/s,
+# latency percentiles and how many requests were shed with 503:
+#   python benchmarks/load_test.py live --url http://localhost:8000 --image test_images/face1.jpeg --concurrency 1 4 16 64
+import os
+
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
+
+import argparse  # noqa: E402
+import asyncio  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+import cv2  # noqa: E402
+import numpy as np  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from imaging import crop_and_score, decode_image, encode_jpeg  # noqa: E402
+from workers import PoolSaturated, WorkerPool  # noqa: E402
+
+cv2.setNumThreads(1)  # measure our pool's parallelism, not OpenCV's internal threads
+
+
+def frame_work(data):
+    img = decode_image(data)
+    h, w = img.shape[:2]
+    cropped, sharpness = crop_and_score(img, {"x": w // 4, "y": h // 4, "w": w // 2, "h": h // 2})
+    return len(encode_jpeg(cropped)), sharpness
+
+
+async def offline(args):
+    rng = np.random.default_rng(0)
+    frame = encode_jpeg((rng.random((1080, 1920, 3)) * 255).astype(np.uint8), quality=90)
+    sizes = sorted({1, 2, 4, 8, os.cpu_count() or 1})
+    print(f"cpu_count={os.cpu_count()} frames={args.frames}")
+    print(f"{'workers':>8} {'frames/s':>10} {'speedup':>8} {'shed':>6}")
+    baseline = None
+    for workers in sizes:
+        pool = WorkerPool("bench", workers, args.frames)
+
+        async def one():
+            async with pool.admit():
+                return await pool.run(frame_work, frame)
+
+        t = time.perf_counter()
+        results = await asyncio.gather(*(one() for _ in range(args.frames)), return_exceptions=True)
+        rate = args.frames / (time.perf_counter() - t)
+        shed = sum(isinstance(r, PoolSaturated) for r in results)
+        baseline = baseline or rate
+        print(f"{workers:>8} {rate:>10.1f} {rate / baseline:>7.2f}x {shed:>6}")
+        pool.shutdown()
+
+
+async def live(args):
+    import httpx
+    with open(args.image, "rb") as f:
+        image = f.read()
+    print(f"{'clients':>8} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'503s':>6} {'errors':>7}")
+    async with httpx.AsyncClient(base_url=args.url, timeout=60.0) as client:
+        for concurrency in args.concurrency:
+            latencies, shed, errors = [], 0, 0
+            deadline = time.perf_counter() + args.duration
+
+            async def worker():
+                nonlocal shed, errors
+                while time.perf_counter() < deadline:
+                    t = time.perf_counter()
+                    try:
+                        r = await client.post("/recognize", files={"file": ("frame.jpg", image, "image/jpeg")})
+                    except httpx.HTTPError:
+                        errors += 1
+                        continue
+                    if r.status_code == 503:
+                        shed += 1
+                    elif r.status_code != 200:
+                        errors += 1
+                    else:
+                        latencies.append((time.perf_counter() - t) * 1000)
+
+            t = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            elapsed = time.perf_counter() - t
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if latencies else (0, 0, 0)
+            print(f"{concurrency:>8} {len(latencies) / elapsed:>8.1f} {p50:>8.0f} {p95:>8.0f} {p99:>8.0f} {shed:>6} {errors:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="mode", required=True)
+    off = sub.add_parser("offline")
+    off.add_argument("--frames", type=int, default=400)
+    on = sub.add_parser("live")
+    on.add_argument("--url", default=os.getenv("API_URL", "http://localhost:8000"))
+    on.add_argument("--image", required=True)
+    on.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    on.add_argument("--duration", type=float, default=15.0)
+    args = parser.parse_args()
+    asyncio.run(offline(args) if args.mode == "offline" else live(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#3.Music/face-backend/caches.py
+# Short-lived server-side caches for the mobile auto-capture loop, which keeps sending
+# near-identical frames of the same student until the UI state changes.
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from matcher import normalize_rows
+
+RECOGNITION_TTL = 30.0  # seconds
+RECOGNITION_MAXSIZE = 256  # sessions (per mode) held at once
+FACES_PER_SESSION = 256
+SAME_FACE_DISTANCE = 0.2  # cosine distance under which two frames count as the same face
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire `ttl` seconds after being stored."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < now:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def items(self):
+        """Snapshot of the unexpired (key, value) pairs."""
+        now = time.monotonic()
+        with self._lock:
+            return [(key, item[1]) for key, item in self._data.items() if item[0] >= now]
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return item[1] if item else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def status(self):
+        total = self.hits + self.misses
+        return {"size": len(self._data), "maxsize": self.maxsize, "ttl": self.ttl, "hits": self.hits,
+                "misses": self.misses, "hit_rate": round(self.hits / total, 4) if total else None}
+
+
+class FaceTable:
+    """One session/mode's recently recognized faces: an embedding matrix plus each row's outcome and expiry."""
+
+    def __init__(self, dim):
+        self.embeddings = np.empty((0, dim), dtype=np.float32)
+        self.entries = []
+        self.expires = np.empty(0)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def nearest(self, query, now):
+        """The live entry closest to `query` (normalized), if it lies within SAME_FACE_DISTANCE."""
+        if not self.entries:
+            return None
+        distances = 1.0 - self.embeddings @ query
+        distances[self.expires < now] = np.inf
+        best = int(np.argmin(distances))
+        return self.entries[best] if distances[best] <= SAME_FACE_DISTANCE else None
+
+    def add(self, embedding, entry, expires, now, limit):
+        # Drop expired rows, then the oldest ones beyond `limit`
+        keep = np.flatnonzero(self.expires >= now)[-(limit - 1):] if limit > 1 else np.empty(0, dtype=np.intp)
+        self.embeddings = np.vstack([self.embeddings[keep], embedding[None, :]])
+        self.entries = [self.entries[i] for i in keep] + [entry]
+        self.expires = np.append(self.expires[keep], expires)
+
+    def discard(self, predicate):
+        keep = [i for i, entry in enumerate(self.entries) if not predicate(entry)]
+        self.embeddings, self.expires = self.embeddings[keep], self.expires[keep]
+        self.entries = [self.entries[i] for i in keep]
+
+
+class RecognitionCache:
+    """Caches recognition outcomes per (session_id, mode), keyed on the face itself.
+
+    Each session/mode keeps a FaceTable of up to `faces` recent embeddings; a lookup scores the
+    new frame against all of them with one matrix product and hits on the nearest within
+    SAME_FACE_DISTANCE. Near-identical frames therefore always hit, and two different students
+    never share an entry. Entries expire `ttl` seconds after being stored.
+    """
+
+    def __init__(self, maxsize=RECOGNITION_MAXSIZE, ttl=RECOGNITION_TTL, faces=FACES_PER_SESSION, dim=512):
+        self.cache = TTLCache(maxsize, ttl)
+        self.ttl = ttl
+        self.faces = faces
+        self.dim = dim
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, session_id, mode, embedding):
+        if not session_id or not mode:
+            return None
+        table = self.cache.get((session_id, mode))
+        if table is not None:
+            with self._lock:
+                entry = table.nearest(normalize_rows(embedding)[0], time.monotonic())
+            if entry is not None:
+                self.hits += 1
+                return entry
+        self.misses += 1
+        return None
+
+    def store(self, session_id, mode, embedding, **entry):
+        """Remember an outcome (student_uuid, usn, distance, already_marked, ...) for this face."""
+        if not session_id or not mode:
+            return
+        now = time.monotonic()
+        with self._lock:
+            table = self.cache.get((session_id, mode)) or FaceTable(self.dim)
+            table.add(normalize_rows(embedding)[0], entry, now + self.ttl, now, self.faces)
+            self.cache.set((session_id, mode), table)
+
+    def forget(self, session_id, mode, student_ids):
+        """Drop the entries of `student_ids` (students.id) for one session and mode."""
+        table = self.cache.get((session_id, mode))
+        if table is not None:
+            with self._lock:
+                table.discard(lambda entry: entry.get("student_uuid") in student_ids)
+
+    def entries(self):
+        return sum(len(table) for _, table in self.cache.items())
+
+    def status(self):
+        total = self.hits + self.misses
+        return {**self.cache.status(), "faces": self.entries(), "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else None}
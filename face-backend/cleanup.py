@@ -0,0 +1,105 @@
+#3.Music/face-backend/cleanup.py
+# Background removal of blurry gallery samples (face_embeddings rows below a sharpness
+# threshold, plus their stored crops). The table is walked in id order with a keyset cursor, and
+# the sharpness filter runs server-side, so each page only carries rows that will be deleted.
+# Each page costs one storage remove and one `in_` delete, and the in-memory gallery drops the
+# same ids right after, so /recognize never matches against a sample that no longer exists.
+import logging
+import threading
+import time
+from enrolment import BUCKET, storage_path
+
+PAGE_SIZE = 500
+log = logging.getLogger(__name__)
+
+
+class BlurryCleanup:
+    """Runs one cleanup pass at a time on a daemon thread; `status()` reports its progress."""
+
+    def __init__(self, client, gallery, page_size=PAGE_SIZE):
+        self.client = client
+        self.gallery = gallery
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._status = {"state": "idle"}
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, sharpness_threshold):
+        """Start a pass in the background; returns False if one is already running."""
+        with self._lock:
+            if self.running:
+                return False
+            self._stop.clear()
+            self._status = {"state": "running", "sharpness_threshold": sharpness_threshold, "pages": 0, "deleted": 0,
+                            "images_removed": 0, "failed": 0, "cursor": None, "started": time.time(),
+                            "finished": None, "error": None}
+            self._thread = threading.Thread(target=self._run, args=(sharpness_threshold,), name="blurry-cleanup", daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _page(self, sharpness_threshold, cursor):
+        query = (self.client.table("face_embeddings").select("id, usn, image_url")
+                 .lt("sharpness", sharpness_threshold).order("id").limit(self.page_size))
+        if cursor is not None:
+            query = query.gt("id", cursor)
+        return query.execute().data
+
+    def run(self, sharpness_threshold):
+        """One full pass on the calling thread; rows that fail to delete are counted and skipped."""
+        log.info(f"Removing embeddings and images with sharpness below {sharpness_threshold}")
+        cursor = None
+        while not self._stop.is_set():
+            rows = self._page(sharpness_threshold, cursor)
+            if not rows:
+                break
+            cursor = rows[-1]["id"]
+            ids = [row["id"] for row in rows]
+            paths = [storage_path(row["image_url"]) for row in rows if row.get("image_url")]
+            removed = 0
+            if paths:
+                try:
+                    self.client.storage.from_(BUCKET).remove(paths)
+                    removed = len(paths)
+                except Exception as e:
+                    log.error(f"Failed to delete {len(paths)} images: {e}")
+            try:
+                self.client.table("face_embeddings").delete().in_("id", ids).execute()
+                self.gallery.remove(ids)
+                deleted, failed = len(ids), 0
+            except Exception as e:
+                log.error(f"Failed to delete {len(ids)} embeddings: {e}")
+                deleted, failed = 0, len(ids)
+            with self._lock:
+                self._status["pages"] += 1
+                self._status["deleted"] += deleted
+                self._status["images_removed"] += removed
+                self._status["failed"] += failed
+                self._status["cursor"] = cursor
+            log.info(f"Page {self._status['pages']}: deleted {deleted} embeddings, {removed} images")
+            if len(rows) < self.page_size:
+                break
+
+    def _run(self, sharpness_threshold):
+        try:
+            self.run(sharpness_threshold)
+            state, error = ("cancelled" if self._stop.is_set() else "done"), None
+        except Exception as e:
+            log.error(f"Cleanup failed: {e}")
+            state, error = "failed", str(e)
+        with self._lock:
+            self._status.update(state=state, error=error, finished=time.time())
+        log.info(f"Cleanup {state}: {self._status['deleted']} embeddings, {self._status['images_removed']} images removed")
+
+    def status(self):
+        with self._lock:
+            return dict(self._status)
@@ -0,0 +1,39 @@
+import os
+import sys
+import threading
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "benchmarks"))
+# Importing bench_pipeline points the job queue, attendance journal and ANN index at a temp dir
+from bench_pipeline import StubModelManager, load_backend, seed  # noqa: E402
+from fake_supabase import FakeSupabase  # noqa: E402
+
+
+class GatedModelManager(StubModelManager):
+    """Stub embedder that holds each detection until `gate` is set, to keep the server busy."""
+
+    def __init__(self):
+        super().__init__()
+        self.gate = threading.Event()
+        self.gate.set()
+        self.entered = threading.Event()
+
+    def represent(self, img, **kwargs):
+        self.entered.set()
+        assert self.gate.wait(10)
+        return super().represent(img, **kwargs)
+
+
+@pytest.fixture(scope="session")
+def backend():
+    """main.py on a fake Supabase with a seeded gallery, served by one TestClient for the whole run.
+
+    The app's lifespan shuts its worker pools down, so it is entered once rather than per module.
+    """
+    fake = FakeSupabase()
+    main = load_backend(fake)
+    main.model_manager = GatedModelManager()
+    queries = seed(main, fake, 20)
+    with TestClient(main.app) as client:
+        yield main, client, queries
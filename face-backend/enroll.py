@@ -0,0 +1,289 @@
+#3.Music/face-backend/enroll.py
+# Bulk offline enrolment: imports a whole intake without going through /register one student
+# at a time. Uses the same quality gate, detection, sharpness threshold, Facenet512 embedding and
+# storage layout as /register (see enrolment.py).
+#
+#   python enroll.py intake/ students.csv            # intake/<usn>/<images>
+#   python enroll.py intake.zip students.csv --workers 4 --reload-url http://localhost:8000
+#
+# The CSV needs a header with at least usn, name, class; optional columns are subjects
+# (separated by ";"), phone, guardian_email and guardian_phone.
+# Students are sharded over a process pool (one warmed model per process). Finished students are
+# appended to a checkpoint file once their rows are written, and a rerun skips them. Embedding
+# ids and storage paths are derived from <usn>/<filename>, so replaying a half-written batch
+# overwrites rows and objects instead of duplicating them.
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+import uuid
+import zipfile
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from pathlib import PurePosixPath
+from urllib.request import Request, urlopen
+from dotenv import load_dotenv
+from enrolment import SHARPNESS_THRESHOLD, analyse_image, embedding_rows, upload_face_image
+from imaging import encode_jpeg
+from models import MODEL_NAME, ModelManager
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".webp"}
+EMBEDDING_NAMESPACE = uuid.UUID("7d0f4a52-3f4e-4c55-9a55-6c1f2b8e9d10")
+BATCH_SIZE = 500  # rows per bulk insert/upsert
+IO_WORKERS = 16
+
+_model_manager = None
+_archives = {}
+
+
+def list_images(source):
+    """{usn: [member, ...]} for a directory tree or zip laid out as <usn>/<image>."""
+    if zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            members = [PurePosixPath(name) for name in archive.namelist() if not name.endswith("/")]
+    else:
+        members = [PurePosixPath(os.path.relpath(os.path.join(root, name), source).replace(os.sep, "/"))
+                   for root, _, names in os.walk(source) for name in names]
+    images = {}
+    for member in sorted(members):
+        if member.suffix.lower() in IMAGE_EXTENSIONS and member.parent.name and not member.name.startswith("."):
+            images.setdefault(member.parent.name, []).append(str(member))
+    return images
+
+
+def read_image(source, member):
+    if os.path.isdir(source):
+        with open(os.path.join(source, member), "rb") as f:
+            return f.read()
+    if source not in _archives:
+        _archives[source] = zipfile.ZipFile(source)
+    return _archives[source].read(member)
+
+
+def load_students(csv_path):
+    """{usn: students row} from the metadata CSV."""
+    students = {}
+    with open(csv_path, newline="", encoding="utf-8-sig") as f:
+        for record in csv.DictReader(f):
+            record = {k.strip().lower(): (v or "").strip() for k, v in record.items() if k}
+            if not record.get("usn"):
+                continue
+            students[record["usn"]] = {
+                "usn": record["usn"],
+                "name": record.get("name"),
+                "class": record.get("class"),
+                "subjects": [s.strip() for s in record.get("subjects", "").split(";") if s.strip()],
+                "phone_number": record.get("phone") or None,
+                "guardian_email": record.get("guardian_email") or None,
+                "guardian_phone": record.get("guardian_phone") or None,
+            }
+    return students
+
+
+def read_checkpoint(path):
+    done = set()
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    done.add(json.loads(line)["usn"])
+    return done
+
+
+def _init_worker():
+    global _model_manager
+    _model_manager = ModelManager()
+    _model_manager.load()
+
+
+def enrol_student(source, usn, members, sharpness_threshold=SHARPNESS_THRESHOLD):
+    """Runs in a worker process: gate, detect, score and embed one student's images.
+
+    Returns {"usn", "images", "accepted": [{filename, embedding, jpeg, sharpness}], "rejected": [{filename, reason, message}]}.
+    """
+    accepted, rejected = [], []
+    for member in members:
+        filename = PurePosixPath(member).name
+        try:
+            analysis = analyse_image(_model_manager, filename, read_image(source, member), sharpness_threshold)
+        except Exception as e:
+            analysis = {"ok": False, "reason": "error", "message": f"Could not read {member}: {e}"}
+        if not analysis["ok"]:
+            rejected.append({"filename": filename, "reason": analysis["reason"], "message": analysis["message"]})
+            continue
+        accepted.append({"filename": filename, "face": analysis["face"], "cropped": analysis["cropped"],
+                         "sharpness": analysis["sharpness"]})
+    if accepted:
+        embeddings = _model_manager.embed_faces([item.pop("face") for item in accepted])
+        for item, embedding in zip(accepted, embeddings):
+            item["embedding"] = [float(v) for v in embedding]
+            item["jpeg"] = encode_jpeg(item.pop("cropped"))
+    return {"usn": usn, "images": len(members), "accepted": accepted, "rejected": rejected}
+
+
+class BulkWriter:
+    """Buffers students and face_embeddings rows and writes them in bulk, then checkpoints."""
+
+    def __init__(self, client, checkpoint_path, batch_size=BATCH_SIZE, dry_run=False):
+        self.client = client
+        self.checkpoint_path = checkpoint_path
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.students = []
+        self.embeddings = []
+        self.done = []
+
+    def add(self, student_row, rows, record):
+        self.students.append(student_row)
+        self.embeddings.extend(rows)
+        self.done.append(record)
+        if len(self.students) >= self.batch_size or len(self.embeddings) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.done:
+            return
+        if not self.dry_run:
+            # One upsert per column set: a bulk upsert writes NULL into columns missing from a row
+            shapes = {}
+            for row in self.students:
+                shapes.setdefault(tuple(sorted(row)), []).append(row)
+            for rows in shapes.values():
+                for start in range(0, len(rows), self.batch_size):
+                    self.client.table("students").upsert(rows[start:start + self.batch_size], on_conflict="usn").execute()
+            for start in range(0, len(self.embeddings), self.batch_size):
+                self.client.table("face_embeddings").upsert(self.embeddings[start:start + self.batch_size]).execute()
+            # Only once both tables are written; a crash before this replays the batch idempotently
+            with open(self.checkpoint_path, "a") as f:
+                for record in self.done:
+                    f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        print(f"[ENROL] Wrote {len(self.students)} students, {len(self.embeddings)} embeddings")
+        self.students, self.embeddings, self.done = [], [], []
+
+
+def upload_student(client, io_executor, result, dry_run=False):
+    """Upload a student's accepted crops; returns (embedding items, rejections for failed uploads)."""
+    usn = result["usn"]
+    items, rejected = [], []
+
+    def upload(item):
+        name = uuid.uuid5(EMBEDDING_NAMESPACE, f"{usn}/{item['filename']}")
+        if dry_run:
+            return name, f"dry-run://students/{usn}/{usn}_{name}.jpg"
+        return name, upload_face_image(client, usn, item["jpeg"], name=name)[1]
+
+    futures = [io_executor.submit(upload, item) for item in result["accepted"]]
+    for item, future in zip(result["accepted"], futures):
+        try:
+            name, image_url = future.result()
+        except Exception as e:
+            rejected.append({"filename": item["filename"], "reason": "upload-failed", "message": f"Upload failed for {item['filename']}: {e}"})
+            continue
+        if not image_url:
+            rejected.append({"filename": item["filename"], "reason": "upload-failed", "message": f"Failed to get public URL for {item['filename']}"})
+            continue
+        items.append({"id": str(name), "embedding": item["embedding"], "image_url": image_url, "sharpness": item["sharpness"]})
+    return items, rejected
+
+
+def reload_server_gallery(url):
+    request = Request(url.rstrip("/") + "/gallery/reload", data=b"", method="POST")
+    with urlopen(request, timeout=300) as response:
+        return json.loads(response.read())
+
+
+def main(argv=None):
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Bulk-enrol students from <usn>/<images> plus a metadata CSV.")
+    parser.add_argument("source", help="directory or .zip laid out as <usn>/<images>")
+    parser.add_argument("csv", help="student metadata CSV (usn, name, class, subjects, phone, guardian_email, guardian_phone)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="embedding processes")
+    parser.add_argument("--io-workers", type=int, default=IO_WORKERS, help="concurrent storage uploads")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="rows per bulk write")
+    parser.add_argument("--checkpoint", default=None, help="progress file (default: <source>.enrol-checkpoint.jsonl)")
+    parser.add_argument("--sharpness-threshold", type=float, default=SHARPNESS_THRESHOLD)
+    parser.add_argument("--reload-url", default=None, help="backend base URL whose gallery to reload when done")
+    parser.add_argument("--quantized", action="store_true", default=os.getenv("QUANTIZED_STORAGE", "0") == "1",
+                        help="also write embedding_q (see quantize.py); defaults to QUANTIZED_STORAGE")
+    parser.add_argument("--dry-run", action="store_true", help="process images but write nothing to Supabase")
+    parser.add_argument("--verbose", action="store_true", help="print every rejection")
+    args = parser.parse_args(argv)
+
+    checkpoint_path = args.checkpoint or os.path.abspath(args.source).rstrip("/\\") + ".enrol-checkpoint.jsonl"
+    students = load_students(args.csv)
+    images = list_images(args.source)
+    done = read_checkpoint(checkpoint_path)
+    todo = [usn for usn in sorted(images) if usn in students and usn not in done]
+    missing_metadata = sorted(set(images) - set(students))
+    without_images = sorted(set(students) - set(images))
+    print(f"[ENROL] {len(images)} students with images, {len(done)} already done, {len(todo)} to import "
+          f"({sum(len(images[usn]) for usn in todo)} images)")
+    if missing_metadata:
+        print(f"[WARN] {len(missing_metadata)} image folders have no CSV row and are skipped: {missing_metadata[:10]}")
+    if without_images:
+        print(f"[WARN] {len(without_images)} CSV students have no images: {without_images[:10]}")
+
+    client = None
+    if not args.dry_run:
+        from supabase import create_client
+        client = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
+    writer = BulkWriter(client, checkpoint_path, args.batch_size, args.dry_run)
+    stats = Counter()
+    reasons = Counter()
+    started = time.perf_counter()
+    window = 4 * args.workers  # bounded look-ahead so a large intake is not all in memory at once
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker) as executor, \
+            ThreadPoolExecutor(max_workers=args.io_workers) as io_executor:
+        queue = iter(todo)
+        pending = set()
+        while True:
+            for usn in queue:
+                pending.add(executor.submit(enrol_student, args.source, usn, images[usn], args.sharpness_threshold))
+                if len(pending) >= window:
+                    break
+            if not pending:
+                break
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                result = future.result()
+                items, upload_rejections = upload_student(client, io_executor, result, args.dry_run)
+                rejected = result["rejected"] + upload_rejections
+                stats["students"] += 1
+                stats["images"] += result["images"]
+                stats["accepted"] += len(items)
+                reasons.update(r["reason"] for r in rejected)
+                if args.verbose:
+                    for r in rejected:
+                        print(f"[WARN] {result['usn']}: {r['message']}")
+                if not items:
+                    stats["students_without_faces"] += 1
+                # Without a usable image the student's existing image_urls are left alone
+                student_row = dict(students[result["usn"]])
+                if items:
+                    student_row["image_urls"] = [item["image_url"] for item in items]
+                writer.add(student_row, embedding_rows(result["usn"], items, source="bulk-import", model=MODEL_NAME,
+                                                      quantized=args.quantized),
+                           {"usn": result["usn"], "images": result["images"], "saved": len(items),
+                            "rejected": dict(Counter(r["reason"] for r in rejected))})
+                if stats["students"] % 50 == 0:
+                    elapsed = time.perf_counter() - started
+                    print(f"[ENROL] {stats['students']}/{len(todo)} students, {stats['images'] / elapsed:.1f} images/s")
+        writer.flush()
+    elapsed = time.perf_counter() - started
+
+    print(f"[SUMMARY] {stats['students']} students, {stats['images']} images in {elapsed:.1f}s "
+          f"({stats['images'] / elapsed if elapsed else 0:.1f} images/s)")
+    print(f"[SUMMARY] {stats['accepted']} embeddings saved, {sum(reasons.values())} images rejected: {dict(reasons)}")
+    if stats["students_without_faces"]:
+        print(f"[SUMMARY] {stats['students_without_faces']} students have no usable image")
+    if args.reload_url and not args.dry_run and stats["students"]:
+        print(f"[ENROL] Gallery reloaded: {reload_server_gallery(args.reload_url)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
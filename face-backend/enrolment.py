@@ -0,0 +1,83 @@
+#3.Music/face-backend/enrolment.py
+# Enrolment logic shared by the /register endpoint and the bulk importer (enroll.py):
+# per-image quality gate, detection and sharpness scoring, and the storage/DB row helpers.
+import uuid
+from imaging import MIN_FACE_SIZE, crop_and_score, decode_image, quality_gate
+from models import REGISTER_DETECTOR
+from quantize import encode_embedding
+
+SHARPNESS_THRESHOLD = 100  # Raised threshold for stricter filtering
+BUCKET = "student-images"
+
+
+def analyse_image(model_manager, filename, data, sharpness_threshold=SHARPNESS_THRESHOLD):
+    """Quality-gate, detect and score one enrolment image (everything before embedding).
+
+    Returns {"ok": True, "face", "facial_area", "cropped", "sharpness", "prefilter"} for a usable
+    image, else {"ok": False, "reason", "message", ...}. Reasons: too-blurry, face-too-small,
+    no-face, error. Messages are the warnings /register has always returned.
+    """
+    try:
+        gate = quality_gate(data, sharpness_threshold)
+    except Exception as e:
+        return {"ok": False, "reason": "error", "message": f"Embedding or upload failed for {filename}: {e}"}
+    if gate["reason"] == "too-blurry":
+        return {"ok": False, "reason": "too-blurry", "prefilter": gate, "sharpness": gate["sharpness"],
+                "message": f"Image {filename} is too blurry (sharpness={gate['sharpness']:.1f} < threshold={sharpness_threshold}), skipping."}
+    try:
+        img = decode_image(data)
+        faces = model_manager.detect_faces(img, detector_backend=REGISTER_DETECTOR, enforce_detection=True)
+    except Exception as e:
+        return {"ok": False, "reason": "no-face" if isinstance(e, ValueError) else "error", "prefilter": gate,
+                "message": f"Embedding or upload failed for {filename}: {e}"}
+    if not faces:
+        return {"ok": False, "reason": "no-face", "prefilter": gate, "message": f"No face detected in {filename}, skipping."}
+    face_size = max(faces[0]["facial_area"]["w"], faces[0]["facial_area"]["h"])
+    if face_size < MIN_FACE_SIZE:
+        return {"ok": False, "reason": "face-too-small", "prefilter": gate, "facial_area": faces[0]["facial_area"],
+                "message": f"Face in {filename} is too small ({face_size}px < {MIN_FACE_SIZE}px), skipping."}
+    cropped, sharpness = crop_and_score(img, faces[0]["facial_area"])
+    if sharpness < sharpness_threshold:
+        # Do NOT upload or save embedding for blurry images
+        return {"ok": False, "reason": "too-blurry", "prefilter": gate, "sharpness": sharpness,
+                "facial_area": faces[0]["facial_area"],
+                "message": f"Image {filename} is too blurry (sharpness={sharpness:.1f} < threshold={sharpness_threshold}), skipping."}
+    return {"ok": True, "face": faces[0]["face"], "facial_area": faces[0]["facial_area"], "cropped": cropped,
+            "sharpness": sharpness, "prefilter": gate}
+
+
+def upload_face_image(client, usn, jpeg_bytes, name=None):
+    """Upload an encoded face crop to Supabase Storage; returns (upload_result, public_url).
+
+    `name` fixes the object name (the bulk importer derives it from the source file so that a
+    resumed run overwrites instead of orphaning uploads); by default it is random.
+    """
+    file_path = f"students/{usn}/{usn}_{name or uuid.uuid4()}.jpg"
+    bucket = client.storage.from_(BUCKET)
+    upload_result = bucket.upload(file_path, jpeg_bytes, {"upsert": "true", "content-type": "image/jpeg"})
+    return upload_result, bucket.get_public_url(file_path)
+
+
+def storage_path(image_url):
+    """Object path inside the bucket for a public URL returned by upload_face_image."""
+    return image_url.split(f"{BUCKET}/")[-1].split("?")[0]
+
+
+def embedding_rows(usn, items, source="register", model="Facenet512", quantized=False):
+    """face_embeddings rows for `items` (dicts with embedding, image_url, sharpness and optionally id).
+
+    With `quantized` each row also carries embedding_q (see quantize.py).
+    """
+    rows = [{
+        "id": item.get("id") or str(uuid.uuid4()),
+        "usn": usn,
+        "embedding": item["embedding"],
+        "image_url": item["image_url"],
+        "source": source,
+        "model": model,
+        "sharpness": item["sharpness"]
+    } for item in items]
+    if quantized:
+        for row in rows:
+            row["embedding_q"] = encode_embedding(row["embedding"])
+    return rows
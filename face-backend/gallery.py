@@ -0,0 +1,411 @@
+#3.Music/face-backend/gallery.py
+# Process-wide, in-memory copy of the face_embeddings table.
+# Loaded once at startup and kept in sync by the write paths in main.py
+# (register, check-in image replacement, blurry cleanup), so /recognize never
+# has to pull the whole table from Supabase per request. The same mutations keep the
+# per-student templates (templates.py) current, touching only the students they change.
+import logging
+import threading
+import numpy as np
+from ann_index import write_index
+from matcher import DISTANCE_THRESHOLD, TEMPLATE_CANDIDATES, Matcher, match_candidates, normalize_rows
+from templates import ADAPTIVE_THRESHOLD_MAX, StudentTemplates
+from quantize import CODECS, QuantizedMatrix, decode_embeddings
+from metrics import timed
+
+EMBEDDING_DIM = 512  # Facenet512
+ANN_MIN_SIZE = 20000  # below this an exact matrix product is already faster than probing an index
+ANN_CANDIDATES = 16  # samples fetched from the index per query (enough to find a runner-up student)
+COMPACT_RATIO = 0.25  # tombstoned share of the rows at which the buffers are compacted
+log = logging.getLogger(__name__)
+
+
+def normalize_subjects(subjects):
+    """students.subjects as a tuple, or None when it is not a list (the mobile page then ignores it)."""
+    if isinstance(subjects, (list, tuple)):
+        return tuple(str(s).strip() for s in subjects)
+    return None
+
+
+class EmbeddingGallery:
+    """Preallocated matrix of pre-normalized embeddings plus parallel id/usn arrays.
+
+    Rows are appended into spare capacity and removed by tombstoning, so a mutation costs
+    the rows it touches rather than a copy of the whole matrix. A snapshot is either a view of
+    rows that no later append or removal writes to, or a copy; the buffers are reallocated
+    (never rewritten) when they grow or when tombstones pass `COMPACT_RATIO` of the rows.
+    Every mutation bumps `version`, which callers use to invalidate anything derived from
+    the gallery.
+
+    An optional ANN `index` (see ann_index.py) is kept in step with every mutation and used
+    for matching once the gallery reaches `ann_min_size` rows. Building, syncing and saving it
+    happen outside the lock: a rebuild fills a fresh index, replays the mutations made in the
+    meantime and swaps it in, and matching stays exact until then.
+
+    Student metadata (students.class / students.subjects) partitions the gallery: a match
+    scoped to a class (and subject) only searches that class's sub-matrix. Partition
+    matchers are cached until a mutation touches one of their class's students, and the
+    class-level ones are warmed on load.
+
+    With `quantization` ("float16" or "int8", see quantize.py) the rows are kept as float16
+    instead of float32. Matchers that score every sample (no centroid pass, or too few students
+    for one) scan a QuantizedMatrix with an exact re-rank; the others need none.
+
+    `templates` holds each student's sample sum and count, updated by every mutation. Matchers
+    use it for a centroid pass over `template_candidates` students (0 scores every sample) and
+    for per-student thresholds up to `adaptive_max`.
+    """
+
+    def __init__(self, dim=EMBEDDING_DIM, index=None, index_path=None, ann_min_size=ANN_MIN_SIZE, quantization=None,
+                 template_candidates=TEMPLATE_CANDIDATES, adaptive_max=ADAPTIVE_THRESHOLD_MAX):
+        if quantization and quantization not in CODECS:
+            raise ValueError(f"quantization must be one of {CODECS}, got {quantization!r}")
+        self.dim = dim
+        self.quantization = quantization or None
+        self.dtype = np.float16 if self.quantization else np.float32
+        self.index = index
+        self.index_path = index_path
+        self.ann_min_size = ann_min_size
+        self.template_candidates = template_candidates
+        self.adaptive_max = adaptive_max
+        self._lock = threading.Lock()
+        self._index_lock = threading.Lock()  # one index build, sync or save at a time
+        self._index_pending = None  # mutations to replay into an index being rebuilt, else None
+        self._allocate(0)
+        self.templates = StudentTemplates(dim)
+        self.version = 0
+        self.loaded = False
+        self._matcher = None
+        self._matcher_version = -1
+        self.students = {}  # usn -> (class, subjects tuple or None)
+        self.student_ids = {}  # usn -> students.id (UUID), so /recognize needs no lookup query
+        self._partitions = {}  # (class, subject) -> Matcher or None
+        self._epochs = {}  # class -> bumped whenever a cached partition of that class goes stale
+        self._generation = 0  # bumped when every partition goes stale at once
+
+    def _allocate(self, capacity):
+        self._vectors = np.empty((capacity, self.dim), dtype=self.dtype)
+        self._usns = np.empty(capacity, dtype=object)
+        self._ids = np.empty(capacity, dtype=object)
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._size = 0  # rows written, live or tombstoned
+        self._dead = 0
+        self._row_of = {}  # face_embeddings.id -> row
+        self._rows_of_usn = {}  # usn -> rows
+
+    def _write(self, ids, usns, vectors):
+        start = self._size
+        end = start + len(ids)
+        self._vectors[start:end] = vectors
+        self._usns[start:end] = usns
+        self._ids[start:end] = ids
+        self._alive[start:end] = True
+        for row, (row_id, usn) in enumerate(zip(ids, usns), start):
+            self._row_of[row_id] = row
+            self._rows_of_usn.setdefault(usn, []).append(row)
+        self._size = end
+
+    def _reallocate(self, capacity):
+        # Fresh buffers holding only the live rows; views handed out earlier keep the old ones
+        live = np.flatnonzero(self._alive[:self._size])
+        vectors, usns, ids = self._vectors[live], self._usns[live], self._ids[live]
+        self._allocate(capacity)
+        self._write(ids, usns, vectors)
+
+    def _live(self, array):
+        if self._dead:
+            return array[:self._size][self._alive[:self._size]]
+        return array[:self._size]
+
+    @property
+    def vectors(self):
+        with self._lock:
+            return self._live(self._vectors)
+
+    @property
+    def usns(self):
+        with self._lock:
+            return self._live(self._usns)
+
+    @property
+    def ids(self):
+        with self._lock:
+            return self._live(self._ids)
+
+    def __len__(self):
+        return self._size - self._dead
+
+    def snapshot(self):
+        """Return (vectors, usns, ids, version) as one consistent view."""
+        with self._lock:
+            return self._live(self._vectors), self._live(self._usns), self._live(self._ids), self.version
+
+    def _invalidate(self, usns):
+        # Drop the cached partitions of the classes these students belong to (held under the lock)
+        classes = {self.students[u][0] for u in set(usns) if u in self.students}
+        if classes:
+            self._partitions = {key: m for key, m in self._partitions.items() if key[0] not in classes}
+            for cls in classes:
+                self._epochs[cls] = self._epochs.get(cls, 0) + 1
+
+    def load(self, rows):
+        """Replace the whole gallery with `rows` ({"id", "usn"} plus "embedding_q" or "embedding")."""
+        packed = [r for r in rows if r.get("embedding_q")]
+        legacy = [r for r in rows if not r.get("embedding_q") and r.get("embedding") is not None]
+        rows = packed + legacy
+        parts = []
+        if packed:
+            parts.append(decode_embeddings([r["embedding_q"] for r in packed], self.dim))
+        if legacy:
+            vectors = np.empty((len(legacy), self.dim), dtype=np.float32)
+            for i, row in enumerate(legacy):
+                vectors[i] = row["embedding"]
+            parts.append(normalize_rows(vectors))
+        if not parts:
+            vectors = np.empty((0, self.dim), dtype=self.dtype)
+        elif self.quantization:
+            vectors = np.vstack(parts).astype(self.dtype, copy=False)
+        else:
+            vectors = normalize_rows(np.vstack(parts)) if packed else parts[0]
+        usns = np.array([r["usn"] for r in rows], dtype=object)
+        ids = np.array([r["id"] for r in rows], dtype=object)
+        templates = StudentTemplates.build(vectors, usns, self.dim)
+        with self._index_lock:
+            with self._lock:
+                self._allocate(len(rows) + max(64, len(rows) // 4))
+                self._write(ids, usns, vectors)
+                self.templates = templates
+                self._partitions = {}
+                self._generation += 1
+                self.version += 1
+                self.loaded = True
+                version = self.version
+                if self.index is not None:
+                    # Until the new index is swapped in, mutations are also recorded for it
+                    rebuild = self.index.needs_retrain()
+                    self._index_pending = [] if rebuild else None
+                    current = None if rebuild else set(self.index.row_ids())
+            log.info(f"Loaded {len(rows)} embeddings (version {version})")
+            if self.index is not None:
+                self._refresh_index(ids, usns, vectors, current)
+        return version
+
+    def _refresh_index(self, ids, usns, vectors, current):
+        """Rebuild (`current` None) or sync the index against freshly loaded rows, outside the lock."""
+        if current is None:
+            index = self.index.fresh()
+            index.build(ids, usns, vectors)
+            with self._lock:
+                for op, args in self._index_pending:
+                    getattr(index, op)(*args)
+                self.index, self._index_pending = index, None
+            log.info(f"Built {index.kind} index over {len(ids)} embeddings")
+            return
+        stale = current - set(ids.tolist())
+        new = np.fromiter((i not in current for i in ids), dtype=bool, count=len(ids))
+        with self._lock:
+            # Rows added or removed since the load already reached the index directly
+            stale = [i for i in stale if i not in self._row_of]
+            new &= np.fromiter((i in self._row_of for i in ids), dtype=bool, count=len(ids))
+            if stale:
+                self.index.remove(stale)
+            if new.any():
+                self.index.add(ids[new], usns[new], vectors[new])
+        log.info(f"Synced {self.index.kind} index: {len(stale)} removed, {int(new.sum())} added")
+
+    def add(self, row_id, usn, embedding):
+        return self.add_many([row_id], [usn], [embedding])
+
+    def add_many(self, row_ids, usns, embeddings):
+        vectors = normalize_rows(np.asarray(embeddings, dtype=np.float32)).astype(self.dtype, copy=False)
+        row_ids, usns = list(row_ids), list(usns)
+        with self._lock:
+            if self._size + len(row_ids) > len(self._alive):
+                self._reallocate(max(64, 2 * (len(self) + len(row_ids))))
+            self._write(row_ids, usns, vectors)
+            self.templates.add(usns, vectors)
+            self._invalidate(usns)
+            self.version += 1
+            if self.index is not None:
+                self.index.add(row_ids, usns, vectors)
+                if self._index_pending is not None:
+                    self._index_pending.append(("add", (row_ids, usns, vectors)))
+            return self.version
+
+    def remove(self, row_ids):
+        """Drop rows by face_embeddings.id; unknown ids are ignored. Returns the number removed."""
+        row_ids = list(dict.fromkeys(row_ids))
+        with self._lock:
+            rows = np.array([r for r in (self._row_of.pop(i, None) for i in row_ids) if r is not None], dtype=np.intp)
+            if not len(rows):
+                return 0
+            usns = self._usns[rows]
+            self.templates.remove(usns, self._vectors[rows])
+            self._alive[rows] = False
+            self._dead += len(rows)
+            for row, usn in zip(rows.tolist(), usns):
+                remaining = self._rows_of_usn[usn]
+                remaining.remove(row)
+                if not remaining:
+                    del self._rows_of_usn[usn]
+            self._invalidate(usns)
+            if self._dead > COMPACT_RATIO * self._size:
+                self._reallocate(max(64, 2 * len(self)))
+            self.version += 1
+            if self.index is not None:
+                self.index.remove(row_ids)
+                if self._index_pending is not None:
+                    self._index_pending.append(("remove", (row_ids,)))
+            return len(rows)
+
+    def set_students(self, rows):
+        """Replace student metadata with `rows` ({"id", "usn", "class", "subjects"} dicts)."""
+        students = {r["usn"]: (r.get("class"), normalize_subjects(r.get("subjects"))) for r in rows if r.get("usn")}
+        student_ids = {r["usn"]: r["id"] for r in rows if r.get("usn") and r.get("id")}
+        with self._lock:
+            self.students = students
+            self.student_ids = student_ids
+            self._partitions = {}
+            self._generation += 1
+            self.version += 1
+        self.warm_partitions()
+
+    def upsert_student(self, usn, class_name, subjects, student_id=None):
+        with self._lock:
+            self._invalidate([usn])
+            self.students[usn] = (class_name, normalize_subjects(subjects))
+            self._invalidate([usn])
+            if student_id:
+                self.student_ids[usn] = student_id
+            self.version += 1
+
+    def student_id(self, usn):
+        return self.student_ids.get(usn)
+
+    def set_student_id(self, usn, student_id):
+        # Not a partition change, so the version (and every cached matcher) stays valid
+        self.student_ids[usn] = student_id
+
+    def partition(self, class_name, subject=None):
+        """Matcher over the students of `class_name` (taking `subject`, when given), or None if empty.
+
+        Mirrors the mobile page's filter: a student whose subjects is not a list stays in
+        every subject partition of their class.
+        """
+        key = (class_name, subject)
+        with self._lock:
+            if key in self._partitions:
+                return self._partitions[key]
+            stamp = (self._generation, self._epochs.get(class_name, 0))
+            members = [
+                usn for usn, (cls, subjects) in self.students.items()
+                if cls == class_name and (subject is None or subjects is None or subject in subjects)
+                and usn in self._rows_of_usn
+            ]
+            rows = np.sort(np.fromiter((r for usn in members for r in self._rows_of_usn[usn]), dtype=np.intp))
+            vectors, usns = self._vectors[rows], self._usns[rows]
+            templates = self.templates.subset(members)
+        matcher = self._build_matcher(vectors, usns, templates) if len(rows) else None
+        with self._lock:
+            if stamp == (self._generation, self._epochs.get(class_name, 0)):
+                self._partitions[key] = matcher
+        return matcher
+
+    def warm_partitions(self):
+        classes = {cls for cls, _ in self.students.values() if cls}
+        for class_name in classes:
+            self.partition(class_name)
+        return len(classes)
+
+    def matcher(self):
+        """Matcher over the current gallery, rebuilt only when the version changes."""
+        with self._lock:
+            if not len(self):
+                return None
+            matcher, version = self._matcher, self.version
+            if matcher is not None and self._matcher_version == version:
+                return matcher
+            vectors, usns = self._live(self._vectors), self._live(self._usns)
+            templates = self.templates.subset(self._rows_of_usn)
+        matcher = self._build_matcher(vectors, usns, templates)
+        self._matcher, self._matcher_version = matcher, version
+        return matcher
+
+    def _build_matcher(self, vectors, usns, templates):
+        matcher = Matcher(vectors, usns, templates=templates, candidates=self.template_candidates,
+                          adaptive_max=self.adaptive_max)
+        # The centroid pass scores its few candidates straight from the float16 rows, so the
+        # compressed scan is only worth building for matchers that score every sample
+        if self.quantization and not matcher.candidates:
+            matcher.quantized = QuantizedMatrix(matcher.vectors, self.quantization)
+        return matcher
+
+    @timed("match")
+    def match(self, queries, aggregate="best", samples=2, threshold=DISTANCE_THRESHOLD,
+              class_name=None, subject=None, fallback_global=False):
+        """Match a batch of query embeddings; returns one result dict (or None) per query.
+
+        With `class_name` only that class/subject partition is searched; `fallback_global`
+        retries queries that found no match there against the whole gallery. Each result
+        carries "scope" ("class" or "global"). Global searches use the ANN index when one is
+        configured and the gallery is large enough (best-of-N only), otherwise the exact Matcher.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        if class_name:
+            matcher = self.partition(class_name, subject)
+            results = matcher.match(queries, aggregate=aggregate, samples=samples, threshold=threshold) if matcher else [None] * len(queries)
+            for result in results:
+                if result is not None:
+                    result["scope"] = "class"
+            retry = [i for i, r in enumerate(results) if r is None or not r["matched"]] if fallback_global else []
+            if retry:
+                fallback = self._match_global(queries[retry], aggregate, samples, threshold)
+                for i, result in zip(retry, fallback):
+                    if result is not None and (results[i] is None or result["matched"]):
+                        result["scope"] = "global"
+                        results[i] = result
+            return results
+        results = self._match_global(queries, aggregate, samples, threshold)
+        for result in results:
+            if result is not None:
+                result["scope"] = "global"
+        return results
+
+    def _match_global(self, queries, aggregate, samples, threshold):
+        if self.index is not None and self._index_pending is None and len(self) >= self.ann_min_size:
+            with self._lock:
+                distances, usns, _ = self.index.search(queries, k=ANN_CANDIDATES)
+                templates = self.templates.subset({u for row in usns for u in row if u is not None})
+            return match_candidates(distances, usns, threshold, templates, self.adaptive_max)
+        matcher = self.matcher()
+        if matcher is None:
+            return [None] * len(queries)
+        return matcher.match(queries, aggregate=aggregate, samples=samples, threshold=threshold)
+
+    def save_index(self):
+        if self.index is None or not self.index_path:
+            return False
+        with self._index_lock:
+            with self._lock:
+                try:
+                    index, exported = self.index, self.index.export()
+                except NotImplementedError:
+                    return False
+            write_index(self.index_path, *exported)
+        log.info(f"Saved {index.kind} index to {self.index_path}")
+        return True
+
+    def status(self):
+        with self._lock:
+            return {
+                "loaded": self.loaded,
+                "version": self.version,
+                "size": len(self),
+                "students": len(self._rows_of_usn),
+                "classes": len({cls for cls, _ in self.students.values() if cls}),
+                "index": self.index.kind if self.index is not None else None,
+                "quantization": self.quantization,
+                "vector_bytes": int(self._vectors.nbytes),
+                "templates": {**self.templates.status(), "candidates": self.template_candidates,
+                              "adaptive_max": self.adaptive_max},
+            }
@@ -0,0 +1,147 @@
+#3.Music/face-backend/imaging.py
+# In-memory image pipeline: an upload is decoded once into a BGR NumPy array, that array is
+# fed to DeepFace, cropped and scored for sharpness, and the crop is JPEG-encoded straight
+# into the storage upload. No temp files are involved anywhere on the request path.
+import io
+import json
+import cv2
+import numpy as np
+from PIL import Image
+from metrics import timed
+
+CROP_SIZE = 224
+JPEG_QUALITY = 75  # PIL's default, which produced the crops stored before this pipeline
+PREVIEW_MAX_SIDE = 640
+MIN_FACE_SIZE = 80  # px in the original image; smaller faces make poor enrolment samples
+PREFILTER_MARGIN = 0.5  # the Haar pre-filter only rejects below this fraction of the sharpness threshold
+MIN_BOX_SIZE = 40  # px; smallest client-supplied face box /recognize will embed without detection
+MIN_BOX_VISIBLE = 0.8  # fraction of a client box that must lie inside the frame
+_REDUCED_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+_face_cascade = None
+
+
+class ImageDecodeError(ValueError):
+    pass
+
+
+@timed("decode")
+def decode_image(data):
+    """Decode uploaded bytes into a BGR uint8 array (EXIF orientation applied, like cv2.imread)."""
+    if not data:
+        raise ImageDecodeError("Empty image upload")
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ImageDecodeError("Could not decode image")
+    return img
+
+
+def crop_face(img, facial_area, size=CROP_SIZE):
+    """Crop DeepFace's facial_area ({x, y, w, h}) out of `img` and resize it to size x size.
+
+    Areas reaching past the border are padded with black, as PIL's crop did.
+    """
+    x, y, w, h = (int(facial_area[k]) for k in ("x", "y", "w", "h"))
+    height, width = img.shape[:2]
+    top, left = max(0, -y), max(0, -x)
+    bottom, right = max(0, y + h - height), max(0, x + w - width)
+    face = img[max(0, y):min(height, y + h), max(0, x):min(width, x + w)]
+    if top or left or bottom or right:
+        face = cv2.copyMakeBorder(face, top, bottom, left, right, cv2.BORDER_CONSTANT, value=0)
+    return cv2.resize(face, (size, size), interpolation=cv2.INTER_CUBIC)
+
+
+def calculate_sharpness(img):
+    """Variance of the Laplacian of the grayscale image; low values mean blur."""
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+
+def crop_and_score(img, facial_area, size=CROP_SIZE):
+    """(crop, sharpness) for a detected face, the quality gate used by register and check-in."""
+    cropped = crop_face(img, facial_area, size)
+    return cropped, calculate_sharpness(cropped)
+
+
+def parse_face_box(value, shape, min_size=MIN_BOX_SIZE):
+    """Validate a client-supplied face box against an image of `shape`; returns a facial_area dict.
+
+    `value` is JSON, either {"x", "y", "w", "h"} (or "width"/"height") or [x, y, w, h], in pixels
+    of the uploaded image. Raises ValueError for a malformed box, one smaller than `min_size`, or
+    one mostly outside the frame; the part past the border is clipped off.
+    """
+    try:
+        box = json.loads(value) if isinstance(value, str) else value
+        if isinstance(box, dict):
+            box = [box.get("x"), box.get("y"), box.get("w", box.get("width")), box.get("h", box.get("height"))]
+        x, y, w, h = (float(v) for v in box)
+    except (TypeError, ValueError):
+        raise ValueError(f"Malformed face box: {value!r}")
+    if not np.isfinite([x, y, w, h]).all() or w < min_size or h < min_size:
+        raise ValueError(f"Face box must be at least {min_size}px: {value!r}")
+    height, width = shape[:2]
+    x0, y0, x1, y1 = max(0.0, x), max(0.0, y), min(float(width), x + w), min(float(height), y + h)
+    if x1 <= x0 or y1 <= y0 or (x1 - x0) * (y1 - y0) < MIN_BOX_VISIBLE * w * h:
+        raise ValueError(f"Face box lies outside the {width}x{height} image: {value!r}")
+    return {"x": int(x0), "y": int(y0), "w": int(round(x1 - x0)), "h": int(round(y1 - y0))}
+
+
+def face_from_box(img, facial_area):
+    """The facial_area of a BGR image in the form the detectors return faces: RGB floats in [0, 1]."""
+    x, y, w, h = (facial_area[k] for k in ("x", "y", "w", "h"))
+    return img[y:y + h, x:x + w, ::-1].astype(np.float32) / 255
+
+
+def encode_jpeg(img, quality=JPEG_QUALITY):
+    ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("JPEG encoding failed")
+    return buf.tobytes()
+
+
+def decode_preview(data, max_side=PREVIEW_MAX_SIDE):
+    """Cheap downscaled decode: (BGR array, scale) where scale is 1, 2, 4 or 8.
+
+    Only the header is parsed to pick the scale; libjpeg then decodes at reduced size directly.
+    """
+    try:
+        width, height = Image.open(io.BytesIO(data)).size
+    except Exception as e:
+        raise ImageDecodeError(f"Could not decode image: {e}")
+    scale = 1
+    while scale < 8 and max(width, height) / (scale * 2) >= max_side:
+        scale *= 2
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), _REDUCED_FLAGS[scale])
+    if img is None:
+        raise ImageDecodeError("Could not decode image")
+    return img, scale
+
+
+@timed("quality_gate")
+def quality_gate(data, sharpness_threshold, min_face_size=MIN_FACE_SIZE):
+    """Pre-model check on a downscaled decode with OpenCV's Haar face detector.
+
+    Rejects images whose largest face scores below PREFILTER_MARGIN x `sharpness_threshold`.
+    The Haar box is not the box the full detector will crop, so anything nearer the threshold
+    passes and the exact sharpness check decides. The face size is only reported: Haar's largest
+    detection can be a false positive, so the size check runs on the full detector's box.
+    Faces smaller than `min_face_size` are not searched for at all.
+    Returns {"ok", "reason", "face_size", "sharpness"}.
+    """
+    global _face_cascade
+    preview, scale = decode_preview(data)
+    if _face_cascade is None:
+        _face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+    gray = cv2.cvtColor(preview, cv2.COLOR_BGR2GRAY)
+    min_side = max(20, min_face_size // (2 * scale))
+    faces = _face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(min_side, min_side))
+    result = {"ok": True, "reason": None, "face_size": None, "sharpness": None}
+    if len(faces) == 0:
+        return result
+    x, y, w, h = max(faces, key=lambda f: f[2] * f[3])
+    result["face_size"] = int(max(w, h) * scale)
+    if max(w, h) >= CROP_SIZE:
+        sharpness = calculate_sharpness(crop_face(preview, {"x": x, "y": y, "w": w, "h": h}))
+        result["sharpness"] = sharpness
+        if sharpness < PREFILTER_MARGIN * sharpness_threshold:
+            result.update(ok=False, reason="too-blurry")
+    return result
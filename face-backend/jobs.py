@@ -0,0 +1,159 @@
+#3.Music/face-backend/jobs.py
+# Persistent background job queue for work that does not need to finish before the phone gets
+# its answer (e.g. rotating a student's gallery images after a check-in).
+# Jobs live in a local SQLite file so they survive restarts, are retried with exponential
+# backoff, and are deduplicated: enqueueing a job whose (kind, dedup_key) is already pending
+# replaces that job's payload instead of adding a second one.
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 2.0  # seconds; the n-th retry waits BACKOFF_BASE ** n
+POLL_INTERVAL = 0.5
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    dedup_key TEXT,
+    payload TEXT NOT NULL,
+    blob BLOB,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_run REAL NOT NULL,
+    last_error TEXT,
+    created REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_pending_dedup ON jobs(kind, dedup_key) WHERE state = 'pending' AND dedup_key IS NOT NULL;
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs(state, next_run);
+"""
+
+
+class JobQueue:
+    """SQLite-backed job queue drained by daemon worker threads.
+
+    `handlers` maps a job kind to a callable(payload: dict, blob: bytes | None); a handler
+    that raises is retried up to `max_attempts` times, then the job is kept as 'failed'.
+    """
+
+    def __init__(self, path, handlers=None, workers=1, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.handlers = dict(handlers or {})
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self.processed = 0
+        self.failed = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        # Jobs that were running when the process died are picked up again, unless a newer job
+        # for the same key (pending, or claimed later) supersedes them, as in _retry
+        self._conn.execute(
+            "DELETE FROM jobs WHERE state = 'running' AND dedup_key IS NOT NULL AND EXISTS ("
+            " SELECT 1 FROM jobs AS newer WHERE newer.kind = jobs.kind AND newer.dedup_key = jobs.dedup_key"
+            " AND (newer.state = 'pending' OR (newer.state = 'running' AND newer.id > jobs.id)))"
+        )
+        self._conn.execute("UPDATE jobs SET state = 'pending' WHERE state = 'running'")
+
+    def register(self, kind, handler):
+        self.handlers[kind] = handler
+
+    def enqueue(self, kind, payload, blob=None, dedup_key=None):
+        """Persist a job; returns its id. A pending job with the same dedup_key is overwritten."""
+        now = time.time()
+        with self._lock:
+            row = None
+            if dedup_key is not None:
+                row = self._conn.execute(
+                    "SELECT id FROM jobs WHERE kind = ? AND dedup_key = ? AND state = 'pending'", (kind, dedup_key)
+                ).fetchone()
+            if row:
+                self._conn.execute(
+                    "UPDATE jobs SET payload = ?, blob = ?, attempts = 0, next_run = ?, last_error = NULL WHERE id = ?",
+                    (json.dumps(payload), blob, now, row[0]),
+                )
+                job_id = row[0]
+            else:
+                job_id = self._conn.execute(
+                    "INSERT INTO jobs (kind, dedup_key, payload, blob, next_run, created) VALUES (?, ?, ?, ?, ?, ?)",
+                    (kind, dedup_key, json.dumps(payload), blob, now, now),
+                ).lastrowid
+        self._wake.set()
+        return job_id
+
+    def _claim(self):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, kind, payload, blob, attempts FROM jobs WHERE state = 'pending' AND next_run <= ? ORDER BY next_run LIMIT 1",
+                (time.time(),),
+            ).fetchone()
+            if row:
+                self._conn.execute("UPDATE jobs SET state = 'running' WHERE id = ?", (row[0],))
+            return row
+
+    def run_once(self):
+        """Run the next due job, if any. Returns True when a job was attempted."""
+        row = self._claim()
+        if row is None:
+            return False
+        job_id, kind, payload, blob, attempts = row
+        try:
+            handler = self.handlers[kind]
+            handler(json.loads(payload), blob)
+        except Exception as e:
+            attempts += 1
+            with self._lock:
+                if attempts >= self.max_attempts:
+                    self._conn.execute("UPDATE jobs SET state = 'failed', attempts = ?, last_error = ? WHERE id = ?",
+                                       (attempts, str(e), job_id))
+                    self.failed += 1
+                else:
+                    self._retry(job_id, attempts, str(e))
+            log.warning(f"{kind} job {job_id} failed (attempt {attempts}/{self.max_attempts}): {e}")
+            return True
+        with self._lock:
+            self._conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            self.processed += 1
+        return True
+
+    def _retry(self, job_id, attempts, error):
+        next_run = time.time() + BACKOFF_BASE ** attempts
+        # A newer job for the same key may have been enqueued meanwhile; it supersedes this one
+        try:
+            self._conn.execute("UPDATE jobs SET state = 'pending', attempts = ?, next_run = ?, last_error = ? WHERE id = ?",
+                               (attempts, next_run, error, job_id))
+        except sqlite3.IntegrityError:
+            self._conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def _loop(self):
+        while not self._stop.is_set():
+            if not self.run_once():
+                self._wake.wait(POLL_INTERVAL)
+                self._wake.clear()
+
+    def start(self):
+        for i in range(self.workers - len(self._threads)):
+            thread = threading.Thread(target=self._loop, name=f"jobs-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def status(self):
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+        return {"pending": counts.get("pending", 0), "running": counts.get("running", 0),
+                "failed": counts.get("failed", 0), "processed": self.processed}
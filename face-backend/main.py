@@ -1,28 +1,217 @@
-# MIGRATION NOTE: As of [MIGRATION DATE], this backend exclusively uses Facenet512 (via DeepFace) for all face embedding and recognition. ArcFace is NOT used due to high resource requirements; MobileFaceNet is not available in this DeepFace build. Facenet512 is chosen for its high accuracy and low resource usage. KNN (n_neighbors=1) is the sole classifier. See README for details.
+# MIGRATION NOTE: As of [MIGRATION DATE], this backend exclusively uses Facenet512 (via DeepFace) for all face embedding and recognition. ArcFace is NOT used due to high resource requirements; MobileFaceNet is not available in this DeepFace build. Facenet512 is chosen for its high accuracy and low resource usage. Cosine 1-NN (matcher.py, equivalent to KNN n_neighbors=1) is the sole classifier. See README for details.
 #3.Music/face-backend/main.py
 import os
-import numpy as np
-from fastapi import FastAPI, File, UploadFile, Form
+import asyncio
+import json
+import logging
+from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI, File, UploadFile, Form, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
+from starlette.websockets import WebSocketState
 from pydantic import BaseModel
-from deepface import DeepFace
-from sklearn.neighbors import KNeighborsClassifier
 from dotenv import load_dotenv
 from supabase import create_client, Client
-import tempfile
 import uuid
 from typing import List
-from PIL import Image
 import time
-import cv2
+from gallery import EmbeddingGallery
+from ann_index import open_index
+from models import ModelManager
+from imaging import ImageDecodeError, crop_and_score, decode_image, encode_jpeg, face_from_box, parse_face_box
+from enrolment import BUCKET, SHARPNESS_THRESHOLD, analyse_image, embedding_rows, storage_path
+import enrolment
+from workers import PoolSaturated, pool_from_env
+from jobs import JobQueue
+from caches import RecognitionCache
+from attendance import AttendanceWriter, SessionAttendance
+from cleanup import BlurryCleanup
+import matcher
+import templates
+from quantize import encode_embedding
+from metrics import REGISTRY, REQUEST_SECONDS, stage, timed
 
 # Load environment variables
 load_dotenv()
+# LOG_LEVEL=DEBUG brings back the per-request diagnostics (match distances, upload results, debug logs)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+log = logging.getLogger("main")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
-app = FastAPI()
+# Face detectors + Facenet512, built and warmed once per worker (see models.py)
+model_manager = ModelManager()
+
+# Blocking work runs on bounded pools instead of the event loop (see workers.py).
+# inference: DeepFace, image decode/crop and matching; requests beyond workers + queue get a 503.
+# io: synchronous Supabase client calls (database and storage).
+inference_pool = pool_from_env("inference", os.cpu_count() or 2, 2 * (os.cpu_count() or 2))
+io_pool = pool_from_env("io", 16, 64)
+
+async def admit_inference():
+    async with inference_pool.admit():
+        yield
+
+# Helper: execute a Supabase query builder on the io pool, timed as pipeline stage `span`
+async def db(query, span="db"):
+    with stage(span):
+        return await io_pool.run(query.execute)
+
+# Persistent background jobs (see jobs.py), e.g. the check-in gallery refresh
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "jobs.sqlite3"))
+job_queue = JobQueue(JOB_QUEUE_PATH, workers=int(os.getenv("JOB_WORKERS", "1")))
+
+# Repeat frames of an already-marked student short-circuit right after embedding (see caches.py)
+recognition_cache = RecognitionCache(
+    maxsize=int(os.getenv("RECOGNITION_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("RECOGNITION_CACHE_TTL", "30")),
+)
+
+# Optional ANN backend for very large galleries: ANN_BACKEND=ivf (default: exact search only)
+ANN_BACKEND = os.getenv("ANN_BACKEND", "").strip().lower()
+ANN_INDEX_PATH = os.getenv("ANN_INDEX_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ann_index"))
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "8"))
+# When a class-scoped match fails, retry against every enrolled student (off by default: cross-class
+# matches are rejected by the mobile page anyway and only add false accepts)
+RECOGNIZE_GLOBAL_FALLBACK = os.getenv("RECOGNIZE_GLOBAL_FALLBACK", "0") == "1"
+
+# Compact embeddings (see quantize.py). QUANTIZED_STORAGE=1 writes face_embeddings.embedding_q next to
+# the JSON embedding and loads the gallery from it. GALLERY_QUANTIZATION=float16|int8 keeps the
+# in-memory gallery as float16; matchers without a centroid pass (TEMPLATE_CANDIDATES=0) scan the
+# quantized matrix, the centroid pass reads its few candidates from the float16 rows directly.
+QUANTIZED_STORAGE = os.getenv("QUANTIZED_STORAGE", "0") == "1"
+GALLERY_QUANTIZATION = os.getenv("GALLERY_QUANTIZATION", "").strip().lower() or None
+
+# Per-student templates (see templates.py). Matching first scores one centroid per student and only
+# re-ranks the samples of the TEMPLATE_CANDIDATES nearest students (0 scores every sample). A student
+# whose samples vary a lot is accepted up to ADAPTIVE_THRESHOLD_MAX (set it to the distance threshold
+# to use one threshold for everyone).
+TEMPLATE_CANDIDATES = int(os.getenv("TEMPLATE_CANDIDATES", str(matcher.TEMPLATE_CANDIDATES)))
+ADAPTIVE_THRESHOLD_MAX = float(os.getenv("ADAPTIVE_THRESHOLD_MAX", str(templates.ADAPTIVE_THRESHOLD_MAX)))
+
+# In-memory copy of face_embeddings used by /recognize (see gallery.py)
+gallery = EmbeddingGallery(
+    index=open_index(ANN_INDEX_PATH, kind=ANN_BACKEND, nprobe=ANN_NPROBE) if ANN_BACKEND else None,
+    index_path=ANN_INDEX_PATH,
+    quantization=GALLERY_QUANTIZATION,
+    template_candidates=TEMPLATE_CANDIDATES,
+    adaptive_max=ADAPTIVE_THRESHOLD_MAX,
+)
+# Blurry-sample cleanup runs as a background pass over face_embeddings (see cleanup.py)
+cleanup_job = BlurryCleanup(supabase, gallery)
+FETCH_PAGE_SIZE = 1000  # Supabase caps a single select at 1000 rows by default
+
+# Helper: get all embedding rows from Supabase, page by page
+def fetch_embeddings():
+    if not QUANTIZED_STORAGE:
+        return fetch_embedding_pages("embedding", lambda query: query)
+    rows = fetch_embedding_pages("embedding_q", lambda query: query.not_.is_("embedding_q", "null"))
+    # Rows written before embedding_q existed (or not yet backfilled) only have the JSON embedding
+    return rows + fetch_embedding_pages("embedding", lambda query: query.is_("embedding_q", "null"))
+
+def fetch_embedding_pages(column, where):
+    rows = []
+    start = 0
+    while True:
+        page = where(supabase.table("face_embeddings").select(f"id, usn, {column}")).order("id").range(start, start + FETCH_PAGE_SIZE - 1).execute().data
+        rows.extend(row for row in page if row[column] is not None)
+        if len(page) < FETCH_PAGE_SIZE:
+            break
+        start += FETCH_PAGE_SIZE
+    return rows
+
+# Helper: class/subject metadata used to partition the gallery
+def fetch_students():
+    rows = []
+    start = 0
+    while True:
+        page = supabase.table("students").select("id, usn, class, subjects").order("usn").range(start, start + FETCH_PAGE_SIZE - 1).execute().data
+        rows.extend(page)
+        if len(page) < FETCH_PAGE_SIZE:
+            break
+        start += FETCH_PAGE_SIZE
+    return rows
+
+# Helper: a session's attendance rows, loaded into session_attendance on its first scan and
+# again every SESSION_REFRESH_SECONDS (the teacher page can undo check-ins directly in Supabase)
+@timed("session_load")
+def fetch_session_attendance(session_id):
+    return supabase.table("attendance").select("student_id, check_in, check_out").eq("session_id", session_id).execute().data
+
+# Write-behind attendance upserts: journaled locally, flushed in bulk every N ms or N rows
+@timed("attendance_upsert")
+def upsert_attendance(payloads):
+    return supabase.table("attendance").upsert(payloads, on_conflict="student_id,session_id").execute()
+
+attendance_writer = AttendanceWriter(
+    os.getenv("ATTENDANCE_JOURNAL_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "attendance_journal.sqlite3")),
+    upsert_attendance,
+    interval=int(os.getenv("ATTENDANCE_FLUSH_MS", "250")) / 1000,
+    max_rows=int(os.getenv("ATTENDANCE_FLUSH_ROWS", "50")),
+)
+
+session_attendance = SessionAttendance(
+    fetch_session_attendance,
+    refresh=float(os.getenv("SESSION_REFRESH_SECONDS", "15")),
+    pending=attendance_writer.pending,
+    on_cleared=recognition_cache.forget,
+)
+
+# Helper: USN -> students.id from the in-memory map, falling back to one query for students
+# created outside this backend (the answer is then remembered)
+async def resolve_student_ids(usns):
+    ids = {usn: gallery.student_id(usn) for usn in usns}
+    missing = [usn for usn, student_id in ids.items() if not student_id]
+    if missing:
+        rows = (await db(supabase.table("students").select("id, usn").in_("usn", missing), span="student_lookup")).data
+        for row in rows:
+            gallery.set_student_id(row["usn"], row["id"])
+            ids[row["usn"]] = row["id"]
+    return {usn: student_id for usn, student_id in ids.items() if student_id}
+
+@timed("gallery_reload")
+def reload_gallery():
+    gallery.load(fetch_embeddings())
+    gallery.set_students(fetch_students())
+    return gallery.version
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm models on a background thread; "/" reports 503 until they are ready
+    model_manager.load_in_background()
+    job_queue.start()
+    attendance_writer.start()
+    try:
+        reload_gallery()
+        gallery.save_index()
+    except Exception as e:
+        log.warning(f"Initial gallery load failed, /recognize will retry lazily: {e}")
+    yield
+    cleanup_job.stop()
+    attendance_writer.stop()
+    job_queue.stop()
+    gallery.save_index()
+    inference_pool.shutdown()
+    io_pool.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+
+# Backpressure: tell clients to retry instead of queueing unboundedly behind slow inference
+@app.exception_handler(PoolSaturated)
+async def pool_saturated_handler(request, exc):
+    return JSONResponse(status_code=503, headers={"Retry-After": "1"},
+                        content={"status": "busy", "message": str(exc), "distance": None})
+
+# End-to-end latency of every request, per route, into face_request_seconds (see metrics.py)
+@app.middleware("http")
+async def record_request_latency(request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=route.path if route else "unmatched",
+                            method=request.method, code=response.status_code)
+    return response
 
 # Allow CORS for local/dev
 app.add_middleware(
@@ -37,33 +226,47 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Helper: get all embeddings and usns from Supabase
-def fetch_embeddings():
-    data = supabase.table("face_embeddings").select("usn, embedding").execute().data
-    embeddings = []
-    usns = []
-    for row in data:
-        if row["embedding"] is not None:
-            embeddings.append(row["embedding"])
-            usns.append(row["usn"])
-    return np.array(embeddings), np.array(usns)
-
-# Helper: save embedding to Supabase
+# Helper: save embedding to Supabase and mirror it into the in-memory gallery
+@timed("embedding_insert")
 def save_embedding(usn, embedding, image_url=None, source="register", model="Facenet512", sharpness=None):
-    supabase.table("face_embeddings").insert({
-        "id": str(uuid.uuid4()),
+    row_id = str(uuid.uuid4())
+    row = {
+        "id": row_id,
         "usn": usn,
         "embedding": embedding,
         "image_url": image_url,
         "source": source,
         "model": model,
         "sharpness": sharpness
-    }).execute()
+    }
+    if QUANTIZED_STORAGE:
+        row["embedding_q"] = encode_embedding(embedding)
+    supabase.table("face_embeddings").insert(row).execute()
+    gallery.add(row_id, usn, embedding)
+    return row_id
+
+# Helper: insert several embeddings for one student with a single multi-row insert.
+# `items` are dicts with embedding, image_url and sharpness; returns the new row ids.
+@timed("embedding_insert")
+def save_embeddings(usn, items, source="register", model="Facenet512"):
+    rows = embedding_rows(usn, items, source=source, model=model, quantized=QUANTIZED_STORAGE)
+    if not rows:
+        return []
+    supabase.table("face_embeddings").insert(rows).execute()
+    gallery.add_many([r["id"] for r in rows], [usn] * len(rows), [r["embedding"] for r in rows])
+    return [r["id"] for r in rows]
 
-def calculate_sharpness(image_path):
-    img = np.array(Image.open(image_path).convert('L'))
-    laplacian = cv2.Laplacian(img, cv2.CV_64F)
-    return float(laplacian.var())
+# Helper: delete embedding rows from Supabase and the in-memory gallery
+def delete_embeddings(row_ids):
+    if not row_ids:
+        return
+    supabase.table("face_embeddings").delete().in_("id", list(row_ids)).execute()
+    gallery.remove(row_ids)
+
+# Helper: upload an encoded face crop to Supabase Storage, returns (upload_result, public_url)
+@timed("upload")
+def upload_face_image(usn, jpeg_bytes):
+    return enrolment.upload_face_image(supabase, usn, jpeg_bytes)
 
 # Registration endpoint
 @app.post("/register")
@@ -75,116 +278,77 @@ async def register(
     guardianEmail: str = Form(None),
     guardianPhone: str = Form(None),
     subjects: List[str] = Form([]),
-    files: List[UploadFile] = File(...)
+    files: List[UploadFile] = File(...),
+    _admitted: None = Depends(admit_inference),
 ):
     image_urls = []
     sharpnesses = []
     warnings = []
     debug_log = []
-    SHARPNESS_THRESHOLD = 100  # Raised threshold for stricter filtering
-    for file in files:
-        debug_step = {"filename": file.filename}
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
-            tmp.write(await file.read())
-            tmp_path = tmp.name
-        debug_step["tmp_path"] = tmp_path
-        try:
-            print(f"[DEBUG] Processing file: {file.filename}, temp path: {tmp_path}")
-            reps = DeepFace.represent(
-                img_path=tmp_path,
-                model_name="Facenet512",
-                detector_backend="retinaface",
-                enforce_detection=True
-            )
-            print(f"[DEBUG] DeepFace.represent output: {reps}")
-            debug_step["deepface_reps"] = str(reps)
-            if not reps or "embedding" not in reps[0] or "facial_area" not in reps[0]:
-                msg = f"No face detected in {file.filename}, skipping."
-                warnings.append(msg)
-                debug_step["error"] = msg
-                print(f"[WARN] {msg}")
-                debug_log.append(debug_step)
-                continue
-            embedding = reps[0]["embedding"]
-            facial_area = reps[0]["facial_area"]
-            img = Image.open(tmp_path)
-            x, y, w, h = facial_area["x"], facial_area["y"], facial_area["w"], facial_area["h"]
-            cropped = img.crop((x, y, x+w, y+h)).resize((224, 224))
-            cropped_path = tmp_path + "_cropped.jpg"
-            cropped.save(cropped_path)
-            debug_step["cropped_path"] = cropped_path
-            sharpness = calculate_sharpness(cropped_path)
-            debug_step["sharpness"] = sharpness
-            print(f"[DEBUG] Sharpness for {file.filename}: {sharpness}")
-            if sharpness < SHARPNESS_THRESHOLD:
-                msg = f"Image {file.filename} is too blurry (sharpness={sharpness:.1f} < threshold={SHARPNESS_THRESHOLD}), skipping."
-                warnings.append(msg)
-                debug_step["error"] = msg
-                print(f"[WARN] {msg}")
-                debug_log.append(debug_step)
-                # Do NOT upload or save embedding for blurry images
-                continue
-            # Upload cropped face to Supabase Storage
-            file_ext = file.filename.split('.')[-1]
-            unique_name = f"{usn}_{uuid.uuid4()}.{file_ext}"
-            file_path = f"students/{usn}/{unique_name}"
-            try:
-                with open(cropped_path, "rb") as fimg:
-                    upload_result = supabase.storage.from_("student-images").upload(file_path, fimg, {"upsert": "true"})
-                print(f"[DEBUG] Supabase upload result: {upload_result}")
-                debug_step["upload_result"] = str(upload_result)
-                image_url = supabase.storage.from_("student-images").get_public_url(file_path)
-                print(f"[DEBUG] Supabase public URL: {image_url}")
-                debug_step["image_url"] = image_url
-                if not image_url:
-                    msg = f"Failed to get public URL for {file.filename}"
-                    warnings.append(msg)
-                    debug_step["error"] = msg
-                    print(f"[WARN] {msg}")
-                    debug_log.append(debug_step)
-                    continue
-            except Exception as e:
-                msg = f"Upload failed for {file.filename}: {str(e)}"
-                warnings.append(msg)
-                debug_step["error"] = msg
-                print(f"[ERROR] {msg}")
-                debug_log.append(debug_step)
-                continue
-            try:
-                save_embedding(usn, embedding, image_url=image_url, sharpness=sharpness, model="Facenet512")
-                print(f"[DEBUG] Embedding saved for {file.filename}")
-                debug_step["embedding_saved"] = True
-            except Exception as e:
-                msg = f"Embedding DB insert failed for {file.filename}: {str(e)}"
-                warnings.append(msg)
-                debug_step["error"] = msg
-                print(f"[ERROR] {msg}")
-                debug_log.append(debug_step)
-                continue
-            image_urls.append(image_url)
-            sharpnesses.append(sharpness)
+
+    def reject(debug_step, msg, level=logging.WARNING):
+        warnings.append(msg)
+        debug_step["error"] = msg
+        log.log(level, msg)
+        debug_log.append(debug_step)
+
+    # 1-3. Per image, in parallel on the inference pool: cheap quality gate on a downscaled decode
+    # (obviously blurry or tiny faces never reach the model), RetinaFace detection, exact crop sharpness
+    uploads = [(file.filename, await file.read()) for file in files]
+    analyses = await asyncio.gather(*(inference_pool.run(analyse_image, model_manager, filename, data, SHARPNESS_THRESHOLD, admitted=True)
+                                      for filename, data in uploads))
+    sharp = []
+    for (filename, _), analysis in zip(uploads, analyses):
+        debug_step = {"filename": filename, "prefilter": analysis.get("prefilter")}
+        if analysis.get("sharpness") is not None:
+            debug_step["sharpness"] = analysis["sharpness"]
+            log.debug(f"Sharpness for {filename}: {analysis['sharpness']}")
+        if not analysis["ok"]:
+            reject(debug_step, analysis["message"], logging.ERROR if analysis["reason"] == "error" else logging.WARNING)
+            continue
+        debug_step["facial_area"] = analysis["facial_area"]
+        sharp.append((filename, debug_step, analysis["face"], analysis["cropped"], analysis["sharpness"]))
+
+    # 4. One batched Facenet512 forward pass for every surviving face
+    embeddings = await inference_pool.run(model_manager.embed_faces, [face for _, _, face, _, _ in sharp], admitted=True) if sharp else []
+
+    # 5. Concurrent uploads of the cropped faces to Supabase Storage
+    async def upload(cropped):
+        jpeg = await inference_pool.run(encode_jpeg, cropped, admitted=True)
+        return await io_pool.run(upload_face_image, usn, jpeg)
+    uploaded = await asyncio.gather(*(upload(cropped) for _, _, _, cropped, _ in sharp), return_exceptions=True)
+    saved = []
+    for (filename, debug_step, _, _, sharpness), embedding, result in zip(sharp, embeddings, uploaded):
+        if isinstance(result, Exception):
+            reject(debug_step, f"Upload failed for {filename}: {result}", logging.ERROR)
+            continue
+        upload_result, image_url = result
+        log.debug(f"Supabase upload result: {upload_result}")
+        debug_step["upload_result"] = str(upload_result)
+        debug_step["image_url"] = image_url
+        if not image_url:
+            reject(debug_step, f"Failed to get public URL for {filename}")
+            continue
+        saved.append((debug_step, {"embedding": [float(v) for v in embedding], "image_url": image_url, "sharpness": sharpness}))
+
+    # 6. Single multi-row insert of all embeddings
+    try:
+        await io_pool.run(save_embeddings, usn, [item for _, item in saved])
+        for debug_step, item in saved:
+            debug_step["embedding_saved"] = True
             debug_step["success"] = True
             debug_log.append(debug_step)
-            # Only now delete cropped file
-            os.remove(cropped_path)
-        except Exception as e:
-            msg = f"Embedding or upload failed for {file.filename}: {str(e)}"
-            warnings.append(msg)
-            debug_step["error"] = msg
-            print(f"[ERROR] {msg}")
-            debug_log.append(debug_step)
-        finally:
-            # Only delete temp file at the end
-            try:
-                os.remove(tmp_path)
-            except Exception as e:
-                print(f"[WARN] Failed to delete temp file {tmp_path}: {e}")
+            image_urls.append(item["image_url"])
+            sharpnesses.append(item["sharpness"])
+    except Exception as e:
+        for debug_step, _ in saved:
+            reject(debug_step, f"Embedding DB insert failed for {debug_step['filename']}: {str(e)}", logging.ERROR)
     # Insert or update student record
     try:
-        student_exists = supabase.table("students").select("id").eq("usn", usn).execute().data
-        print(f"[DEBUG] Student exists: {student_exists}")
+        student_exists = (await db(supabase.table("students").select("id").eq("usn", usn), span="student_lookup")).data
+        log.debug(f"Student exists: {student_exists}")
         if not student_exists:
-            insert_result = supabase.table("students").insert({
+            insert_result = await db(supabase.table("students").insert({
                 "usn": usn,
                 "name": name,
                 "class": class_,
@@ -193,50 +357,158 @@ async def register(
                 "guardian_email": guardianEmail,
                 "guardian_phone": guardianPhone,
                 "image_urls": image_urls,
-            }).execute()
-            print(f"[DEBUG] Student insert result: {insert_result}")
+            }), span="student_upsert")
+            log.debug(f"Student insert result: {insert_result}")
+            student_id = insert_result.data[0]["id"] if insert_result.data else None
+            gallery.upsert_student(usn, class_, subjects, student_id=student_id)
         else:
-            update_result = supabase.table("students").update({"image_urls": image_urls}).eq("usn", usn).execute()
-            print(f"[DEBUG] Student update result: {update_result}")
+            update_result = await db(supabase.table("students").update({"image_urls": image_urls}).eq("usn", usn), span="student_upsert")
+            log.debug(f"Student update result: {update_result}")
     except Exception as e:
         msg = f"Student DB insert/update failed: {str(e)}"
         warnings.append(msg)
-        print(f"[ERROR] {msg}")
-    print(f"[SUMMARY] Registration for USN {usn}: {len(image_urls)} images saved, {len(warnings)} warnings.")
-    print(f"[SUMMARY] Warnings: {warnings}")
-    print(f"[SUMMARY] Debug log: {debug_log}")
+        log.error(msg)
+    log.info(f"Registration for USN {usn}: {len(image_urls)} images saved, {len(warnings)} warnings.")
+    log.debug(f"Registration warnings: {warnings}")
+    log.debug(f"Registration debug log: {debug_log}")
     return {"status": "success", "usn": usn, "image_urls": image_urls, "sharpnesses": sharpnesses, "warnings": warnings, "debug_log": debug_log}
 
-# Utility endpoint: Clean up blurry embeddings and images from DB and storage
-def delete_blurry_embeddings_and_images(sharpness_threshold=100):
-    print(f"[CLEANUP] Removing embeddings and images with sharpness below {sharpness_threshold}")
-    data = supabase.table("face_embeddings").select("id, usn, image_url, sharpness").execute().data
-    for row in data:
-        if row.get("sharpness") is not None and row["sharpness"] < sharpness_threshold:
-            # Delete from storage
-            image_url = row.get("image_url")
-            if image_url:
-                # Extract path after bucket name
-                try:
-                    path = image_url.split("student-images/")[-1].split("?")[0]
-                    supabase.storage.from_("student-images").remove([path])
-                    print(f"[CLEANUP] Deleted image from storage: {path}")
-                except Exception as e:
-                    print(f"[CLEANUP] Failed to delete image: {e}")
-            # Delete from embeddings table
+# Utility endpoints: remove blurry embeddings and their images from DB and storage.
+# POST starts a background pass (a second POST while one runs is a no-op); GET reports progress.
+@app.post("/cleanup_blurry")
+def cleanup_blurry_api(sharpness_threshold: float = Form(SHARPNESS_THRESHOLD)):
+    started = cleanup_job.start(sharpness_threshold)
+    return {"status": "cleanup-started" if started else "cleanup-running", **cleanup_job.status()}
+
+@app.get("/cleanup_blurry")
+def cleanup_blurry_status_api():
+    return cleanup_job.status()
+
+# Resync the in-memory gallery with face_embeddings (e.g. after rows were edited directly in Supabase).
+# Pass if_version (from GET /gallery) to reload only if the gallery is still at that version, i.e. no
+# other mutation or reload happened since the caller looked; otherwise it answers version-mismatch.
+@app.post("/gallery/reload")
+def reload_gallery_api(if_version: int = Form(None)):
+    if if_version is not None and if_version != gallery.version:
+        return {"status": "version-mismatch", **gallery.status()}
+    reload_gallery()
+    gallery.save_index()
+    return {"status": "reloaded", **gallery.status()}
+
+@app.get("/gallery")
+def gallery_status_api():
+    return gallery.status()
+
+# Helper: attendance row for one recognized student; check_in or check_out is stamped by mode
+def attendance_payload(student_uuid, session_id, class_name, subject, teacher_id, mode, now_iso=None):
+    now_iso = now_iso or time.strftime('%Y-%m-%dT%H:%M:%S')
+    payload = {
+        "student_id": student_uuid,
+        "session_id": session_id,
+        "class": class_name,
+        "subject": subject,
+        "teacher_id": teacher_id,
+        "date": now_iso.split('T')[0],
+        "method": "face-auto",
+        "is_absent": False
+    }
+    if mode == "check-in":
+        payload["check_in"] = now_iso
+    elif mode == "check-out":
+        payload["check_out"] = now_iso
+    return payload
+
+# Check-in image rotation: keep up to CHECKIN_MAX_IMAGES sharp samples per student, replacing the
+# least sharp one when a sharper check-in frame arrives. `img` is the decoded BGR frame.
+CHECKIN_MAX_IMAGES = 5
+def save_checkin_image(usn, img, facial_area, embedding, sharpness_threshold=100):
+    cropped, sharpness = crop_and_score(img, facial_area)
+    log.debug(f"[CHECKIN-IMG] Sharpness: {sharpness}")
+    if sharpness < sharpness_threshold:
+        log.debug(f"[CHECKIN-IMG] Image too blurry (sharpness={sharpness}), not saving.")
+        return None
+    # Fetch all existing images/embeddings for this student
+    existing = supabase.table("face_embeddings").select("id, image_url, sharpness").eq("usn", usn).execute().data
+    log.debug(f"[CHECKIN-IMG] Existing images: {len(existing)}")
+    min_row = None
+    if len(existing) >= CHECKIN_MAX_IMAGES:
+        # Find lowest sharpness
+        min_row = min(existing, key=lambda r: r.get("sharpness") or 0)
+        if sharpness <= (min_row.get("sharpness") or 0):
+            log.debug(f"[CHECKIN-IMG] New image sharpness {sharpness} not higher than lowest {min_row['sharpness']}, not replacing.")
+            return None
+        log.info(f"[CHECKIN-IMG] Replacing image {min_row['image_url']} (sharpness={min_row['sharpness']}) with new (sharpness={sharpness})")
+        # Delete old image from storage
+        if min_row["image_url"]:
             try:
-                supabase.table("face_embeddings").delete().eq("id", row["id"]).execute()
-                print(f"[CLEANUP] Deleted embedding id: {row['id']}")
+                path = storage_path(min_row["image_url"])
+                supabase.storage.from_(BUCKET).remove([path])
+                log.debug(f"[CHECKIN-IMG] Deleted old image from storage: {path}")
             except Exception as e:
-                print(f"[CLEANUP] Failed to delete embedding: {e}")
+                log.warning(f"[CHECKIN-IMG] Failed to delete old image: {e}")
+        # Delete old embedding
+        delete_embeddings([min_row["id"]])
+    # Upload new image straight from memory
+    _, image_url = upload_face_image(usn, encode_jpeg(cropped))
+    log.debug(f"[CHECKIN-IMG] Uploaded {'replacement' if min_row else 'new'} image: {image_url}")
+    save_embedding(usn, embedding, image_url=image_url, sharpness=sharpness, model="Facenet512", source="check-in")
+    # Update students table image_urls
+    kept = [row for row in existing if min_row is None or row["id"] != min_row["id"]]
+    all_urls = [row["image_url"] for row in kept if row["image_url"]] + [image_url]
+    supabase.table("students").update({"image_urls": all_urls}).eq("usn", usn).execute()
+    return image_url
 
-# Add a FastAPI endpoint to trigger cleanup (for automation)
-@app.post("/cleanup_blurry")
-def cleanup_blurry_api():
-    delete_blurry_embeddings_and_images(sharpness_threshold=100)
-    return {"status": "cleanup-complete"}
+# Background job: check-in gallery refresh. The job carries the raw upload, so all decoding,
+# cropping and storage work happens off the request path; one pending job is kept per USN.
+# A job without an embedding came from a client face box, whose crop is not aligned the way
+# enrolment samples are: the job runs server-side detection on the frame and stores the
+# detected face inside that box instead.
+def detect_checkin_face(img, client_box):
+    """(facial_area, embedding) of the detected face centred inside `client_box`, or (None, None)."""
+    for rep in model_manager.represent(img, enforce_detection=False):
+        area = rep.get("facial_area") or {}
+        if not area.get("w") or not area.get("h"):
+            continue
+        cx, cy = area["x"] + area["w"] / 2, area["y"] + area["h"] / 2
+        if client_box["x"] <= cx <= client_box["x"] + client_box["w"] and client_box["y"] <= cy <= client_box["y"] + client_box["h"]:
+            return area, rep["embedding"]
+    return None, None
+
+def run_checkin_image_job(payload, blob):
+    img = decode_image(blob)
+    facial_area, embedding = payload["facial_area"], payload.get("embedding")
+    if embedding is None:
+        facial_area, embedding = detect_checkin_face(img, facial_area)
+        if embedding is None:
+            log.debug(f"[CHECKIN-IMG] No face detected inside the client box for {payload['usn']}, not saving.")
+            return None
+    return save_checkin_image(payload["usn"], img, facial_area, embedding)
+
+job_queue.register("checkin-image", run_checkin_image_job)
+
+def enqueue_checkin_image(usn, data, facial_area, embedding=None):
+    area = {k: int(facial_area[k]) for k in ("x", "y", "w", "h")}
+    payload = {"usn": usn, "facial_area": area}
+    if embedding is not None:
+        payload["embedding"] = [float(v) for v in embedding]
+    return job_queue.enqueue("checkin-image", payload, blob=data, dedup_key=usn)
 
 # Recognition endpoint
+# Client-located faces: the mobile page already runs face detection on every frame before
+# uploading it. When it sends that box (`face_box`), or uploads the face crop itself
+# (`face_cropped`), /recognize only validates the box, checks its sharpness and embeds it,
+# skipping server-side detection. Frames without a usable box are detected here as before.
+RECOGNIZE_SHARPNESS_THRESHOLD = float(os.getenv("RECOGNIZE_SHARPNESS_THRESHOLD", "30"))
+
+
+def embed_client_face(img, facial_area):
+    """(embedding, sharpness) for a face located by the client; the embedding is None when it is too blurry."""
+    _, sharpness = crop_and_score(img, facial_area)
+    if sharpness < RECOGNIZE_SHARPNESS_THRESHOLD:
+        return None, sharpness
+    return model_manager.embed_faces([face_from_box(img, facial_area)])[0].tolist(), sharpness
+
+
 @app.post("/recognize")
 async def recognize(
     file: UploadFile = File(...),
@@ -245,179 +517,340 @@ async def recognize(
     subject: str = Form(None),
     teacher_id: str = Form(None),
     mode: str = Form(None),
+    face_box: str = Form(None),
+    face_cropped: bool = Form(False),
+    _admitted: None = Depends(admit_inference),
 ):
-    print("RECOGNIZE endpoint: called")
-    t0 = time.time()
-    # Save uploaded file to temp
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
-        tmp.write(await file.read())
-        tmp_path = tmp.name
+    data = await file.read()
+    return await recognize_frame(data, session_id, class_name, subject, teacher_id, mode, face_box, face_cropped)
+
+
+async def recognize_frame(data, session_id=None, class_name=None, subject=None, teacher_id=None, mode=None,
+                          face_box=None, face_cropped=False):
+    """One frame through the /recognize pipeline; returns the response body. Shared with /ws/recognize."""
+    # Decode the upload once; the same array feeds DeepFace and the check-in crop
+    try:
+        img = await inference_pool.run(decode_image, data, admitted=True)
+    except ImageDecodeError as e:
+        log.debug(f"Upload could not be decoded: {e}")
+        return {"status": "no-face", "message": str(e), "distance": None}
+
+    facial_area = None
+    if face_cropped or face_box:
+        try:
+            facial_area = parse_face_box([0, 0, img.shape[1], img.shape[0]] if face_cropped else face_box, img.shape)
+        except ValueError as e:
+            log.debug(f"Ignoring client face box, detecting instead: {e}")
+    client_box = facial_area is not None
 
     try:
-        t1 = time.time()
-        reps = DeepFace.represent(img_path=tmp_path, model_name="Facenet512")
-        print(f"DeepFace.represent done in {time.time() - t1:.2f}s")
-        if not reps or "embedding" not in reps[0]:
-            os.remove(tmp_path)
-            print(f"No face detected. Total time: {time.time() - t0:.2f}s")
-            return {"status": "no-face", "message": "No face detected in image.", "distance": None}
-        test_embedding = reps[0]["embedding"]
+        if facial_area:
+            test_embedding, sharpness = await inference_pool.run(embed_client_face, img, facial_area, admitted=True)
+            if test_embedding is None:
+                log.debug(f"Client face box too blurry: sharpness={sharpness:.1f}")
+                return {"status": "no-face", "distance": None,
+                        "message": f"Face too blurry (sharpness={sharpness:.1f} < threshold={RECOGNIZE_SHARPNESS_THRESHOLD})."}
+        else:
+            reps = await inference_pool.run(model_manager.represent, img, admitted=True)
+            if not reps or "embedding" not in reps[0]:
+                log.debug("No face detected")
+                return {"status": "no-face", "message": "No face detected in image.", "distance": None}
+            test_embedding = reps[0]["embedding"]
+            facial_area = reps[0].get("facial_area")
     except Exception as e:
-        os.remove(tmp_path)
-        print(f"Exception in DeepFace.represent: {e}. Total time: {time.time() - t0:.2f}s")
+        log.debug(f"Exception while embedding the face: {e}")
         return {"status": "no-face", "message": str(e), "distance": None}
-    os.remove(tmp_path)
-
-    # Fetch all embeddings and usns
-    embeddings, usns = fetch_embeddings()
-    if len(embeddings) == 0:
-        print(f"No embeddings in database. Total time: {time.time() - t0:.2f}s")
-        return {"status": "error", "message": "No embeddings in database", "distance": None}
-
-    # KNN classification with distance threshold
-    knn = KNeighborsClassifier(n_neighbors=1, metric='cosine')
-    embeddings = np.array(embeddings, dtype=np.float32)
-    knn.fit(embeddings, usns)
-    dist, idx = knn.kneighbors([test_embedding], n_neighbors=1, return_distance=True)
-    pred_usn = knn.predict([test_embedding])[0]
-    DISTANCE_THRESHOLD = 0.5  # Facenet512 tuned for real-world classroom use
-    print(f"[DEBUG] KNN distance: {dist[0][0]}")
-    # Look up student UUID from USN
+
+    # Same face, same session and mode, already marked a moment ago: answer without matching or
+    # Supabase, as long as the session state is fresh and still says marked (an undo clears it)
+    cached = recognition_cache.lookup(session_id, mode, test_embedding)
+    if cached and session_attendance.is_fresh(session_id) and session_attendance.is_marked(session_id, cached["student_uuid"], mode):
+        log.debug(f"Recognition cache hit: USN={cached['usn']}, mode={mode}")
+        return {"status": "already-marked", "usn": cached["usn"], "distance": cached["distance"], "margin": cached["margin"], "cached": True}
+
+    # Match against the in-memory gallery (loaded at startup, kept current by the write paths)
+    if not gallery.loaded:
+        await io_pool.run(reload_gallery)
+    # Cosine match with distance threshold (best sample per student, runner-up margin for diagnostics).
+    # With a class_name only that class/subject partition of the gallery is searched.
+    match = (await inference_pool.run(gallery.match, [test_embedding], aggregate="best", class_name=class_name,
+                                      subject=subject, fallback_global=RECOGNIZE_GLOBAL_FALLBACK, admitted=True))[0]
+    if match is None:
+        scope = f"class {class_name}" if class_name else "database"
+        log.warning(f"No embeddings in {scope}")
+        return {"status": "error", "message": f"No embeddings in {scope}", "distance": None}
+    pred_usn, distance, margin = match["usn"], match["distance"], match["margin"]
+    log.debug(f"Match distance: {distance}, runner-up margin: {margin}, scope: {match['scope']}")
+    # Look up student UUID from USN (in-memory map next to the gallery)
     student_uuid = None
     try:
-        student_row = supabase.table("students").select("id").eq("usn", pred_usn).execute().data
-        if student_row and len(student_row) > 0:
-            student_uuid = student_row[0]["id"]
-            print(f"[DEBUG] Found student UUID: {student_uuid} for USN: {pred_usn}")
+        student_uuid = (await resolve_student_ids([pred_usn])).get(pred_usn)
+        log.debug(f"Found student UUID: {student_uuid} for USN: {pred_usn}")
     except Exception as e:
-        print(f"[ERROR] Failed to look up student UUID: {e}")
-    # Check if already marked for this session and mode (must have student_uuid)
+        log.error(f"Failed to look up student UUID: {e}")
+    # Check if already marked for this session and mode (must have student_uuid), from the
+    # in-memory session state; the session's rows are re-read from Supabase once they are stale
     already_marked = False
     try:
         if student_uuid and session_id and mode:
-            attendance_rows = supabase.table("attendance").select("check_in,check_out").eq("student_id", student_uuid).eq("session_id", session_id).execute().data
-            if attendance_rows and len(attendance_rows) > 0:
-                row = attendance_rows[0]
-                if mode == "check-in" and row.get("check_in") not in (None, "", "null"):
-                    already_marked = True
-                if mode == "check-out" and row.get("check_out") not in (None, "", "null"):
-                    already_marked = True
+            if not session_attendance.is_fresh(session_id):
+                await io_pool.run(session_attendance.load, session_id)
+            already_marked = session_attendance.is_marked(session_id, student_uuid, mode)
     except Exception as e:
-        print(f"[ERROR] Failed to check already-marked: {e}")
-    if dist[0][0] > DISTANCE_THRESHOLD:
-        print(f"[DEBUG] No close match found (distance {dist[0][0]} > {DISTANCE_THRESHOLD})")
-        return {"status": "no-match", "distance": float(dist[0][0])}
+        log.error(f"Failed to check already-marked: {e}")
+    if not match["matched"]:
+        log.debug(f"No close match found (distance {distance} > {match['threshold']})")
+        return {"status": "no-match", "distance": distance, "margin": margin}
     if already_marked:
-        print(f"[DEBUG] Already marked: USN={pred_usn}, distance={dist[0][0]}, mode={mode}")
-        return {"status": "already-marked", "usn": pred_usn, "distance": float(dist[0][0])}
+        log.debug(f"Already marked: USN={pred_usn}, distance={distance}, mode={mode}")
+        recognition_cache.store(session_id, mode, test_embedding, student_uuid=student_uuid, usn=pred_usn, distance=distance, margin=margin)
+        return {"status": "already-marked", "usn": pred_usn, "distance": distance, "margin": margin}
     # Only upsert if not already marked
+    marked = False
     try:
-        print(f"[DEBUG] session_id: {session_id}, class_name: {class_name}, subject: {subject}, teacher_id: {teacher_id}, mode: {mode}")
+        log.debug(f"session_id: {session_id}, class_name: {class_name}, subject: {subject}, teacher_id: {teacher_id}, mode: {mode}")
         if student_uuid and session_id and class_name and subject and teacher_id and mode:
-            now_iso = time.strftime('%Y-%m-%dT%H:%M:%S')
-            upsert_payload = {
-                "student_id": student_uuid,
-                "session_id": session_id,
-                "class": class_name,
-                "subject": subject,
-                "teacher_id": teacher_id,
-                "date": now_iso.split('T')[0],
-                "method": "face-auto",
-                "is_absent": False
-            }
+            upsert_payload = attendance_payload(student_uuid, session_id, class_name, subject, teacher_id, mode)
             if mode == "check-in":
-                upsert_payload["check_in"] = now_iso
-                # --- Begin: Save check-in image logic ---
-                try:
-                    # Re-run DeepFace to get facial area for cropping (already done above, so reuse reps[0])
-                    facial_area = reps[0].get("facial_area")
-                    if facial_area:
-                        # Re-save uploaded file to temp for cropping
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp2:
-                            file.file.seek(0)
-                            tmp2.write(await file.read())
-                            tmp2_path = tmp2.name
-                        img = Image.open(tmp2_path)
-                        x, y, w, h = facial_area["x"], facial_area["y"], facial_area["w"], facial_area["h"]
-                        cropped = img.crop((x, y, x+w, y+h)).resize((224, 224))
-                        cropped_path = tmp2_path + "_cropped.jpg"
-                        cropped.save(cropped_path)
-                        sharpness = calculate_sharpness(cropped_path)
-                        print(f"[CHECKIN-IMG] Sharpness: {sharpness}")
-                        SHARPNESS_THRESHOLD = 100
-                        if sharpness >= SHARPNESS_THRESHOLD:
-                            # Fetch all existing images/embeddings for this student
-                            existing = supabase.table("face_embeddings").select("id, image_url, sharpness").eq("usn", pred_usn).execute().data
-                            print(f"[CHECKIN-IMG] Existing images: {len(existing)}")
-                            if len(existing) < 5:
-                                # Add new image
-                                file_ext = "jpg"
-                                unique_name = f"{pred_usn}_{uuid.uuid4()}.{file_ext}"
-                                file_path = f"students/{pred_usn}/{unique_name}"
-                                with open(cropped_path, "rb") as fimg:
-                                    upload_result = supabase.storage.from_("student-images").upload(file_path, fimg, {"upsert": "true"})
-                                image_url = supabase.storage.from_("student-images").get_public_url(file_path)
-                                print(f"[CHECKIN-IMG] Uploaded new image: {image_url}")
-                                save_embedding(pred_usn, test_embedding, image_url=image_url, sharpness=sharpness, model="Facenet512", source="check-in")
-                                # Update students table image_urls
-                                all_urls = [row["image_url"] for row in existing if row["image_url"]] + [image_url]
-                                supabase.table("students").update({"image_urls": all_urls}).eq("usn", pred_usn).execute()
-                            else:
-                                # Find lowest sharpness
-                                min_row = min(existing, key=lambda r: r.get("sharpness", 0))
-                                if sharpness > min_row.get("sharpness", 0):
-                                    # Replace
-                                    print(f"[CHECKIN-IMG] Replacing image {min_row['image_url']} (sharpness={min_row['sharpness']}) with new (sharpness={sharpness})")
-                                    # Delete old image from storage
-                                    if min_row["image_url"]:
-                                        try:
-                                            path = min_row["image_url"].split("student-images/")[-1].split("?")[0]
-                                            supabase.storage.from_("student-images").remove([path])
-                                            print(f"[CHECKIN-IMG] Deleted old image from storage: {path}")
-                                        except Exception as e:
-                                            print(f"[CHECKIN-IMG] Failed to delete old image: {e}")
-                                    # Delete old embedding
-                                    supabase.table("face_embeddings").delete().eq("id", min_row["id"]).execute()
-                                    # Upload new image
-                                    file_ext = "jpg"
-                                    unique_name = f"{pred_usn}_{uuid.uuid4()}.{file_ext}"
-                                    file_path = f"students/{pred_usn}/{unique_name}"
-                                    with open(cropped_path, "rb") as fimg:
-                                        upload_result = supabase.storage.from_("student-images").upload(file_path, fimg, {"upsert": "true"})
-                                    image_url = supabase.storage.from_("student-images").get_public_url(file_path)
-                                    print(f"[CHECKIN-IMG] Uploaded replacement image: {image_url}")
-                                    save_embedding(pred_usn, test_embedding, image_url=image_url, sharpness=sharpness, model="Facenet512", source="check-in")
-                                    # Update students table image_urls
-                                    all_urls = [row["image_url"] for row in existing if row["id"] != min_row["id"] and row["image_url"]] + [image_url]
-                                    supabase.table("students").update({"image_urls": all_urls}).eq("usn", pred_usn).execute()
-                                else:
-                                    print(f"[CHECKIN-IMG] New image sharpness {sharpness} not higher than lowest {min_row['sharpness']}, not replacing.")
-                        else:
-                            print(f"[CHECKIN-IMG] Image too blurry (sharpness={sharpness}), not saving.")
-                        # Clean up temp files
-                        try:
-                            os.remove(cropped_path)
-                        except Exception as e:
-                            print(f"[CHECKIN-IMG] Failed to delete cropped file: {e}")
-                        try:
-                            os.remove(tmp2_path)
-                        except Exception as e:
-                            print(f"[CHECKIN-IMG] Failed to delete temp file: {e}")
-                except Exception as e:
-                    print(f"[CHECKIN-IMG] Exception in check-in image save: {e}")
-            elif mode == "check-out":
-                upsert_payload["check_out"] = now_iso
-            print(f"[DEBUG] Upserting attendance: {upsert_payload}")
-            result = supabase.table("attendance").upsert(upsert_payload, on_conflict="student_id,session_id").execute()
-            print(f"[DEBUG] Upsert result: {result}")
+                # Keep the student's gallery fresh with a sharp check-in image, in the background.
+                # A client box's embedding is not stored: the job re-detects the face in that box.
+                if facial_area:
+                    try:
+                        await io_pool.run(enqueue_checkin_image, pred_usn, data, facial_area,
+                                          None if client_box else test_embedding)
+                    except Exception as e:
+                        log.warning(f"[CHECKIN-IMG] Failed to queue check-in image: {e}")
+            log.debug(f"Queueing attendance upsert: {upsert_payload}")
+            await io_pool.run(attendance_writer.submit, upsert_payload)
+            session_attendance.record(upsert_payload)
+            recognition_cache.store(session_id, mode, test_embedding, student_uuid=student_uuid, usn=pred_usn, distance=distance, margin=margin)
+            marked = True
         else:
-            print(f"[DEBUG] Missing session_id, class_name, subject, teacher_id, or mode. Attendance not upserted.")
+            log.debug("Missing session_id, class_name, subject, teacher_id, or mode. Attendance not upserted.")
+    except Exception as e:
+        log.error(f"Failed to upsert attendance: {e}")
+    return {"status": "success", "usn": pred_usn, "distance": distance, "margin": margin, "marked": marked}
+
+
+# Streaming recognition: the mobile page opens one WebSocket per attendance session, binds the
+# session context once, then streams binary JPEG frames. Only the newest frame waits for
+# inference; a frame that arrives while another is waiting replaces it, so a slow server drops
+# stale frames instead of queueing them. Each processed frame is answered with a "recognition"
+# event, plus an "attendance" event when it recorded attendance.
+WS_CONTEXT_FIELDS = ("session_id", "class_name", "subject", "teacher_id", "mode")
+WS_FRAME_HINTS = ("face_box", "face_cropped")
+ws_stats = {"connections": 0, "frames": 0, "dropped": 0}
+
+
+@app.websocket("/ws/recognize")
+async def recognize_ws(websocket: WebSocket):
+    """Protocol (client -> server): a JSON text message with the session context (the /recognize
+    form fields), then binary JPEG frames. A JSON text message with `face_box` or `face_cropped`
+    applies to the next frame; one with context fields rebinds them for later frames.
+    Server -> client: {"type": "ready"}, then per frame "recognition" (the /recognize body plus
+    `frame` and `dropped`), "attendance", "busy" (the frame was dropped, the server is saturated)
+    or "error" (processing the frame failed; later frames are still processed).
+    """
+    await websocket.accept()
+    try:
+        first = await websocket.receive_json()
+    except WebSocketDisconnect:
+        return
+    except (ValueError, KeyError):
+        await websocket.close(code=1007)  # the first message must be the JSON session context
+        return
+    context = {k: first.get(k) for k in WS_CONTEXT_FIELDS} if isinstance(first, dict) else dict.fromkeys(WS_CONTEXT_FIELDS)
+    latest = {"frame": None}
+    frame_ready = asyncio.Event()
+    counts = {"received": 0, "dropped": 0}
+
+    async def receive():
+        hints = {}
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            if message.get("bytes") is not None:
+                counts["received"] += 1
+                ws_stats["frames"] += 1
+                if latest["frame"] is not None:
+                    counts["dropped"] += 1
+                    ws_stats["dropped"] += 1
+                latest["frame"] = (counts["received"], message["bytes"], hints)
+                hints = {}
+                frame_ready.set()
+            elif message.get("text"):
+                try:
+                    update = json.loads(message["text"])
+                    hints = {k: update[k] for k in WS_FRAME_HINTS if k in update}
+                    context.update({k: update[k] for k in WS_CONTEXT_FIELDS if k in update})
+                except (ValueError, TypeError, AttributeError) as e:
+                    log.debug(f"Ignoring malformed WebSocket message: {e}")
+
+    ws_stats["connections"] += 1
+    receiver = asyncio.create_task(receive())
+    try:
+        await websocket.send_json({"type": "ready", **context})
+        while True:
+            waiter = asyncio.create_task(frame_ready.wait())
+            done, _ = await asyncio.wait({receiver, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            if receiver in done:
+                waiter.cancel()
+                break
+            frame_ready.clear()
+            number, data, hints = latest["frame"]
+            latest["frame"] = None
+            try:
+                async with inference_pool.admit():
+                    result = await recognize_frame(data, **context, **hints)
+            except PoolSaturated as e:
+                counts["dropped"] += 1
+                ws_stats["dropped"] += 1
+                await websocket.send_json({"type": "busy", "frame": number, "message": str(e)})
+                continue
+            except Exception:
+                log.exception(f"WebSocket frame {number} failed")
+                await websocket.send_json({"type": "error", "frame": number})
+                continue
+            await websocket.send_json({"type": "recognition", "frame": number, "dropped": counts["dropped"], **result})
+            if result.get("marked"):
+                await websocket.send_json({"type": "attendance", "frame": number, "usn": result["usn"],
+                                           "session_id": context["session_id"], "mode": context["mode"]})
+    except WebSocketDisconnect:
+        pass  # the client went away mid-send; anything it recognized is already recorded
+    except RuntimeError:
+        # Starlette raises RuntimeError for a send after the close; anything else is a bug
+        if WebSocketState.DISCONNECTED not in (websocket.client_state, websocket.application_state):
+            raise
+    finally:
+        receiver.cancel()
+        ws_stats["connections"] -= 1
+        log.debug(f"WebSocket session {context['session_id']} closed: {counts}")
+
+# Batched recognition: several frames and/or a group photo in one request. Every face in every
+# frame is detected, all faces are embedded in one forward pass and matched in one vectorized
+# query, and attendance for all newly recognized students is written with a single bulk upsert.
+# Check-in image rotation is skipped here: group-photo crops are too small to improve the gallery.
+MAX_BATCH_FRAMES = 10
+@app.post("/recognize/batch")
+async def recognize_batch(
+    files: List[UploadFile] = File(...),
+    session_id: str = Form(None),
+    class_name: str = Form(None),
+    subject: str = Form(None),
+    teacher_id: str = Form(None),
+    mode: str = Form(None),
+    _admitted: None = Depends(admit_inference),
+):
+    if len(files) > MAX_BATCH_FRAMES:
+        return JSONResponse(status_code=413, content={"status": "error", "message": f"At most {MAX_BATCH_FRAMES} frames per batch"})
+    faces, results = [], []
+    for frame, file in enumerate(files):
+        try:
+            img = await inference_pool.run(decode_image, await file.read(), admitted=True)
+        except ImageDecodeError as e:
+            results.append({"frame": frame, "status": "no-face", "message": str(e)})
+            continue
+        detected = await inference_pool.run(model_manager.detect_faces, img, admitted=True)
+        if not detected:
+            results.append({"frame": frame, "status": "no-face", "message": "No face detected in image."})
+        for face in detected:
+            faces.append(face["face"])
+            results.append({"frame": frame, "facial_area": face["facial_area"], "status": None})
+    face_results = [r for r in results if r["status"] is None]
+    if not faces:
+        log.debug(f"[BATCH] No faces in {len(files)} frames")
+        return {"status": "no-face", "faces": results, "marked": [], "already_marked": []}
+
+    embeddings = await inference_pool.run(model_manager.embed_faces, faces, admitted=True)
+    if not gallery.loaded:
+        await io_pool.run(reload_gallery)
+    matches = await inference_pool.run(gallery.match, embeddings, aggregate="best", class_name=class_name,
+                                       subject=subject, fallback_global=RECOGNIZE_GLOBAL_FALLBACK, admitted=True)
+    best = {}  # usn -> closest face, so a student seen in several frames is marked once
+    for result, match in zip(face_results, matches):
+        if match is None:
+            result.update({"status": "error", "message": "No embeddings in database", "distance": None})
+            continue
+        result.update({"usn": match["usn"], "distance": match["distance"], "margin": match["margin"]})
+        if not match["matched"]:
+            result["status"] = "no-match"
+            continue
+        result["status"] = "success"
+        if match["usn"] not in best or match["distance"] < best[match["usn"]]["distance"]:
+            best[match["usn"]] = result
+
+    marked, already = [], []
+    try:
+        if best:
+            uuid_by_usn = await resolve_student_ids(list(best))
+            if session_id and mode and not session_attendance.is_fresh(session_id):
+                await io_pool.run(session_attendance.load, session_id)
+            payloads = []
+            for usn, result in best.items():
+                student_uuid = uuid_by_usn.get(usn)
+                if student_uuid and session_id and session_attendance.is_marked(session_id, student_uuid, mode):
+                    result["status"] = "already-marked"
+                    already.append(usn)
+                elif student_uuid and session_id and class_name and subject and teacher_id and mode:
+                    payloads.append(attendance_payload(student_uuid, session_id, class_name, subject, teacher_id, mode))
+                    marked.append(usn)
+            for payload in payloads:
+                await io_pool.run(attendance_writer.submit, payload)
+                session_attendance.record(payload)
     except Exception as e:
-        print(f"[ERROR] Failed to upsert attendance: {e}")
-    print(f"Total recognition pipeline time: {time.time() - t0:.2f}s")
-    return {"status": "success", "usn": pred_usn, "distance": float(dist[0][0])}
+        log.error(f"[BATCH] Attendance update failed: {e}")
+        marked = []
+    log.debug(f"[BATCH] {len(files)} frames, {len(faces)} faces, {len(marked)} marked, {len(already)} already marked")
+    return {"status": "success" if best else "no-match", "faces": results, "marked": marked, "already_marked": already}
+
+# Preload a session's attendance state when the teacher starts it, so even the first scan needs no read
+@app.post("/sessions/{session_id}/start")
+def start_session(session_id: str):
+    rows = session_attendance.load(session_id)
+    return {"status": "started", "session_id": session_id, "rows": rows}
+
+# Flush the session's buffered attendance to Supabase and drop its in-memory state
+@app.post("/sessions/{session_id}/end")
+def end_session(session_id: str):
+    flushed = attendance_writer.flush(session_id)
+    pending = attendance_writer.status()["pending"]
+    session_attendance.forget(session_id)
+    return {"status": "ended", "session_id": session_id, "flushed": flushed, "pending": pending}
+
+# Prometheus scrape target: per-stage and per-request latency histograms plus the gauges below
+REGISTRY.gauge("face_models_ready", "1 once the face models are warmed up.", lambda: int(model_manager.ready))
+REGISTRY.gauge("face_gallery_embeddings", "Embeddings in the in-memory gallery.", lambda: len(gallery))
+REGISTRY.gauge("face_gallery_students", "Students with at least one embedding in the gallery.", lambda: gallery.status()["students"])
+REGISTRY.gauge("face_gallery_version", "Gallery version, bumped by every mutation.", lambda: gallery.version)
+REGISTRY.gauge("face_recognition_cache_entries", "Faces in the recognition cache.", recognition_cache.entries)
+REGISTRY.gauge("face_recognition_cache_hits_total", "Recognition cache hits.", lambda: recognition_cache.hits, kind="counter")
+REGISTRY.gauge("face_recognition_cache_misses_total", "Recognition cache misses.", lambda: recognition_cache.misses, kind="counter")
+REGISTRY.gauge("face_recognition_cache_hit_ratio", "Recognition cache hit rate since start.", lambda: recognition_cache.status()["hit_rate"])
+REGISTRY.gauge("face_pool_in_flight", "Requests admitted to a worker pool.", lambda: {"inference": inference_pool.admitted, "io": io_pool.admitted}, label="pool")
+REGISTRY.gauge("face_pool_tasks", "Blocking calls running or queued on a worker pool.", lambda: {"inference": inference_pool.tasks, "io": io_pool.tasks}, label="pool")
+REGISTRY.gauge("face_pool_rejected_total", "Requests and tasks rejected by a saturated pool.", lambda: {"inference": inference_pool.rejected, "io": io_pool.rejected}, label="pool", kind="counter")
+REGISTRY.gauge("face_jobs", "Background jobs by state.", lambda: {k: v for k, v in job_queue.status().items() if k != "processed"}, label="state")
+REGISTRY.gauge("face_jobs_processed_total", "Background jobs completed.", lambda: job_queue.processed, kind="counter")
+REGISTRY.gauge("face_attendance_pending_rows", "Attendance rows waiting to be flushed.", lambda: attendance_writer.status()["pending"])
+REGISTRY.gauge("face_attendance_flush_failures_total", "Failed attendance flushes.", lambda: attendance_writer.failures, kind="counter")
+REGISTRY.gauge("face_attendance_dead_rows", "Attendance rows moved to the dead-letter table after repeated failures.", lambda: attendance_writer.dead)
+REGISTRY.gauge("face_sessions_loaded", "Sessions held in memory.", lambda: session_attendance.status()["sessions"])
+REGISTRY.gauge("face_ws_connections", "Open /ws/recognize connections.", lambda: ws_stats["connections"])
+REGISTRY.gauge("face_ws_frames_total", "Frames received over /ws/recognize.", lambda: ws_stats["frames"], kind="counter")
+REGISTRY.gauge("face_ws_frames_dropped_total", "Stale /ws/recognize frames skipped because a newer one arrived or the server was saturated.", lambda: ws_stats["dropped"], kind="counter")
+
+@app.get("/metrics")
+def metrics_api():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
-# Health check
+# Health check: 200 only once models are warmed, so the load balancer skips cold workers
 @app.get("/")
 def root():
-    return {"message": "Face Attendance Backend is running"}
\ No newline at end of file
+    body = {"message": "Face Attendance Backend is running", "models": model_manager.status(), "gallery": gallery.status(),
+            "pools": {"inference": inference_pool.status(), "io": io_pool.status()}, "jobs": job_queue.status(),
+            "recognition_cache": recognition_cache.status(), "sessions": session_attendance.status(),
+            "attendance_writer": attendance_writer.status(), "cleanup": cleanup_job.status()}
+    if not model_manager.ready:
+        return JSONResponse(status_code=503, content={**body, "message": "Face Attendance Backend is warming up"})
+    return body
\ No newline at end of file
@@ -0,0 +1,223 @@
+#3.Music/face-backend/matcher.py
+# Vectorized cosine matcher over L2-normalized float32 embeddings.
+# Replaces the per-request KNeighborsClassifier: one matrix product scores every
+# gallery sample, argpartition picks the top candidates, and scores are optionally
+# aggregated per USN (each student has up to five samples).
+# With a QuantizedMatrix (quantize.py) the product runs over the compressed codes and the top
+# RERANK samples per query are re-scored exactly before aggregation.
+# With per-student templates (templates.py) queries are first scored against one centroid per
+# student, and only the nearest students' own samples are scored and aggregated. Each student
+# is then accepted at their own threshold, derived from how far apart their samples lie.
+import numpy as np
+from templates import ADAPTIVE_THRESHOLD_MAX, adaptive_thresholds
+
+DISTANCE_THRESHOLD = 0.5  # Facenet512 tuned for real-world classroom use
+AGGREGATIONS = ("best", "mean")
+RERANK = 32
+TEMPLATE_CANDIDATES = 8  # students per query whose samples are scored after the centroid pass
+
+
+def normalize_rows(vectors):
+    """L2-normalize each row of a 2D float32 array (zero rows are left as-is)."""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def top_k(vectors, queries, k=1):
+    """Return (indices, distances) of the k nearest gallery rows for each query, nearest first.
+
+    `vectors` must already be L2-normalized; queries are normalized here. Distances are
+    cosine distances (1 - cosine similarity), the same metric sklearn's 'cosine' uses.
+    """
+    return rank(normalize_rows(queries) @ vectors.T, k)
+
+
+def rank(sims, k=1):
+    """(indices, distances) of the k highest similarities per row of `sims`, nearest first."""
+    k = min(k, sims.shape[1])
+    if k < sims.shape[1]:
+        part = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    else:
+        part = np.broadcast_to(np.arange(sims.shape[1]), (len(sims), sims.shape[1]))
+    part_sims = np.take_along_axis(sims, part, axis=1)
+    order = np.argsort(-part_sims, axis=1, kind="stable")
+    idx = np.take_along_axis(part, order, axis=1)
+    return idx, 1.0 - np.take_along_axis(part_sims, order, axis=1)
+
+
+class Matcher:
+    """Per-USN cosine matcher built from one gallery snapshot.
+
+    Samples are laid out as a padded (students x max_samples) index table so that
+    per-student aggregation is a pure array operation for a whole batch of queries.
+
+    `vectors` may be float16 (a quantized gallery); `quantized` is an optional QuantizedMatrix
+    over the same rows that is scanned instead, with the best `rerank` samples per query
+    re-scored in float32 against `vectors`.
+
+    `templates` (a templates.StudentTemplates covering these students) adds per-student
+    thresholds up to `adaptive_max` and, when there are more than `candidates` students, the
+    centroid pass: match() then only scores the samples of the `candidates` nearest centroids.
+    """
+
+    def __init__(self, vectors, usns, quantized=None, rerank=RERANK, templates=None,
+                 candidates=TEMPLATE_CANDIDATES, adaptive_max=ADAPTIVE_THRESHOLD_MAX):
+        vectors = np.asarray(vectors)
+        self.vectors = vectors if vectors.dtype == np.float16 else np.ascontiguousarray(vectors, dtype=np.float32)
+        self.quantized = quantized
+        self.rerank = rerank
+        self.usns = np.asarray(usns, dtype=object)
+        self.labels, codes = np.unique(self.usns.astype(str), return_inverse=True)
+        codes = codes.reshape(-1)
+        counts = np.bincount(codes, minlength=len(self.labels))
+        self.max_samples = int(counts.max()) if len(counts) else 0
+        # slots[u, j] is the j-th sample of student u, or -1 when the student has fewer samples
+        self.slots = np.full((len(self.labels), self.max_samples), -1, dtype=np.intp)
+        order = np.argsort(codes, kind="stable")
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]]) if len(counts) else counts
+        sorted_codes = codes[order]
+        self.slots[sorted_codes, np.arange(len(order)) - starts[sorted_codes]] = order
+        self.centroids, self.spreads = templates.lookup(self.labels) if templates is not None else (None, None)
+        self.candidates = candidates if templates is not None and 1 < candidates < len(self.labels) else 0
+        self.adaptive_max = adaptive_max
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def search(self, queries, k=1):
+        """Raw top-k over individual samples: (indices, distances, usns)."""
+        idx, dist = rank(self.similarities(queries), k)
+        return idx, dist, self.usns[idx]
+
+    def similarities(self, queries):
+        """Cosine similarity of each query to each sample, shape (queries, samples)."""
+        queries = normalize_rows(queries)
+        if self.quantized is None:
+            return queries @ self.vectors.T
+        sims = self.quantized.scores(queries)
+        if self.quantized.scale is None:
+            return sims  # a float16 scan already reads the stored rows exactly
+        k = min(self.rerank, sims.shape[1])
+        candidates = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        exact = np.einsum("qd,qkd->qk", queries, self.vectors[candidates].astype(np.float32))
+        np.put_along_axis(sims, candidates, exact, axis=1)
+        return sims
+
+    def student_scores(self, queries, aggregate="best", samples=2):
+        """Cosine similarity of each query to each student, shape (queries, students).
+
+        aggregate="best" keeps each student's best sample; "mean" averages the student's
+        top `samples` samples (students with fewer samples average what they have).
+        """
+        if aggregate not in AGGREGATIONS:
+            raise ValueError(f"aggregate must be one of {AGGREGATIONS}, got {aggregate!r}")
+        sims = self.similarities(queries)
+        return self._aggregate(np.where(self.slots >= 0, sims[:, self.slots], -np.inf), aggregate, samples)
+
+    def candidate_scores(self, queries, aggregate="best", samples=2):
+        """Centroid pass, then student_scores() for the `candidates` nearest students only.
+
+        Returns (students, scores), both shaped (queries, candidates): indices into `labels` and
+        each one's aggregated similarity.
+        """
+        if aggregate not in AGGREGATIONS:
+            raise ValueError(f"aggregate must be one of {AGGREGATIONS}, got {aggregate!r}")
+        queries = normalize_rows(queries)
+        students, _ = rank(queries @ self.centroids.T, self.candidates)
+        slots = self.slots[students]  # (queries, candidates, max_samples)
+        sims = np.einsum("qd,qcsd->qcs", queries, self.vectors[np.maximum(slots, 0)].astype(np.float32))
+        return students, self._aggregate(np.where(slots >= 0, sims, -np.inf), aggregate, samples)
+
+    def _aggregate(self, padded, aggregate, samples):
+        if aggregate == "best":
+            return padded.max(axis=2)
+        samples = max(1, min(samples, self.max_samples))
+        top = -np.sort(-padded, axis=2)[:, :, :samples]
+        valid = np.isfinite(top)
+        return np.where(valid, top, 0.0).sum(axis=2) / valid.sum(axis=2)
+
+    def match(self, queries, aggregate="best", samples=2, threshold=DISTANCE_THRESHOLD):
+        """Best student per query with its cosine distance and the margin to the runner-up student.
+
+        Returns one dict per query: usn, distance, runner_up, runner_up_distance, margin,
+        threshold and matched (distance <= threshold). Without templates, and with
+        aggregate="best", the winner and distance are identical to a 1-NN cosine
+        KNeighborsClassifier over the same samples. With templates, `threshold` is the floor of
+        each student's adaptive threshold.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries.reshape(1, -1)
+        if len(self.labels) == 0:
+            return [None] * len(queries)
+        if self.candidates:
+            students, scores = self.candidate_scores(queries, aggregate=aggregate, samples=samples)
+        else:
+            students, scores = None, self.student_scores(queries, aggregate=aggregate, samples=samples)
+        k = min(2, scores.shape[1])
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        best_scores = np.take_along_axis(scores, best, axis=1)
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        best = np.take_along_axis(best, order, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        if students is not None:
+            best = np.take_along_axis(students, best, axis=1)
+        if self.spreads is not None:
+            thresholds = adaptive_thresholds(self.spreads, threshold, self.adaptive_max)
+        else:
+            thresholds = np.full(len(self.labels), threshold)
+        results = []
+        for row in range(len(queries)):
+            distance = float(1.0 - best_scores[row, 0])
+            student_threshold = float(thresholds[best[row, 0]])
+            result = {
+                "usn": str(self.labels[best[row, 0]]),
+                "distance": distance,
+                "runner_up": None,
+                "runner_up_distance": None,
+                "margin": None,
+                "threshold": student_threshold,
+                "matched": distance <= student_threshold,
+            }
+            if k > 1:
+                runner_up_distance = float(1.0 - best_scores[row, 1])
+                result["runner_up"] = str(self.labels[best[row, 1]])
+                result["runner_up_distance"] = runner_up_distance
+                result["margin"] = runner_up_distance - distance
+            results.append(result)
+        return results
+
+
+def match_candidates(distances, usns, threshold=DISTANCE_THRESHOLD, templates=None, adaptive_max=ADAPTIVE_THRESHOLD_MAX):
+    """Turn per-sample top-k candidates (as returned by an ANN index) into match() results.
+
+    The winner is the nearest sample's student; the runner-up is the nearest sample that
+    belongs to a different student, if any made it into the candidate list. With `templates`
+    the winner is accepted at their adaptive threshold, as in Matcher.match().
+    """
+    winners = [row_usns[0] for row_usns in usns if row_usns[0] is not None]
+    thresholds = {}
+    if templates is not None and winners:
+        _, spreads = templates.lookup(winners)
+        thresholds = dict(zip(winners, adaptive_thresholds(spreads, threshold, adaptive_max)))
+    results = []
+    for row_dist, row_usns in zip(distances, usns):
+        if row_usns[0] is None:
+            results.append(None)
+            continue
+        distance = float(row_dist[0])
+        student_threshold = float(thresholds.get(row_usns[0], threshold))
+        result = {"usn": str(row_usns[0]), "distance": distance, "runner_up": None, "runner_up_distance": None,
+                  "margin": None, "threshold": student_threshold, "matched": distance <= student_threshold}
+        for d, usn in zip(row_dist[1:], row_usns[1:]):
+            if usn is not None and usn != row_usns[0]:
+                result["runner_up"] = str(usn)
+                result["runner_up_distance"] = float(d)
+                result["margin"] = float(d) - distance
+                break
+        results.append(result)
+    return results
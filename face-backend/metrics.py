@@ -0,0 +1,131 @@
+#3.Music/face-backend/metrics.py
+# In-process metrics in the Prometheus text exposition format, served by GET /metrics.
+# Latency histograms are filled as requests run, through `stage(name)` spans around each
+# pipeline step and a middleware that times every request. Gauges (gallery size, cache hit
+# rates, queue depths, ...) are callbacks that are read at scrape time, so the hot path never
+# updates them.
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram with a fixed set of label names."""
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+
+    def mean(self):
+        """{label values: mean observed value}."""
+        with self._lock:
+            return {key: series[-1] / series[-2] for key, series in self._series.items() if series[-2]}
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        names = self.labelnames + ("le",)
+        for key in sorted(series):
+            values = series[key]
+            for bound, count in zip(self.buckets, values):
+                lines.append(f"{self.name}_bucket{_labels(names, key + (repr(bound),))} {count}")
+            lines.append(f"{self.name}_bucket{_labels(names, key + ('+Inf',))} {values[-2]}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {values[-2]}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {values[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.histograms = []
+        self.gauges = []
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        histogram = Histogram(name, help, labelnames, buckets)
+        self.histograms.append(histogram)
+        return histogram
+
+    def gauge(self, name, help, fn, label=None, kind="gauge"):
+        """Register a value read at scrape time. `fn` returns a number, or {label value: number} with `label`."""
+        self.gauges.append((name, help, fn, label, kind))
+
+    def render(self):
+        lines = []
+        for histogram in self.histograms:
+            lines.extend(histogram.render())
+        for name, help, fn, label, kind in self.gauges:
+            try:
+                value = fn()
+            except Exception:
+                continue
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            values = value if label else {None: value}
+            for label_value, v in values.items():
+                if v is None:
+                    continue
+                labels = _labels((label,), (label_value,)) if label else ""
+                lines.append(f"{name}{labels} {float(v)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram("face_stage_seconds", "Latency of one pipeline stage.", ["stage"])
+REQUEST_SECONDS = REGISTRY.histogram("face_request_seconds", "End-to-end HTTP request latency.", ["endpoint", "method", "code"])
+
+
+def stage(name):
+    """Context manager timing one pipeline stage into face_stage_seconds{stage=name}."""
+    return STAGE_SECONDS.time(stage=name)
+
+
+def timed(name):
+    """Decorator form of stage()."""
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,132 @@
+#3.Music/face-backend/models.py
+# Builds the face detectors and the Facenet512 network once per worker and warms them up,
+# so the first teacher's scan after a deploy does not pay for model construction and the
+# first TensorFlow graph build. DeepFace caches built models process-wide; running one
+# inference per detector here is what fills that cache.
+import logging
+import threading
+import time
+import numpy as np
+from metrics import timed
+
+MODEL_NAME = "Facenet512"
+RECOGNIZE_DETECTOR = "opencv"  # DeepFace's default, used by /recognize
+REGISTER_DETECTOR = "retinaface"  # stricter detector used at enrolment
+log = logging.getLogger(__name__)
+
+
+def _deepface():
+    # Imported on first use: TensorFlow is slow to import and not needed by code that only uses
+    # this module's constants or swaps in a stub embedder (benchmarks/bench_pipeline.py)
+    from deepface import DeepFace
+    return DeepFace
+
+
+class ModelManager:
+    """Owns model construction/warm-up and reports readiness for the health endpoint."""
+
+    def __init__(self, model_name=MODEL_NAME, detectors=(RECOGNIZE_DETECTOR, REGISTER_DETECTOR)):
+        self.model_name = model_name
+        self.detectors = tuple(detectors)
+        self.state = "cold"  # cold -> warming -> ready | failed
+        self.error = None
+        self.timings = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    def load(self):
+        """Build every model and run one warm-up inference per detector (blocking, idempotent)."""
+        with self._lock:
+            if self.state in ("warming", "ready"):
+                return self.ready
+            self.state = "warming"
+        try:
+            t0 = time.time()
+            _deepface().build_model(self.model_name)
+            self.timings["build_model"] = round(time.time() - t0, 3)
+            warmup = synthetic_face_image()
+            for detector in self.detectors:
+                t1 = time.time()
+                _deepface().represent(img_path=warmup, model_name=self.model_name,
+                                      detector_backend=detector, enforce_detection=False)
+                self.timings[f"warmup_{detector}"] = round(time.time() - t1, 3)
+            self.timings["total"] = round(time.time() - t0, 3)
+            self.state = "ready"
+            log.info(f"{self.model_name} ready with detectors {self.detectors}: {self.timings}")
+        except Exception as e:
+            self.state, self.error = "failed", str(e)
+            log.error(f"Warm-up failed: {e}")
+        return self.ready
+
+    def load_in_background(self):
+        """Start load() on a daemon thread so the server can answer health checks while warming."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.load, name="model-warmup", daemon=True)
+            self._thread.start()
+        return self._thread
+
+    @timed("detect_embed")
+    def represent(self, img, detector_backend=RECOGNIZE_DETECTOR, enforce_detection=True):
+        """DeepFace.represent with this manager's model; `img` may be a path or a BGR array."""
+        return _deepface().represent(img_path=img, model_name=self.model_name,
+                                     detector_backend=detector_backend, enforce_detection=enforce_detection)
+
+    @timed("detect")
+    def detect_faces(self, img, detector_backend=RECOGNIZE_DETECTOR, enforce_detection=False):
+        """Every face DeepFace finds in `img`: dicts with "face" (aligned RGB floats in [0, 1]),
+        "facial_area" and "confidence". Returns [] when there is no face, or raises DeepFace's
+        ValueError when `enforce_detection` is set."""
+        try:
+            return _deepface().extract_faces(img_path=img, detector_backend=detector_backend,
+                                             enforce_detection=True, align=True)
+        except ValueError:
+            if enforce_detection:
+                raise
+            return []
+
+    @timed("embed")
+    def embed_faces(self, faces):
+        """Facenet512 embeddings for already-detected faces, in one batched forward pass.
+
+        Applies the same preprocessing DeepFace.represent does for a single face (RGB->BGR,
+        padded resize to the model input, "base" normalization). Falls back to one
+        represent(detector_backend="skip") call per face on DeepFace builds whose
+        internals differ.
+        """
+        if len(faces) == 0:
+            return np.empty((0, 512), dtype=np.float32)
+        try:
+            from deepface.modules import preprocessing
+            model = _deepface().build_model(self.model_name)
+            target = (model.input_shape[1], model.input_shape[0])
+            batch = np.concatenate([
+                preprocessing.normalize_input(preprocessing.resize_image(face[:, :, ::-1], target), normalization="base")
+                for face in faces
+            ])
+            return np.asarray(model.model(batch, training=False), dtype=np.float32)
+        except (ImportError, AttributeError, TypeError) as e:
+            log.warning(f"Batched embedding unavailable ({e}), embedding faces one by one")
+        embeddings = []
+        for face in faces:
+            bgr = (face[:, :, ::-1] * 255).astype(np.uint8)
+            embeddings.append(self.represent(bgr, detector_backend="skip", enforce_detection=False)[0]["embedding"])
+        return np.asarray(embeddings, dtype=np.float32)
+
+    def status(self):
+        return {"state": self.state, "ready": self.ready, "model": self.model_name,
+                "detectors": list(self.detectors), "timings": self.timings, "error": self.error}
+
+
+def synthetic_face_image(size=224):
+    """A smooth face-like BGR image (light oval, darker eyes and mouth) to drive the warm-up pass."""
+    yy, xx = np.mgrid[0:size, 0:size].astype(np.float32) / size
+    img = np.full((size, size, 3), 60, dtype=np.uint8)
+    face = ((xx - 0.5) / 0.32) ** 2 + ((yy - 0.5) / 0.42) ** 2 <= 1
+    img[face] = (150, 175, 205)
+    for cx, cy, rx, ry in ((0.38, 0.42, 0.05, 0.03), (0.62, 0.42, 0.05, 0.03), (0.5, 0.68, 0.1, 0.03)):
+        img[((xx - cx) / rx) ** 2 + ((yy - cy) / ry) ** 2 <= 1] = (40, 40, 70)
+    return img
@@ -0,0 +1,98 @@
+#3.Music/face-backend/quantize.py
+# Compact embedding representations.
+#
+# On the wire and in the database: face_embeddings.embedding_q (bytea) holds the L2-normalized
+# embedding as little-endian float16, 1 KB per Facenet512 vector instead of ~10 KB of JSON.
+# PostgREST returns bytea as "\x<hex>", so a page of rows decodes with one bytes.fromhex per row
+# and a single np.frombuffer over the joined buffer. No Python float lists are ever built.
+#
+# In memory: QuantizedMatrix is what the matcher scans. "float16" scans the stored rows as they
+# are; "int8" adds a 1-byte-per-dimension code with a per-dimension scale. Scores are computed
+# block by block in float32, so only one block is ever widened at a time.
+#
+#   alter table face_embeddings add column embedding_q bytea;
+#   python quantize.py backfill      # fill embedding_q for rows that only have the JSON embedding
+import sys
+import numpy as np
+from matcher import normalize_rows
+
+CODECS = ("float16", "int8")
+WIRE_DTYPE = np.dtype("<f2")
+SCAN_BLOCK = 8192  # gallery rows widened to float32 at a time while scanning
+
+
+def encode_embedding(embedding):
+    """bytea literal ("\\x<hex>") for embedding_q: the normalized embedding as float16."""
+    return "\\x" + normalize_rows(embedding)[0].astype(WIRE_DTYPE).tobytes().hex()
+
+
+def decode_embeddings(values, dim):
+    """(n, dim) float16 array from embedding_q values; a view over one joined buffer."""
+    if not values:
+        return np.empty((0, dim), dtype=WIRE_DTYPE)
+    buffer = b"".join(bytes.fromhex(v[2:] if v.startswith("\\x") else v) for v in values)
+    return np.frombuffer(buffer, dtype=WIRE_DTYPE).reshape(-1, dim)
+
+
+class QuantizedMatrix:
+    """Scan-only compressed copy of a normalized gallery matrix.
+
+    `scores(queries)` approximates `queries @ vectors.T`. With "int8" each dimension d is stored
+    as round(v[d] / scale[d]) and the scale is folded into the query, so the scan is one
+    float32 product per block of codes.
+    """
+
+    def __init__(self, vectors, codec="int8"):
+        if codec not in CODECS:
+            raise ValueError(f"codec must be one of {CODECS}, got {codec!r}")
+        self.codec = codec
+        if codec == "float16":
+            self.codes = vectors if vectors.dtype == np.float16 else vectors.astype(np.float16)
+            self.scale = None
+        else:
+            peak = np.abs(vectors).max(axis=0).astype(np.float32) if len(vectors) else np.ones(vectors.shape[1], np.float32)
+            self.scale = np.maximum(peak, 1e-6) / 127.0
+            self.codes = np.empty(vectors.shape, dtype=np.int8)
+            for start in range(0, len(vectors), SCAN_BLOCK):
+                block = vectors[start:start + SCAN_BLOCK].astype(np.float32) / self.scale
+                self.codes[start:start + SCAN_BLOCK] = np.clip(np.rint(block), -127, 127)
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.scale.nbytes if self.scale is not None else 0)
+
+    def scores(self, queries):
+        """Approximate cosine similarities, shape (queries, rows); `queries` must be normalized."""
+        queries = queries if self.scale is None else queries * self.scale
+        sims = np.empty((len(queries), len(self.codes)), dtype=np.float32)
+        for start in range(0, len(self.codes), SCAN_BLOCK):
+            block = self.codes[start:start + SCAN_BLOCK]
+            sims[:, start:start + len(block)] = queries @ block.astype(np.float32).T
+        return sims
+
+
+def backfill(client, page_size=500):
+    """Fill embedding_q for every row that only has the JSON embedding; returns rows updated."""
+    updated = 0
+    while True:
+        rows = (client.table("face_embeddings").select("id, embedding").is_("embedding_q", "null")
+                .not_.is_("embedding", "null").order("id").limit(page_size).execute().data)
+        if not rows:
+            return updated
+        for row in rows:
+            client.table("face_embeddings").update({"embedding_q": encode_embedding(row["embedding"])}).eq("id", row["id"]).execute()
+        updated += len(rows)
+        print(f"[QUANTIZE] Backfilled {updated} rows")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["backfill"]:
+        sys.exit("usage: python quantize.py backfill")
+    import os
+    from dotenv import load_dotenv
+    from supabase import create_client
+    load_dotenv()
+    backfill(create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY")))
@@ -0,0 +1,76 @@
+import numpy as np
+from ann_index import BruteForceIndex, IVFIndex, open_index, saved_index_dir
+from matcher import normalize_rows
+from test_matcher import make_gallery
+
+
+def make_rows(students=40, samples=5, dim=32):
+    vectors, usns, queries = make_gallery(students=students, samples=samples, dim=dim)
+    ids = np.array([f"row{i}" for i in range(len(vectors))], dtype=object)
+    return ids, usns, normalize_rows(vectors), queries
+
+
+def test_ivf_agrees_with_exact_search():
+    ids, usns, vectors, queries = make_rows()
+    ivf, exact = IVFIndex(dim=32, nlist=8, nprobe=8), BruteForceIndex(dim=32)
+    ivf.build(ids, usns, vectors)
+    exact.build(ids, usns, vectors)
+    # Probing every cell makes the inverted file exhaustive
+    assert np.array_equal(ivf.search(queries, k=3)[2], exact.search(queries, k=3)[2])
+
+
+def test_removed_rows_are_never_returned():
+    ids, usns, vectors, _ = make_rows()
+    index = IVFIndex(dim=32, nlist=8, nprobe=8)
+    index.build(ids, usns, vectors)
+    assert index.remove(["row0", "row1", "missing"]) == 2
+    _, found_usns, found_ids = index.search(vectors[:2], k=5)
+    assert not {"row0", "row1"} & set(found_ids.ravel().tolist())
+    assert found_usns[0, 0] == usns[2]  # the student's next sample
+    assert len(index) == len(ids) - 2
+
+
+def test_save_load_sync_round_trip(tmp_path):
+    ids, usns, vectors, queries = make_rows()
+    index = IVFIndex(dim=32, nlist=8, nprobe=8)
+    index.build(ids[:150], usns[:150], vectors[:150])
+    index.remove(["row3"])
+    index.save(str(tmp_path))
+    loaded = open_index(str(tmp_path), kind="ivf", dim=32, nprobe=4)
+    assert isinstance(loaded, IVFIndex) and loaded.nprobe == 4 and not loaded.needs_retrain()
+    assert sorted(loaded.row_ids()) == sorted(set(ids[:150]) - {"row3"})
+    # The saved index is memory-mapped; sync copies it on the first add and only applies the difference
+    keep = np.array([i not in ("row5", "row6") for i in ids])
+    assert loaded.sync(ids[keep], usns[keep], vectors[keep]) == (2, 51)
+    assert sorted(loaded.row_ids()) == sorted(ids[keep].tolist())
+    loaded.nprobe = 8
+    exact = BruteForceIndex(dim=32)
+    exact.build(ids[keep], usns[keep], vectors[keep])
+    assert np.array_equal(loaded.search(queries, k=3)[2], exact.search(queries, k=3)[2])
+
+
+def test_open_index_falls_back_to_a_fresh_index(tmp_path):
+    assert isinstance(open_index(str(tmp_path), kind="exact", dim=32), BruteForceIndex)
+    fresh = open_index(str(tmp_path / "missing"), kind="ivf", dim=32)
+    assert isinstance(fresh, IVFIndex) and fresh.needs_retrain()
+    index = IVFIndex(dim=16, nlist=2)
+    index.build(*make_rows(students=4, dim=16)[:3])
+    index.save(str(tmp_path))
+    assert len(open_index(str(tmp_path), kind="ivf", dim=32)) == 0  # saved with another dimension
+
+
+def test_a_torn_save_keeps_the_previous_index_or_falls_back(tmp_path):
+    ids, usns, vectors, _ = make_rows()
+    index = IVFIndex(dim=32, nlist=8)
+    index.build(ids[:100], usns[:100], vectors[:100])
+    index.save(str(tmp_path))
+    first = saved_index_dir(str(tmp_path))
+    index.add(ids[100:], usns[100:], vectors[100:])
+    index.save(str(tmp_path))
+    assert saved_index_dir(str(tmp_path)) != first and not (tmp_path / first).exists()
+    assert len(open_index(str(tmp_path), kind="ivf", dim=32)) == len(ids)
+    # Files from different saves no longer line up: load refuses them instead of failing in search
+    current = saved_index_dir(str(tmp_path))
+    np.save(f"{current}/ids.npy", np.asarray(ids[:100]))
+    fresh = open_index(str(tmp_path), kind="ivf", dim=32)
+    assert len(fresh) == 0 and fresh.needs_retrain()
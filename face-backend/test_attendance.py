@@ -0,0 +1,104 @@
+import numpy as np
+from attendance import AttendanceWriter, SessionAttendance
+from caches import RecognitionCache
+
+
+def test_reload_sees_undo_and_keeps_unflushed_rows():
+    rows = [{"student_id": "a", "check_in": "09:00", "check_out": None}]
+    pending = [{"session_id": "s1", "student_id": "b", "check_in": "09:05"}]
+    cleared = []
+    sessions = SessionAttendance(lambda session_id: rows, refresh=0.0, pending=lambda session_id: pending,
+                                 on_cleared=lambda *args: cleared.append(args))
+    sessions.load("s1")
+    assert sessions.is_marked("s1", "a", "check-in") and sessions.is_marked("s1", "b", "check-in")
+    assert not sessions.is_fresh("s1")  # refresh=0: every scan reloads
+    rows[0]["check_in"] = None  # the teacher page undid the check-in
+    sessions.ensure_fresh("s1")
+    assert not sessions.is_marked("s1", "a", "check-in")
+    assert sessions.is_marked("s1", "b", "check-in")
+    assert cleared == [("s1", "check-in", {"a"})]
+
+
+def test_undo_clears_cached_recognitions():
+    cache = RecognitionCache()
+    face = np.ones(512, dtype=np.float32)
+    cache.store("s1", "check-in", face, student_uuid="a", usn="USN1")
+    rows = [{"student_id": "a", "check_in": "09:00"}]
+    sessions = SessionAttendance(lambda session_id: rows, on_cleared=cache.forget)
+    sessions.load("s1")
+    assert sessions.is_fresh("s1")
+    rows.clear()
+    sessions.load("s1")
+    assert cache.lookup("s1", "check-in", face) is None
+
+
+class FakeUpsert:
+    """Records bulk upserts; rows for students in `bad` make the whole call fail."""
+
+    def __init__(self, bad=()):
+        self.bad = set(bad)
+        self.calls = []
+        self.rows = {}
+
+    def __call__(self, payloads):
+        self.calls.append(len(payloads))
+        if any(p["student_id"] in self.bad for p in payloads):
+            raise RuntimeError("violates foreign key constraint")
+        for payload in payloads:
+            self.rows[(payload["session_id"], payload["student_id"])] = payload
+
+
+def payload(student_id, session_id="s1", **stamps):
+    return {"session_id": session_id, "student_id": student_id, **stamps}
+
+
+def test_rows_coalesce_and_the_first_check_in_wins(tmp_path):
+    upsert = FakeUpsert()
+    writer = AttendanceWriter(str(tmp_path / "journal.sqlite3"), upsert)
+    writer.submit(payload("a", check_in="09:00"))
+    writer.submit(payload("a", check_in="09:01"))
+    writer.submit(payload("a", check_out="10:00"))
+    writer.submit(payload("b", check_out="10:00"))
+    assert writer.pending("s1") == [payload("a", check_in="09:00", check_out="10:00"), payload("b", check_out="10:00")]
+    assert writer.flush() == 2
+    # Rows with different columns go in separate upserts, so b's missing check_in is not written as NULL
+    assert sorted(upsert.calls) == [1, 1]
+    assert upsert.rows[("s1", "a")] == payload("a", check_in="09:00", check_out="10:00")
+    assert writer.status()["pending"] == 0
+
+
+def test_journal_is_replayed_after_a_restart(tmp_path):
+    path = str(tmp_path / "journal.sqlite3")
+    AttendanceWriter(path, FakeUpsert(bad={"a"})).submit(payload("a", check_in="09:00"))
+    upsert = FakeUpsert()
+    writer = AttendanceWriter(path, upsert)
+    assert writer.status()["pending"] == 1
+    assert writer.flush() == 1
+    assert upsert.rows == {("s1", "a"): payload("a", check_in="09:00")}
+    assert AttendanceWriter(path, upsert).status()["pending"] == 0
+
+
+def test_a_bad_row_only_holds_back_itself_then_goes_to_dead_letters(tmp_path):
+    path = str(tmp_path / "journal.sqlite3")
+    upsert = FakeUpsert(bad={"gone"})
+    writer = AttendanceWriter(path, upsert, max_attempts=3, backoff=0.0)
+    for student_id in ("a", "gone", "b"):
+        writer.submit(payload(student_id, check_in="09:00"))
+    assert writer.flush() == 2
+    assert set(upsert.rows) == {("s1", "a"), ("s1", "b")}
+    assert writer.status()["retrying"] == 1 and writer.status()["pending"] == 1
+    assert writer.flush() == 0
+    assert AttendanceWriter(path, upsert).status()["pending"] == 1  # the attempt count survives a restart too
+    assert writer.flush() == 0
+    assert writer.status() == {"pending": 0, "retrying": 0, "flushed": 2, "failures": 3, "dead": 1}
+    assert AttendanceWriter(path, upsert).dead == 1
+
+
+def test_failed_rows_back_off(tmp_path):
+    upsert = FakeUpsert(bad={"a"})
+    writer = AttendanceWriter(str(tmp_path / "journal.sqlite3"), upsert, backoff=60.0)
+    writer.submit(payload("a", check_in="09:00"))
+    assert writer.flush() == 0
+    calls = len(upsert.calls)
+    assert writer.flush() == 0
+    assert len(upsert.calls) == calls  # not retried before its backoff has passed
@@ -0,0 +1,42 @@
+import numpy as np
+from caches import RecognitionCache
+from matcher import normalize_rows
+
+
+def perturbed(embedding, distance, rng):
+    """A unit vector at roughly `distance` cosine distance from `embedding`."""
+    noise = normalize_rows(rng.standard_normal(embedding.shape))[0]
+    noise -= (noise @ embedding) * embedding
+    noise /= np.linalg.norm(noise)
+    angle = np.arccos(1.0 - distance)
+    return np.cos(angle) * embedding + np.sin(angle) * noise
+
+
+def test_near_identical_frames_hit_and_other_faces_miss():
+    rng = np.random.default_rng(0)
+    cache = RecognitionCache()
+    alice, bob = normalize_rows(rng.standard_normal((2, 512)))
+    cache.store("s1", "check-in", alice, usn="ALICE")
+    cache.store("s1", "check-in", bob, usn="BOB")
+    for distance in (0.005, 0.019, 0.042, 0.15):
+        assert cache.lookup("s1", "check-in", perturbed(alice, distance, rng))["usn"] == "ALICE"
+    assert cache.lookup("s1", "check-in", perturbed(bob, 0.02, rng))["usn"] == "BOB"
+    assert cache.lookup("s1", "check-in", normalize_rows(rng.standard_normal(512))[0]) is None
+    assert cache.lookup("s1", "check-out", alice) is None
+    assert cache.lookup("s2", "check-in", alice) is None
+    assert cache.status()["hits"] == 5
+
+
+def test_entries_expire_and_tables_are_bounded():
+    rng = np.random.default_rng(1)
+    cache = RecognitionCache(ttl=0.0, faces=3)
+    face = normalize_rows(rng.standard_normal(512))[0]
+    cache.store("s1", "check-in", face, usn="A")
+    assert cache.lookup("s1", "check-in", face) is None
+    cache = RecognitionCache(faces=3)
+    faces = normalize_rows(rng.standard_normal((5, 512)))
+    for i, face in enumerate(faces):
+        cache.store("s1", "check-in", face, usn=str(i))
+    assert cache.entries() == 3
+    assert cache.lookup("s1", "check-in", faces[0]) is None
+    assert cache.lookup("s1", "check-in", faces[4])["usn"] == "4"
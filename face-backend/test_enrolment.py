@@ -0,0 +1,50 @@
+import cv2
+import numpy as np
+from bench_pipeline import CLASS_NAME, SUBJECT
+from enroll import BulkWriter
+from enrolment import analyse_image
+from fake_supabase import FakeSupabase
+from workers import WorkerPool
+
+
+class WholeImageDetector:
+    """Detects one face covering the whole image, like a detector on a tight crop."""
+
+    def detect_faces(self, img, detector_backend=None, enforce_detection=True):
+        h, w = img.shape[:2]
+        return [{"face": img, "facial_area": {"x": 0, "y": 0, "w": w, "h": h}, "confidence": 1.0}]
+
+
+def png(size, seed=0):
+    img = np.random.default_rng(seed).integers(0, 256, (size, size, 3), dtype=np.uint8)
+    return cv2.imencode(".png", img)[1].tobytes()
+
+
+def test_face_size_is_checked_on_the_detector_box():
+    small = analyse_image(WholeImageDetector(), "small.png", png(60))
+    assert (small["ok"], small["reason"]) == (False, "face-too-small")
+    assert small["facial_area"]["w"] == 60
+    assert analyse_image(WholeImageDetector(), "large.png", png(120))["ok"]
+
+
+def test_register_fans_out_past_the_pool_queue_bound(backend, monkeypatch):
+    main, client, _ = backend
+    pool = WorkerPool("inference", workers=1, queue_depth=2)
+    monkeypatch.setattr(main, "inference_pool", pool)
+    files = [("files", (f"{i}.png", png(200, seed=i), "image/png")) for i in range(5)]
+    form = {"usn": "FANOUT01", "name": "Fan Out", "class_": CLASS_NAME, "subjects": [SUBJECT]}
+    response = client.post("/register", data=form, files=files)
+    pool.shutdown()
+    assert response.status_code == 200
+    assert len(response.json()["image_urls"]) == 5, response.json()["warnings"]
+    assert pool.rejected == 0
+
+
+def test_bulk_import_keeps_image_urls_of_students_without_a_usable_image(tmp_path):
+    fake = FakeSupabase()
+    fake.tables["students"] = [{"id": "s1", "usn": "USN001", "name": "One", "image_urls": ["old.jpg"]}]
+    writer = BulkWriter(fake, str(tmp_path / "checkpoint.jsonl"))
+    writer.add({"usn": "USN001", "name": "One"}, [], {"usn": "USN001"})
+    writer.add({"usn": "USN002", "name": "Two", "image_urls": ["new.jpg"]}, [], {"usn": "USN002"})
+    writer.flush()
+    assert {r["usn"]: r.get("image_urls") for r in fake.tables["students"]} == {"USN001": ["old.jpg"], "USN002": ["new.jpg"]}
@@ -0,0 +1,109 @@
+import numpy as np
+from ann_index import IVFIndex, open_index
+from gallery import EmbeddingGallery
+from quantize import encode_embedding
+from test_matcher import make_gallery
+
+
+def make_rows(students=12, samples=4, dim=32, seed=1):
+    vectors, usns, _ = make_gallery(students=students, samples=samples, dim=dim, seed=seed)
+    return [{"id": f"row{i}", "usn": usn, "embedding": vector.tolist()} for i, (usn, vector) in enumerate(zip(usns, vectors))]
+
+
+def make_students(students=12):
+    return [{"id": f"id{i}", "usn": f"USN{i:03d}", "class": "A" if i % 2 else "B", "subjects": None} for i in range(students)]
+
+
+def test_mutations_match_a_rebuilt_gallery():
+    rows = make_rows()
+    gallery = EmbeddingGallery(dim=32)
+    gallery.load(rows[:24])
+    gallery.add_many([r["id"] for r in rows[24:]], [r["usn"] for r in rows[24:]], [r["embedding"] for r in rows[24:]])
+    removed = [r["id"] for r in rows[::3]]
+    assert gallery.remove(removed + ["missing"]) == len(removed)
+    kept = [r for r in rows if r["id"] not in removed]
+    rebuilt = EmbeddingGallery(dim=32)
+    rebuilt.load(kept)
+    assert len(gallery) == len(kept)
+    assert list(gallery.ids) == [r["id"] for r in kept]
+    assert np.allclose(gallery.vectors, rebuilt.vectors)
+    queries = np.array([r["embedding"] for r in rows[1::3]])
+    assert [m["usn"] for m in gallery.match(queries)] == [m["usn"] for m in rebuilt.match(queries)]
+    assert gallery.status()["templates"] == rebuilt.status()["templates"]
+
+
+def test_snapshot_survives_later_mutations():
+    rows = make_rows()
+    gallery = EmbeddingGallery(dim=32)
+    gallery.load(rows[:8])
+    vectors, usns, ids, _ = gallery.snapshot()
+    before = vectors.copy()
+    gallery.remove([r["id"] for r in rows[:6]])
+    for row in rows[8:]:
+        gallery.add(row["id"], row["usn"], row["embedding"])
+    assert np.array_equal(vectors, before)
+    assert list(ids) == [r["id"] for r in rows[:8]]
+    assert len(gallery) == len(rows) - 6
+
+
+def test_mutation_only_rebuilds_the_touched_class():
+    rows = make_rows()
+    gallery = EmbeddingGallery(dim=32)
+    gallery.load(rows)
+    gallery.set_students(make_students())
+    class_a, class_b = gallery.partition("A"), gallery.partition("B")
+    gallery.add("new", "USN001", rows[0]["embedding"])  # USN001 is in class A
+    assert gallery.partition("B") is class_b
+    assert gallery.partition("A") is not class_a
+    assert "USN001" in gallery.partition("A").labels
+    gallery.upsert_student("USN001", "B", None)
+    assert gallery.partition("B") is not class_b
+    assert "USN001" not in gallery.partition("A").labels
+
+
+def test_index_rebuild_runs_outside_the_lock_and_keeps_concurrent_mutations(tmp_path):
+    rows = make_rows()
+    gallery = EmbeddingGallery(dim=32, index=IVFIndex(dim=32, nlist=4, nprobe=4), index_path=str(tmp_path), ann_min_size=1)
+    fresh = gallery.index.fresh
+
+    def fresh_index():
+        index = fresh()
+        build = index.build
+
+        def build_while_mutating(*args):
+            assert gallery._lock.acquire(timeout=1)
+            gallery._lock.release()
+            gallery.remove(["row0"])
+            gallery.add("late", "USN011", rows[0]["embedding"])
+            build(*args)
+        index.build = build_while_mutating
+        return index
+    gallery.index.fresh = fresh_index
+    gallery.load(rows)
+    assert sorted(gallery.index.row_ids()) == sorted([r["id"] for r in rows[1:]] + ["late"])
+    assert gallery.match(np.array([rows[0]["embedding"]]))[0]["usn"] == "USN011"
+    assert gallery.save_index()
+    assert sorted(open_index(str(tmp_path), kind="ivf", dim=32).row_ids()) == sorted(gallery.index.row_ids())
+
+
+def test_quantized_gallery_stores_float16_whatever_the_row_format():
+    rows = make_rows()
+    packed = [{**r, "embedding_q": encode_embedding(r["embedding"])} for r in rows[:8]]
+    for loaded in (rows, packed, packed + rows[8:]):
+        gallery = EmbeddingGallery(dim=32, quantization="float16")
+        gallery.load(loaded)
+        assert gallery.vectors.dtype == np.float16 and len(gallery) == len(loaded)
+        assert gallery.match(np.array([rows[1]["embedding"]]))[0]["usn"] == rows[1]["usn"]
+
+
+def test_quantized_scan_is_only_built_without_a_centroid_pass():
+    rows = make_rows()
+    queries = np.array([r["embedding"] for r in rows[::4]])
+    results = {}
+    for candidates in (0, 4):
+        gallery = EmbeddingGallery(dim=32, quantization="int8", template_candidates=candidates)
+        gallery.load(rows)
+        matcher = gallery.matcher()
+        assert (matcher.quantized is None) == bool(candidates)
+        results[candidates] = [m["usn"] for m in gallery.match(queries)]
+    assert results[0] == results[4]
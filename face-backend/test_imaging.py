@@ -0,0 +1,28 @@
+import pytest
+from imaging import parse_face_box
+
+SHAPE = (480, 640, 3)
+
+
+@pytest.mark.parametrize("value, expected", [
+    ('{"x": 100, "y": 50, "w": 120, "h": 140}', {"x": 100, "y": 50, "w": 120, "h": 140}),
+    ('{"x": 10.4, "y": 20.6, "width": 80, "height": 90}', {"x": 10, "y": 20, "w": 80, "h": 90}),
+    ("[0, 0, 640, 480]", {"x": 0, "y": 0, "w": 640, "h": 480}),
+    ({"x": 600, "y": 0, "w": 45, "h": 60}, {"x": 600, "y": 0, "w": 40, "h": 60}),  # clipped at the border
+])
+def test_accepts_boxes_inside_the_frame(value, expected):
+    assert parse_face_box(value, SHAPE) == expected
+
+
+@pytest.mark.parametrize("value, message", [
+    ("not json", "Malformed"),
+    ('{"x": 1, "y": 2}', "Malformed"),
+    ("[1, 2, 3]", "Malformed"),
+    ('{"x": 0, "y": 0, "w": 30, "h": 80}', "at least"),
+    ('{"x": 0, "y": 0, "w": NaN, "h": 80}', "at least"),
+    ('{"x": 620, "y": 0, "w": 100, "h": 100}', "outside"),
+    ('{"x": -500, "y": -500, "w": 100, "h": 100}', "outside"),
+])
+def test_rejects_malformed_small_or_offscreen_boxes(value, message):
+    with pytest.raises(ValueError, match=message):
+        parse_face_box(value, SHAPE)
@@ -0,0 +1,24 @@
+from jobs import JobQueue
+
+
+def test_restart_requeues_running_jobs_unless_superseded(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    queue = JobQueue(path)
+    queue.enqueue("rotate", {"n": 1}, dedup_key="USN001")
+    queue.enqueue("rotate", {"n": 1}, dedup_key="USN002")
+    queue.enqueue("rotate", {"n": 1})
+    for _ in range(3):
+        assert queue._claim()
+    # The process dies while these run; newer jobs for USN001 were queued and claimed meanwhile
+    queue.enqueue("rotate", {"n": 2}, dedup_key="USN001")
+    assert queue._claim()
+    queue.enqueue("rotate", {"n": 3}, dedup_key="USN001")
+    queue._conn.close()
+
+    seen = []
+    restarted = JobQueue(path, handlers={"rotate": lambda payload, blob: seen.append(payload["n"])})
+    assert restarted.status()["pending"] == 3
+    while restarted.run_once():
+        pass
+    assert sorted(seen) == [1, 1, 3]
+    assert restarted.status() == {"pending": 0, "running": 0, "failed": 0, "processed": 3}
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+from sklearn.neighbors import KNeighborsClassifier
+from matcher import Matcher, normalize_rows, top_k
+from quantize import QuantizedMatrix, decode_embeddings, encode_embedding
+from templates import StudentTemplates
+
+
+def make_gallery(students=40, samples=5, dim=512, seed=1):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((students, dim)).astype(np.float32)
+    labels = np.repeat(np.arange(students), samples)
+    vectors = centers[labels] + 0.4 * rng.standard_normal((len(labels), dim)).astype(np.float32)
+    usns = np.array([f"USN{l:03d}" for l in labels], dtype=object)
+    queries = centers + 0.4 * rng.standard_normal(centers.shape).astype(np.float32)
+    return vectors, usns, queries
+
+
+def test_best_match_agrees_with_sklearn_cosine_knn():
+    vectors, usns, queries = make_gallery()
+    knn = KNeighborsClassifier(n_neighbors=1, metric='cosine').fit(vectors, usns)
+    dist, _ = knn.kneighbors(queries, n_neighbors=1, return_distance=True)
+    expected = knn.predict(queries)
+    results = Matcher(normalize_rows(vectors), usns).match(queries)
+    assert [r["usn"] for r in results] == list(expected)
+    assert np.allclose([r["distance"] for r in results], dist[:, 0], atol=1e-5)
+    assert all(r["matched"] == (r["distance"] <= 0.5) for r in results)
+
+
+def test_runner_up_margin_and_mean_aggregation():
+    vectors, usns, queries = make_gallery(students=3, samples=2, dim=8)
+    matcher = Matcher(normalize_rows(vectors), usns)
+    for result in matcher.match(queries, aggregate="mean", samples=2):
+        assert result["runner_up"] != result["usn"]
+        assert result["margin"] == pytest.approx(result["runner_up_distance"] - result["distance"])
+        assert result["margin"] >= 0
+    with pytest.raises(ValueError):
+        matcher.match(queries, aggregate="median")
+
+
+def test_top_k_orders_nearest_first():
+    vectors = normalize_rows(np.eye(4, dtype=np.float32))
+    idx, dist = top_k(vectors, [[0.9, 0.1, 0, 0]], k=2)
+    assert list(idx[0]) == [0, 1]
+    assert dist[0, 0] < dist[0, 1]
+
+
+@pytest.mark.parametrize("codec", ["float16", "int8"])
+def test_quantized_matcher_agrees_with_float32(codec):
+    vectors, usns, queries = make_gallery()
+    exact = Matcher(normalize_rows(vectors), usns).match(queries)
+    stored = decode_embeddings([encode_embedding(v) for v in vectors], 512)
+    results = Matcher(stored, usns, quantized=QuantizedMatrix(stored, codec)).match(queries)
+    assert [r["usn"] for r in results] == [r["usn"] for r in exact]
+    assert np.allclose([r["distance"] for r in results], [r["distance"] for r in exact], atol=1e-3)
+
+
+def test_templates_update_incrementally():
+    vectors, usns, _ = make_gallery(students=6, samples=4, dim=16)
+    vectors = normalize_rows(vectors)
+    templates = StudentTemplates.build(vectors[:12], usns[:12], 16)
+    templates.add(usns[12:], vectors[12:])
+    templates.remove(usns[:4], vectors[:4])
+    rebuilt = StudentTemplates.build(vectors[4:], usns[4:], 16)
+    assert len(templates) == len(rebuilt) == 5
+    centroids, spreads = templates.lookup(rebuilt.usns)
+    assert np.allclose(centroids, rebuilt.lookup(rebuilt.usns)[0], atol=1e-6)
+    own = vectors[usns == "USN001"]
+    pairwise = 1 - (own @ own.T)[~np.eye(len(own), dtype=bool)].mean()
+    assert spreads[list(rebuilt.usns).index("USN001")] == pytest.approx(pairwise, abs=1e-6)
+
+
+def test_centroid_pass_and_adaptive_thresholds():
+    vectors, usns, queries = make_gallery()
+    vectors = normalize_rows(vectors)
+    templates = StudentTemplates.build(vectors, usns, 512)
+    exact = Matcher(vectors, usns).match(queries)
+    coarse = Matcher(vectors, usns, templates=templates, candidates=4).match(queries)
+    assert [r["usn"] for r in coarse] == [r["usn"] for r in exact]
+    assert np.allclose([r["distance"] for r in coarse], [r["distance"] for r in exact], atol=1e-5)
+    # A student's threshold rises to the spread of their samples, capped at adaptive_max
+    spread = float(templates.lookup(["USN000"])[1][0])
+    floor = spread - 0.05
+    assert Matcher(vectors, usns, templates=templates).match(queries[:1], threshold=floor)[0]["threshold"] == pytest.approx(min(spread, 0.55))
+    assert Matcher(vectors, usns, templates=templates, adaptive_max=0).match(queries[:1], threshold=floor)[0]["threshold"] == pytest.approx(floor)
@@ -0,0 +1,141 @@
+import time
+import numpy as np
+import pytest
+from starlette.websockets import WebSocketDisconnect
+from bench_pipeline import CLASS_NAME, SUBJECT
+from imaging import decode_image, encode_jpeg, face_from_box
+
+
+def frame(seed_value):
+    return encode_jpeg((np.random.default_rng(seed_value).random((120, 160, 3)) * 255).astype(np.uint8))
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_ready_then_recognition_and_attendance(backend):
+    main, client, queries = backend
+    data = frame(0)
+    main.model_manager.know(decode_image(data), queries[0])
+    student = main.gallery.student_id(main.gallery.match([queries[0]])[0]["usn"])
+    context = {"session_id": "ws-1", "class_name": CLASS_NAME, "subject": SUBJECT, "teacher_id": "t1", "mode": "check-in"}
+    with client.websocket_connect("/ws/recognize") as ws:
+        ws.send_json(context)
+        assert ws.receive_json() == {"type": "ready", **context}
+        ws.send_bytes(data)
+        recognition = ws.receive_json()
+        assert (recognition["type"], recognition["frame"], recognition["dropped"]) == ("recognition", 1, 0)
+        assert recognition["status"] == "success" and recognition["marked"]
+        assert ws.receive_json() == {"type": "attendance", "frame": 1, "usn": recognition["usn"],
+                                     "session_id": "ws-1", "mode": "check-in"}
+        ws.send_bytes(data)
+        assert ws.receive_json()["status"] == "already-marked"
+    assert main.session_attendance.is_marked("ws-1", student, "check-in")
+
+
+def test_client_box_check_in_stores_the_re_detected_face(backend):
+    main, client, queries = backend
+    data = frame(1)
+    img = decode_image(data)
+    box = {"x": 0, "y": 0, "w": img.shape[1], "h": img.shape[0]}
+    detected = queries[1] + 0.01
+    main.model_manager.know(face_from_box(img, box), queries[1])  # the client-box embedding
+    main.model_manager.know(img, detected)  # what server-side detection finds in the frame
+    context = {"session_id": "ws-box", "class_name": CLASS_NAME, "subject": SUBJECT, "teacher_id": "t1", "mode": "check-in"}
+    with client.websocket_connect("/ws/recognize") as ws:
+        ws.send_json(context)
+        assert ws.receive_json()["type"] == "ready"
+        ws.send_json({"face_box": box})
+        ws.send_bytes(data)
+        recognition = ws.receive_json()
+        assert recognition["marked"]
+    rows = main.supabase.tables["face_embeddings"]
+
+    def stored():
+        return [r for r in rows if r["usn"] == recognition["usn"] and r.get("source") == "check-in"]
+    wait_for(lambda: stored())
+    assert np.allclose(stored()[0]["embedding"], detected, atol=1e-5)
+
+
+def test_frames_arriving_while_busy_replace_the_waiting_one(backend):
+    main, client, _ = backend
+    gate = main.model_manager.gate
+    with client.websocket_connect("/ws/recognize") as ws:
+        ws.send_json({})
+        assert ws.receive_json()["type"] == "ready"
+        gate.clear()
+        main.model_manager.entered.clear()
+        try:
+            frames = main.ws_stats["frames"]
+            ws.send_bytes(frame(10))
+            assert main.model_manager.entered.wait(5)
+            # While frame 1 is being processed, 3 replaces 2 and 4 replaces 3
+            for i in range(3):
+                ws.send_bytes(frame(11 + i))
+            wait_for(lambda: main.ws_stats["frames"] == frames + 4)
+        finally:
+            gate.set()
+        first, second = ws.receive_json(), ws.receive_json()
+        assert [(e["type"], e["frame"], e["dropped"]) for e in (first, second)] == [("recognition", 1, 2), ("recognition", 4, 2)]
+
+
+def test_malformed_messages_are_ignored(backend):
+    main, client, _ = backend
+    with client.websocket_connect("/ws/recognize") as ws:
+        ws.send_json({"session_id": "ws-2"})
+        assert ws.receive_json()["type"] == "ready"
+        ws.send_text("{not json")
+        ws.send_text("[1, 2]")
+        ws.send_bytes(frame(20))
+        event = ws.receive_json()
+        assert (event["type"], event["frame"]) == ("recognition", 1)
+    # A first message that is not the JSON context closes the socket instead of binding one
+    for send, first in (("send_text", "{not json"), ("send_bytes", frame(21))):
+        with client.websocket_connect("/ws/recognize") as ws:
+            getattr(ws, send)(first)
+            with pytest.raises(WebSocketDisconnect) as closed:
+                ws.receive_json()
+            assert closed.value.code == 1007
+
+
+def test_saturated_server_sends_busy(backend):
+    main, client, _ = backend
+    pool = main.inference_pool
+    with client.websocket_connect("/ws/recognize") as ws:
+        ws.send_json({})
+        assert ws.receive_json()["type"] == "ready"
+        pool.admitted += pool.capacity
+        try:
+            ws.send_bytes(frame(30))
+            event = ws.receive_json()
+        finally:
+            pool.admitted -= pool.capacity
+        assert (event["type"], event["frame"]) == ("busy", 1)
+        assert "saturated" in event["message"]
+        ws.send_bytes(frame(31))
+        assert ws.receive_json()["type"] == "recognition"
+
+
+def test_a_failing_frame_sends_error_and_keeps_the_socket(backend, monkeypatch):
+    main, client, _ = backend
+    recognize_frame = main.recognize_frame
+    calls = []
+
+    async def fail_first(data, **kwargs):
+        calls.append(data)
+        if len(calls) == 1:
+            raise KeyError("boom")
+        return await recognize_frame(data, **kwargs)
+    monkeypatch.setattr(main, "recognize_frame", fail_first)
+    with client.websocket_connect("/ws/recognize") as ws:
+        ws.send_json({})
+        assert ws.receive_json()["type"] == "ready"
+        ws.send_bytes(frame(40))
+        assert ws.receive_json() == {"type": "error", "frame": 1}
+        ws.send_bytes(frame(41))
+        event = ws.receive_json()
+        assert (event["type"], event["frame"]) == ("recognition", 2)
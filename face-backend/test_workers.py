@@ -0,0 +1,42 @@
+import asyncio
+import threading
+import pytest
+from workers import PoolSaturated, WorkerPool
+
+
+def test_run_bounds_tasks_without_admission():
+    pool = WorkerPool("test", workers=1, queue_depth=1)
+    release = threading.Event()
+
+    async def scenario():
+        running = [asyncio.ensure_future(pool.run(release.wait)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        assert pool.tasks == 2
+        with pytest.raises(PoolSaturated):
+            await pool.run(release.wait)
+        release.set()
+        await asyncio.gather(*running)
+        assert await pool.run(sum, [1, 2]) == 3
+
+    asyncio.run(scenario())
+    assert pool.status() == {"workers": 1, "queue_depth": 1, "in_flight": 0, "tasks": 0, "rejected": 1}
+    pool.shutdown()
+
+
+def test_admitted_fan_out_is_not_rejected():
+    pool = WorkerPool("test", workers=1, queue_depth=1)
+    release = threading.Event()
+
+    async def scenario():
+        async with pool.admit():
+            running = [asyncio.ensure_future(pool.run(release.wait, admitted=True)) for _ in range(5)]
+            await asyncio.sleep(0.05)
+            assert pool.tasks == 5
+            with pytest.raises(PoolSaturated):
+                await pool.run(release.wait)  # callers without admission still get the bound
+            release.set()
+            assert await asyncio.gather(*running) == [True] * 5
+
+    asyncio.run(scenario())
+    assert pool.status()["tasks"] == 0 and pool.rejected == 1
+    pool.shutdown()
@@ -0,0 +1,91 @@
+#3.Music/face-backend/workers.py
+# Bounded worker pools that keep blocking work off the asyncio event loop.
+# Endpoints first `admit()` a request (rejecting it with PoolSaturated once every worker is
+# busy and the queue is full), then `run(..., admitted=True)` each blocking call on the pool's
+# threads. Those calls are already paid for by the request's admission, so a request that fans
+# out (one task per uploaded file) is never rejected halfway through. A pool used without
+# `admit()` (database calls) gets the same bound per `run()` call instead.
+# Threads rather than processes: TensorFlow, OpenCV and NumPy release the GIL in their hot
+# loops, and every worker can share the one warmed Facenet512 model and the in-memory gallery.
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+
+
+class PoolSaturated(Exception):
+    """Raised by WorkerPool.admit() or run() when the pool cannot take another request or task."""
+
+    def __init__(self, pool):
+        super().__init__(f"{pool.name} pool saturated ({pool.admitted} requests, {pool.tasks} tasks in flight;"
+                         f" capacity {pool.capacity})")
+        self.pool = pool
+
+
+class WorkerPool:
+    """A ThreadPoolExecutor with admission control: `workers` run at once, `queue_depth` wait."""
+
+    def __init__(self, name, workers, queue_depth):
+        self.name = name
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.capacity = workers + queue_depth
+        self.admitted = 0
+        self.tasks = 0  # submitted to the executor and not yet finished
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{name}-worker")
+
+    @asynccontextmanager
+    async def admit(self):
+        with self._lock:
+            if self.admitted >= self.capacity:
+                self.rejected += 1
+                raise PoolSaturated(self)
+            self.admitted += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self.admitted -= 1
+
+    async def run(self, fn, *args, admitted=False, **kwargs):
+        """Run a blocking callable on this pool and await its result.
+
+        Raises PoolSaturated when `capacity` tasks are already running or queued, unless the
+        caller holds an `admit()` slot (`admitted=True`). A task holds its slot until the thread
+        finishes it, even if the awaiting request was cancelled.
+        """
+        with self._lock:
+            if not admitted and self.tasks >= self.capacity:
+                self.rejected += 1
+                raise PoolSaturated(self)
+            self.tasks += 1
+        try:
+            future = self.executor.submit(partial(fn, *args, **kwargs))
+        except BaseException:
+            self._task_done(None)
+            raise
+        future.add_done_callback(self._task_done)
+        return await asyncio.wrap_future(future)
+
+    def _task_done(self, _future):
+        with self._lock:
+            self.tasks -= 1
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def status(self):
+        return {"workers": self.workers, "queue_depth": self.queue_depth,
+                "in_flight": self.admitted, "tasks": self.tasks, "rejected": self.rejected}
+
+
+def pool_from_env(name, default_workers, default_queue_depth):
+    """WorkerPool sized by <NAME>_WORKERS / <NAME>_QUEUE_DEPTH environment variables."""
+    prefix = name.upper()
+    workers = int(os.getenv(f"{prefix}_WORKERS", default_workers))
+    queue_depth = int(os.getenv(f"{prefix}_QUEUE_DEPTH", default_queue_depth))
+    return WorkerPool(name, max(1, workers), max(0, queue_depth))